@@ -0,0 +1,230 @@
+"""beattracking.py
+
+aubio's tempo object against the spectral flux one in flux.py, for tempo and
+beats. Each algorithm runs as both audio processors (the way it does with
+talg and balg set the same) over each piece of material at each frame
+multiplier. Both audio processors get each block in turn, as in ProcessAudio,
+so with flux the tempo finder follows the beats finder's FluxTempo instead
+of running its own. For each it reports:
+
+    cpu/s       seconds of processing per second of audio, tempo and beats
+                together
+    bpm         the last steady BPM
+    tempo       how close that is to the right BPM, 0.0-1.0
+    beats F     F-measure of the beats against the right ones, 0.0-1.0
+
+These are AutoTuner's scores, so they're the same numbers autotune goes by.
+The synthetic material is click tracks from soundtomidi/signals.py, clean and
+with noise mixed in. Recorded material is any audio files given, each with
+its beats marked in a text file next to it with .beats in place of its
+extension (one time in seconds per line, the way most beat annotations
+come). The right BPM is from the middle interval between them.
+
+Usage:
+  beattracking.py [options] [<audiofile>...]
+
+Options:
+  -h --help                     Show this screen.
+  --framesize=FRAMESIZE         Size of each block handed to the audio
+                                processors.
+                                [default: 512]
+  --framemults=FRAMEMULTS       Comma separated frame multipliers to try.
+                                [default: 1,2,4,8]
+  --bpms=BPMS                   Comma separated BPMs of the click tracks.
+                                [default: 90,120,140,174]
+  --seconds=SECONDS             Length of each click track, in seconds.
+                                [default: 16]
+  --noise=NOISE                 Level of the noise mixed into the noisy
+                                click tracks.
+                                [default: .05]
+  --save=FILE                   Save the results as JSON to FILE.
+                                [default: None]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import sys
+import time
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import numpy as np
+import soundtomidi
+import signals
+
+ALGORITHMS = ('default', 'flux')
+MISSING_INIFILE = os.path.join(HERE, 'no-such-file.ini')
+
+
+def make_options(framesize, framemult, algorithm):
+    # aubio wants exactly one hop per call these days, hence the hop
+    # multipliers.
+    return soundtomidi.Options(['--inifile', MISSING_INIFILE,
+                                '--inputdevice', '0', '--midiout', 'False',
+                                '--outbaud', '0', '--framesize',
+                                str(framesize), '--tframemult',
+                                str(framemult), '--bframemult',
+                                str(framemult), '--thopmult', '1',
+                                '--bhopmult', '1', '--talg', algorithm,
+                                '--balg', algorithm])
+
+
+def run_finders(options, samples):
+    # The beats and tempo finders over the same blocks, timed together.
+    beat_finder = soundtomidi.BeatFinder(options)
+    tempo_finder = soundtomidi.TempoFinder(options)
+    soundtomidi.share_tempo_object(beat_finder, tempo_finder)
+    events = []
+    feature_bus = soundtomidi.FeatureBus()
+    feature_bus.subscribe(events.append)
+    beat_finder.feature_bus = tempo_finder.feature_bus = feature_bus
+    framesize = options.config.framesize
+    samplerate = options.config.samplerate
+    started = time.time()
+    for start in range(0, len(samples) - framesize + 1, framesize):
+        feature_bus.stream_time = (start + framesize) / samplerate
+        frame = samples[start:start + framesize]
+        beat_finder.add_frame(frame)
+        tempo_finder.add_frame(frame)
+    return events, time.time() - started
+
+
+def synthetic_material(bpms, seconds, noise, samplerate):
+    material = []
+    rng = np.random.RandomState(1)
+    for bpm in bpms:
+        samples, click_times = signals.click_track(bpm, seconds, samplerate)
+        material.append(('clicks ' + str(bpm), samples, click_times))
+        noisy = samples + noise * rng.randn(len(samples)).astype(np.float32)
+        material.append(('noisy ' + str(bpm), noisy, click_times))
+    return material
+
+
+def read_audio(filename, samplerate, framesize):
+    # The whole file, mixed down and resampled by aubio.
+    source = soundtomidi.aubio.source(filename, samplerate, framesize)
+    blocks = []
+    try:
+        while True:
+            samples, read = source()
+            blocks.append(samples[:read].copy())
+            if read < framesize:
+                break
+    finally:
+        source.close()
+    return np.concatenate(blocks)
+
+
+def read_beats(filename):
+    beats_filename = os.path.splitext(filename)[0] + '.beats'
+    beat_times = []
+    with open(beats_filename) as beats_file:
+        for line in beats_file:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                beat_times.append(float(fields[0]))
+    if len(beat_times) < 2:
+        raise ValueError(beats_filename + " needs at least two beats")
+    return beat_times
+
+
+def recorded_material(filenames, samplerate, framesize):
+    material = []
+    for filename in filenames:
+        material.append((os.path.basename(filename),
+                         read_audio(filename, samplerate, framesize),
+                         read_beats(filename)))
+    return material
+
+
+def run(material, framesize, framemults):
+    results = []
+    for algorithm in ALGORITHMS:
+        for framemult in framemults:
+            options = make_options(framesize, framemult, algorithm)
+            tuner = soundtomidi.AutoTuner(options)
+            window = framesize * framemult
+            for name, samples, beat_times in material:
+                result = {'algorithm': algorithm, 'framemult': framemult,
+                          'material': name}
+                try:
+                    events, seconds = run_finders(options, samples)
+                except (ValueError, RuntimeError) as error:
+                    # aubio won't take every window and hop.
+                    result['error'] = str(error)
+                    results.append(result)
+                    continue
+                bpms = [event.steady_bpm for event in events
+                        if isinstance(event, soundtomidi.TempoEvent)]
+                audio_seconds = len(samples) / options.config.samplerate
+                result.update({
+                    'cpu_per_second': seconds / audio_seconds,
+                    'bpm': bpms[-1] if bpms else None,
+                    'tempo': tuner.score_tempo(events, beat_times, window),
+                    'beats': tuner.score_beats(events, beat_times, window)})
+                results.append(result)
+    return results
+
+
+def show(results):
+    row = "{:<8} {:>5}  {:<20} {:>8} {:>7} {:>6} {:>8}"
+    print(row.format('', 'mult', '', 'cpu/s', 'bpm', 'tempo', 'beats F'))
+    for result in results:
+        if 'error' in result:
+            print(row.format(result['algorithm'], result['framemult'],
+                             result['material'], '-', '-', '-', '-'))
+            continue
+        bpm = '-' if result['bpm'] is None else \
+            '{:.1f}'.format(result['bpm'])
+        print(row.format(result['algorithm'], result['framemult'],
+                         result['material'],
+                         '{:.4f}'.format(result['cpu_per_second']), bpm,
+                         '{:.2f}'.format(result['tempo']),
+                         '{:.2f}'.format(result['beats'])))
+    print()
+    print("Averages")
+    for algorithm in ALGORITHMS:
+        for framemult in sorted(set(result['framemult']
+                                    for result in results)):
+            chosen = [result for result in results
+                      if result['algorithm'] == algorithm and
+                      result['framemult'] == framemult and
+                      'error' not in result]
+            if not chosen:
+                continue
+            print(row.format(
+                algorithm, framemult, '',
+                '{:.4f}'.format(np.mean([result['cpu_per_second']
+                                         for result in chosen])), '',
+                '{:.2f}'.format(np.mean([result['tempo']
+                                         for result in chosen])),
+                '{:.2f}'.format(np.mean([result['beats']
+                                         for result in chosen]))))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    framesize = int(arguments['--framesize'])
+    framemults = [int(value) for value in
+                  arguments['--framemults'].split(',')]
+    samplerate = make_options(framesize, 1, 'default').config.samplerate
+    material = synthetic_material(
+        [int(value) for value in arguments['--bpms'].split(',')],
+        float(arguments['--seconds']), float(arguments['--noise']),
+        samplerate)
+    try:
+        material += recorded_material(arguments['<audiofile>'], samplerate,
+                                      framesize)
+    except (IOError, OSError, RuntimeError, ValueError) as error:
+        sys.exit(str(error))
+    results = run(material, framesize, framemults)
+    show(results)
+    if arguments['--save'] != 'None':
+        with open(arguments['--save'], 'w') as save_file:
+            json.dump({'time': time.time(), 'python': sys.version,
+                       'framesize': framesize, 'results': results},
+                      save_file, indent=2)
@@ -0,0 +1,192 @@
+"""decodercheck.py
+
+Checks the Decoder in soundtomidi/decoder.py. Anything listening to a MIDI
+port hears every device on it, not just soundtomidi, so the decoder has to
+turn down whatever isn't one of ours without raising. This builds a decoder
+from the default options (the way Decoder.from_config is meant to be used),
+and another with two byte sysex commands so the prefixes are different
+lengths, and then:
+
+    ours            messages like the MidiEncoder sends decode to the right
+                    feature, source and value.
+    short           sysex shorter than a prefix and command (F0 F7,
+                    F0 7D F7, and so on), control changes and notes missing
+                    bytes, and an empty message, all decode to None.
+    cut short       messages with our prefix and command whose values are
+                    missing, or half there, decode to None.
+    foreign         other manufacturers, other channels and other
+                    controllers decode to None.
+    decode_many     a queue with all of the above mixed in gives back just
+                    ours, in order.
+
+It prints each thing it checked, and exits with an error at the first one
+that's wrong.
+
+Usage:
+  decodercheck.py [options]
+
+Options:
+  -h --help                     Show this screen.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import soundtomidi
+from decoder import Decoder
+
+MISSING_INIFILE = os.path.join(HERE, 'no-such-file.ini')
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, description):
+    if not condition:
+        raise CheckFailed(description)
+    print("ok   " + description)
+
+
+def message(*values):
+    return bytes(bytearray(values))
+
+
+def describe(data):
+    return ' '.join('{:02X}'.format(value) for value in bytearray(data)) or \
+        '(empty)'
+
+
+def decode(decoder, data):
+    # A value, or the exception, so a raise is a failed check rather than a
+    # stack trace.
+    try:
+        result = decoder.decode(data)
+    except Exception as error:
+        return 'raised ' + repr(error)
+    if result is not None and isinstance(result[2], memoryview):
+        result = result[:2] + (list(result[2]),)
+    return result
+
+
+def default_decoder():
+    options = soundtomidi.Options(['--inifile', MISSING_INIFILE,
+                                   '--inputdevice', '0', '--midiout',
+                                   'False', '--outbaud', '0'])
+    return options.config, Decoder.from_config(options.config)
+
+
+def ours(config):
+    # (message, what it should decode to), from the config's numbers.
+    manufacturer = tuple(config.sysexmanf)
+    channel = config.outputs[0][1]
+
+    def sysex(commands, *values):
+        return message(*((0xF0,) + manufacturer + (channel,) +
+                         tuple(commands) + values + (0xF7,)))
+
+    return [
+        (message(0xB0 | channel, config.tcontrolnum, 60),
+         ('tempo', 'control', 120)),
+        (message(0xB0 | channel, config.bcontrolnum, 3),
+         ('beats', 'control', 3)),
+        (sysex(config.tsysexnum, 9, 22), ('tempo', 'sysex', 117.4)),
+        (sysex(config.bsysexnum, 2), ('beats', 'sysex', 2)),
+        (sysex(config.rsysexnum, 100), ('rms', 'sysex', 100)),
+        (sysex(config.fsysexnum, 1, 2, 3), ('frequencies', 'sysex',
+                                             [1, 2, 3])),
+        (sysex(config.psysexnum, 69), ('pitch', 'sysex', 69)),
+        (message(0x90 | channel, 69, 100), ('pitch', 'note_on', 69)),
+        (message(0x90 | channel, 69, 0), ('pitch', 'note_off', 69)),
+        (message(0x80 | channel, 69, 0), ('pitch', 'note_off', 69)),
+    ]
+
+
+def not_ours(config):
+    manufacturer = tuple(config.sysexmanf)
+    channel = config.outputs[0][1]
+    prefix = (0xF0,) + manufacturer + (channel,)
+    short = [message(), message(0xF0), message(0xF0, 0xF7),
+             message(*((0xF0,) + manufacturer + (0xF7,))),
+             message(*(prefix + (0xF7,))),
+             message(0xB0 | channel), message(0xB0 | channel,
+                                               config.tcontrolnum),
+             message(0x90 | channel, 69), message(0x80 | channel)]
+    cut_short = [
+        # The command with no value, and twobytes BPM with only one.
+        message(*(prefix + tuple(config.tsysexnum) + (0xF7,))),
+        message(*(prefix + tuple(config.tsysexnum) + (9, 0xF7))),
+        message(*(prefix + tuple(config.bsysexnum) + (0xF7,))),
+        message(*(prefix + tuple(config.rsysexnum) + (0xF7,))),
+        message(*(prefix + tuple(config.psysexnum) + (0xF7,))),
+        # No F7 at all.
+        message(*(prefix + tuple(config.fsysexnum))),
+    ]
+    foreign = [message(0xF0, 0x41, 0x10, 0x42, 0x12, 0x40, 0x00, 0x7F,
+                       0xF7),
+               message(0xF0, 0x7E, 0x7F, 0x06, 0x01, 0xF7),
+               message(*((0xF0,) + manufacturer + ((channel + 1) % 16,) +
+                         tuple(config.rsysexnum) + (100, 0xF7))),
+               message(0xB0 | ((channel + 1) % 16), config.tcontrolnum, 60),
+               message(0xB0 | channel, 7, 100),
+               message(0xE0 | channel, 0, 64), message(0xF8),
+               message(0xFE)]
+    return [('short', short), ('cut short', cut_short),
+            ('foreign', foreign)]
+
+
+def run():
+    config, decoder = default_decoder()
+    good = ours(config)
+    for data, expected in good:
+        check(decode(decoder, data) == expected,
+              "ours: " + describe(data) + " is " + repr(expected))
+    groups = not_ours(config)
+    for name, messages in groups:
+        for data in messages:
+            result = decode(decoder, data)
+            check(result is None, name + ": " + describe(data) + " is None" +
+                  ('' if result is None else ", not " + repr(result)))
+    # Longer prefixes, from commands more than a byte long, alongside
+    # shorter ones.
+    long_decoder = Decoder(channels=(13,), sysex_commands={
+        'tempo': (1, 11), 'rms': (31,)}, tempo_sysex_type='twobytes')
+    check(decode(long_decoder, message(0xF0, 0x7D, 13, 1, 11, 9, 22, 0xF7)) ==
+          ('tempo', 'sysex', 117.4),
+          "ours: a two byte command decodes")
+    for data in (message(0xF0, 0x7D, 13, 1, 0xF7),
+                 message(0xF0, 0x7D, 13, 1, 11, 0xF7),
+                 message(0xF0, 0x7D, 13, 1, 11, 9, 0xF7),
+                 message(0xF0, 0x7D, 13, 31, 0xF7)):
+        check(decode(long_decoder, data) is None,
+              "cut short: " + describe(data) + " is None with a two byte " +
+              "command")
+    mixed = []
+    for index, (data, expected) in enumerate(good):
+        mixed.append(data)
+        mixed.extend(groups[index % len(groups)][1])
+    try:
+        results = decoder.decode_many(mixed)
+    except Exception as error:
+        results = 'raised ' + repr(error)
+    else:
+        results = [result[:2] + (list(result[2]),)
+                   if isinstance(result[2], memoryview) else result
+                   for result in results]
+    check(results == [expected for data, expected in good],
+          "decode_many: " + str(len(mixed)) + " messages give back just " +
+          "our " + str(len(good)) + ", in order")
+
+
+if __name__ == '__main__':
+    docopt(__doc__)
+    try:
+        run()
+    except CheckFailed as error:
+        sys.exit("FAILED " + str(error))
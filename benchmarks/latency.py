@@ -0,0 +1,261 @@
+"""latency.py
+
+How late does the MIDI come out, compared to the sound that caused it? This
+plays synthetic audio with known hit times into ProcessAudio.callback the way
+sounddevice would--one block at a time, each one handed over when it would
+have finished arriving from the sound card--with the MIDI outputs running
+their usual threads and pacing. Every message sent is caught by a stand in
+MIDI port that notes the time.
+
+Latency for a hit is the time from when its first sample would have reached
+the sound card to the first matching message out:
+
+    beats        any beat message
+    rms          RMS at half of its maximum or more
+    frequencies  any band at half of its maximum or more
+    pitch        a note on (tone bursts instead of clicks)
+
+Tempo is a running estimate, not a reaction to a hit, so it isn't measured.
+Hits that get no response before the next one are counted as missed.
+
+Each ini file given is a configuration to measure (command line options here
+apply on top, like they do for soundtomidi). With none, the defaults are
+used. aubio wants exactly one hop per call these days, so the tempo and pitch
+hop multipliers are set to 1 unless an ini file says otherwise.
+
+Usage:
+  latency.py [options] [<inifile>...]
+
+Options:
+  -h --help                     Show this screen.
+  --seconds=SECONDS             Seconds of audio per signal. It plays in real
+                                time, so this is how long it takes, twice.
+                                [default: 10]
+  --interval=INTERVAL           Seconds between hits.
+                                [default: .5]
+  --save=FILE                   Save the results as JSON to FILE.
+                                [default: None]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import numpy as np
+import soundtomidi
+import signals
+
+MISSING_INIFILE = os.path.join(HERE, 'no-such-file.ini')
+FEATURES = ('beats', 'rms', 'frequencies', 'pitch')
+
+# What sounddevice hands the callback as its time argument.
+StreamTime = namedtuple('StreamTime', 'inputBufferAdcTime '
+                                      'outputBufferDacTime currentTime')
+
+
+class SinkPort:
+    """Stands in for a mido output port. Keeps every message and when."""
+
+    def __init__(self):
+        self.received = []
+
+    def send(self, message):
+        self.received.append((soundtomidi.monotonic(), message))
+
+
+class FakeInputStream:
+    """Stands in for sd.InputStream, playing samples at the real rate.
+
+    Block n is handed to the callback at start + (n + 1) * block time, when
+    its last sample would have arrived, with a StreamTime like sounddevice's
+    on the monotonic clock.
+
+    """
+
+    def __init__(self, samples, samplerate, blocksize, callback):
+        self.samples = samples.reshape(-1, 1)
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.start_time = None
+        self.late_blocks = 0
+
+    def play(self):
+        monotonic = soundtomidi.monotonic
+        self.start_time = monotonic()
+        block_seconds = self.blocksize / self.samplerate
+        for block, start in enumerate(range(0, len(self.samples) -
+                                            self.blocksize + 1,
+                                            self.blocksize)):
+            adc_time = self.start_time + block * block_seconds
+            due = adc_time + block_seconds
+            wait = due - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                self.late_blocks += 1
+            self.callback(self.samples[start:start + self.blocksize],
+                          self.blocksize, StreamTime(adc_time, 0.0,
+                                                     monotonic()), 0)
+
+    def sample_time(self, sample):
+        return self.start_time + sample / self.samplerate
+
+
+def make_options(inifile):
+    arguments = ['--inputdevice', '0', '--midiout', 'False']
+    if inifile is None:
+        arguments += ['--inifile', MISSING_INIFILE, '--thopmult', '1',
+                      '--phopmult', '1']
+    else:
+        arguments += ['--inifile', inifile]
+    return soundtomidi.Options(arguments)
+
+
+class Classifier:
+    """Works out which feature a message is for, and its biggest value."""
+
+    def __init__(self, config):
+        self.controls = {}
+        self.sysex_commands = {}
+        for feature, prefix in (('tempo', 't'), ('beats', 'b'), ('rms', 'r'),
+                                ('frequencies', 'f'), ('pitch', 'p')):
+            control = getattr(config, prefix + 'controlnum', None)
+            if control is not None:
+                self.controls[control] = feature
+            sysex = getattr(config, prefix + 'sysexnum')
+            if sysex:
+                self.sysex_commands[sysex[0]] = feature
+        self.command_index = len(config.sysexmanf) + 1
+
+    def classify(self, message):
+        if message.type == 'note_on':
+            return 'pitch', 127
+        if message.type == 'control_change':
+            return self.controls.get(message.control), message.value
+        if message.type == 'sysex':
+            data = message.data
+            feature = self.sysex_commands.get(data[self.command_index])
+            return feature, max(data[self.command_index + 1:] or (0,))
+        return None, 0
+
+
+def responds(feature, value):
+    if feature in ('rms', 'frequencies'):
+        return value >= 64
+    return True
+
+
+def measure(options, samples, hit_samples, features):
+    # A little hiss, like any real input has. Blocks of pure digital silence
+    # are skipped by ProcessAudio, which isn't what's being measured.
+    samples = samples + signals.band_noise(20, 20000, len(samples) /
+                                           options.config.samplerate,
+                                           options.config.samplerate, .002)
+    process_audio = soundtomidi.ProcessAudio(options)
+    sink = SinkPort()
+    for output in process_audio.midi_processor.outputs:
+        output.midi_outport = sink
+    stream = FakeInputStream(samples, process_audio.samplerate,
+                             process_audio.blocksize, process_audio.callback)
+    process_audio.midi_processor.start()
+    try:
+        stream.play()
+        time.sleep(.5)
+    finally:
+        process_audio.midi_processor.stop()
+    classifier = Classifier(options.config)
+    hit_times = [stream.sample_time(sample) for sample in hit_samples]
+    results = {}
+    for feature in features:
+        sent = []
+        for sent_time, message in sink.received:
+            message_feature, value = classifier.classify(message)
+            if message_feature == feature and responds(feature, value):
+                sent.append(sent_time)
+        latencies = []
+        for index, hit_time in enumerate(hit_times):
+            next_hit = float('inf')
+            if index + 1 < len(hit_times):
+                next_hit = hit_times[index + 1]
+            for sent_time in sent:
+                if hit_time <= sent_time < next_hit:
+                    latencies.append(sent_time - hit_time)
+                    break
+        results[feature] = summarize(latencies, len(hit_times))
+    results['late_blocks'] = stream.late_blocks
+    return results
+
+
+def summarize(latencies, hits):
+    summary = {'hits': hits, 'answered': len(latencies),
+               'p50': None, 'p95': None, 'p99': None}
+    if latencies:
+        milliseconds = np.array(latencies) * 1000
+        for percentile in (50, 95, 99):
+            summary['p' + str(percentile)] = float(
+                np.percentile(milliseconds, percentile))
+    return summary
+
+
+def run(inifile, seconds, interval):
+    options = make_options(inifile)
+    samplerate = options.config.samplerate
+    # Clicks for beats, RMS and frequencies.
+    clicks, click_times = signals.click_track(60.0 / interval, seconds,
+                                              samplerate)
+    hits = [int(round(click_time * samplerate)) for click_time in click_times]
+    results = measure(options, clicks, hits, ('beats', 'rms', 'frequencies'))
+    # Tone bursts, a fifth apart, for pitch.
+    samples = signals.silence(seconds, samplerate)
+    hits = []
+    burst_length = int(interval * .6 * samplerate)
+    for index, start in enumerate(range(0, len(samples) - burst_length,
+                                        int(interval * samplerate))):
+        note = (60, 67)[index % 2]
+        samples[start:start + burst_length] = signals.tone(
+            signals.note_frequency(note), interval * .6, samplerate)
+        hits.append(start)
+    pitch_results = measure(options, samples, hits, ('pitch',))
+    results['pitch'] = pitch_results['pitch']
+    results['late_blocks'] += pitch_results['late_blocks']
+    return results
+
+
+def show(name, results):
+    print("\n" + name)
+    print("{:<12} {:>8} {:>9} {:>9} {:>9}".format('', 'answered', 'p50 ms',
+                                                  'p95 ms', 'p99 ms'))
+    for feature in FEATURES:
+        result = results[feature]
+        cells = ['-' if result[key] is None else '{:.1f}'.format(result[key])
+                 for key in ('p50', 'p95', 'p99')]
+        print("{:<12} {:>8} {:>9} {:>9} {:>9}".format(
+            feature, '{}/{}'.format(result['answered'], result['hits']),
+            *cells))
+    if results['late_blocks']:
+        print(results['late_blocks'], "blocks were handed over late; this "
+              "computer couldn't keep up.")
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    inifiles = arguments['<inifile>'] or [None]
+    all_results = {}
+    for inifile in inifiles:
+        name = inifile or 'defaults'
+        all_results[name] = run(inifile, float(arguments['--seconds']),
+                                float(arguments['--interval']))
+        show(name, all_results[name])
+    if arguments['--save'] != 'None':
+        with open(arguments['--save'], 'w') as save_file:
+            json.dump({'time': time.time(), 'python': sys.version,
+                       'results': all_results}, save_file, indent=2)
@@ -0,0 +1,165 @@
+"""osccheck.py
+
+Checks what the OscProcessor sends. A UDP socket is bound on the loopback
+address, an OscProcessor is pointed at it, and one block's worth of events
+(tempo, a beat, RMS, frequencies and pitch, then the BlockEvent) goes
+through it. The datagram that arrives is taken apart by hand and checked
+against the OSC spec: the "#bundle" header, the time tag, the length of each
+element, every string null terminated and padded to four bytes, the type
+tags, and the values themselves. The floats are sent as float32, so the
+values used here are ones float32 holds exactly.
+
+It prints each thing it checked, and exits with an error at the first one
+that's wrong.
+
+Usage:
+  osccheck.py [options]
+
+Options:
+  -h --help                     Show this screen.
+  --oscprefix=OSCPREFIX         Prefix for the OSC addresses.
+                                [default: /soundtomidi]
+  --timeout=TIMEOUT             Seconds to wait for the datagram.
+                                [default: 2]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import socket
+import struct
+import sys
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import soundtomidi
+
+MISSING_INIFILE = os.path.join(HERE, 'no-such-file.ini')
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, description):
+    if not condition:
+        raise CheckFailed(description)
+    print("ok   " + description)
+
+
+def make_processor(port, prefix):
+    options = soundtomidi.Options(['--inifile', MISSING_INIFILE,
+                                   '--inputdevice', '0', '--midiout',
+                                   'False', '--outbaud', '0', '--oscout',
+                                   'True', '--oschost', '127.0.0.1',
+                                   '--oscport', str(port), '--oscprefix',
+                                   prefix])
+    return soundtomidi.OscProcessor(options)
+
+
+def one_block():
+    # Each event, and the messages it should turn into: address suffix,
+    # type tags and values.
+    return [
+        (soundtomidi.TempoEvent(1.0, 121.0, 120.5, 120.0),
+         ('/bpm', ',f', (120.5,))),
+        (soundtomidi.BeatEvent(1.0, 3, 0.0),
+         ('/beat', ',i', (3,))),
+        (soundtomidi.RMSEvent(1.0, 0.125, 0.75),
+         ('/rms', ',ff', (0.125, 0.75))),
+        (soundtomidi.FrequenciesEvent(1.0, [2.0, 4.0, 8.0],
+                                      [0.25, 0.5, 1.0]),
+         ('/frequencies', ',fff', (0.25, 0.5, 1.0))),
+        (soundtomidi.PitchEvent(1.0, 69.5, 0.875),
+         ('/pitch', ',ff', (69.5, 0.875))),
+    ]
+
+
+def read_string(data, offset, what):
+    # An OSC string: ASCII, at least one null, padded with nulls to a
+    # multiple of four bytes.
+    end = data.find(b'\0', offset)
+    check(end >= 0, what + " is null terminated")
+    value = data[offset:end].decode('ascii')
+    padded_end = (end // 4 + 1) * 4
+    check(padded_end <= len(data) and
+          data[end:padded_end] == b'\0' * (padded_end - end),
+          what + " is padded with nulls to a multiple of four")
+    return value, padded_end
+
+
+def read_message(data, description):
+    address, offset = read_string(data, 0, description + " address")
+    type_tags, offset = read_string(data, offset,
+                                    description + " type tags")
+    check(type_tags.startswith(','),
+          description + " type tags start with a comma")
+    arguments = struct.unpack('>' + type_tags[1:], data[offset:])
+    return address, type_tags, arguments
+
+
+def read_bundle(datagram):
+    check(len(datagram) % 4 == 0, "bundle is a multiple of four bytes")
+    header, offset = read_string(datagram, 0, "bundle header")
+    check(header == '#bundle', "bundle starts with #bundle")
+    seconds, fraction = struct.unpack_from('>II', datagram, offset)
+    check((seconds, fraction) == (0, 1), "time tag is 1, meaning now")
+    offset += 8
+    elements = []
+    while offset < len(datagram):
+        size, = struct.unpack_from('>i', datagram, offset)
+        offset += 4
+        check(size > 0 and size % 4 == 0 and
+              offset + size <= len(datagram),
+              "element " + str(len(elements)) + " size " + str(size) +
+              " fits and is a multiple of four")
+        elements.append(datagram[offset:offset + size])
+        offset += size
+    return elements
+
+
+def run(prefix, timeout):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(timeout)
+        port = listener.getsockname()[1]
+        processor = make_processor(port, prefix)
+        block = one_block()
+        for event, expected in block:
+            processor.handle_event(event)
+        check(processor.stats()['sent'] == 0,
+              "nothing is sent before the end of the block")
+        processor.handle_event(soundtomidi.BlockEvent(1.0, 512))
+        check(processor.stats() == {'sent': 1, 'errors': 0},
+              "one datagram is sent at the end of the block")
+        datagram = listener.recv(65536)
+        elements = read_bundle(datagram)
+        check(len(elements) == len(block),
+              "bundle has " + str(len(block)) + " messages")
+        prefix = prefix.rstrip('/')
+        for element, (event, expected) in zip(elements, block):
+            suffix, expected_tags, expected_values = expected
+            address, type_tags, arguments = read_message(element, suffix)
+            check(address == prefix + suffix,
+                  suffix + " address is " + prefix + suffix)
+            check(type_tags == expected_tags,
+                  suffix + " type tags are " + expected_tags)
+            check(arguments == expected_values,
+                  suffix + " values are " + repr(expected_values))
+        # A block with nothing in it sends nothing.
+        processor.handle_event(soundtomidi.BlockEvent(2.0, 512))
+        check(processor.stats()['sent'] == 1,
+              "an empty block sends nothing")
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    try:
+        run(arguments['--oscprefix'], float(arguments['--timeout']))
+    except (CheckFailed, socket.timeout) as error:
+        sys.exit("FAILED " + str(error))
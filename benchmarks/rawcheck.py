@@ -0,0 +1,268 @@
+"""rawcheck.py
+
+Checks the raw input streams in soundtomidi/rawinput.py, with no sound card
+and nothing but this computer. A ramp (every sample a different value, so
+anything out of order, repeated or lost shows) goes in as raw frames, and
+what comes out of the stream's callback is compared with it:
+
+    udp int16       paced like a real sender through a UDP socket on the
+    udp float32     loopback address. Every block played is the next piece
+                    of the ramp, and once the sender stops the blocks are
+                    silence flagged as an input underflow.
+    udp overflow    a burst much bigger than the jitter buffer, all at once.
+                    The receiving thread has to drop the oldest audio, and a
+                    block is flagged as an input overflow. What's played is
+                    still in order.
+    fifo int16      through a named pipe, written by two writers one after
+    fifo float32    the other. Every block is the next piece of the ramp,
+                    across the reopen, and nothing is flagged.
+
+It prints each thing it checked, and exits with an error at the first one
+that's wrong.
+
+Usage:
+  rawcheck.py [options]
+
+Options:
+  -h --help                     Show this screen.
+  --blocksize=BLOCKSIZE         Frames per block.
+                                [default: 64]
+  --samplerate=SAMPLERATE       Sample rate. Low, so the UDP checks don't
+                                take long.
+                                [default: 8000]
+  --channels=CHANNELS           Channels per frame.
+                                [default: 2]
+  --jitter=JITTER               Seconds of UDP jitter buffer.
+                                [default: .02]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import numpy as np
+import rawinput
+
+# How long to wait for blocks that should come.
+TIMEOUT = 5
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, description):
+    if not condition:
+        raise CheckFailed(description)
+    print("ok   " + description)
+
+
+def make_ramp(frames, channels, sample_format):
+    # The raw bytes to send, and the float32 values they should come out as.
+    # Both formats hold every value exactly.
+    values = np.arange(frames * channels)
+    if sample_format == 'int16':
+        raw = (values % 32768).astype('<i2')
+        expected = raw.astype(np.float32) / 32768
+    else:
+        raw = (values / 65536).astype('<f4')
+        expected = raw.astype(np.float32)
+    return raw.tobytes(), expected.reshape(frames, channels)
+
+
+class Receiver:
+    """The stream's callback. Keeps a copy of every block, because the
+    stream reuses its buffer."""
+
+    def __init__(self):
+        self.blocks = []
+        self.statuses = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data, frames, stream_time, status):
+        with self.lock:
+            self.blocks.append(data.copy())
+            self.statuses.append(status)
+
+    def wait_for(self, condition):
+        started = time.time()
+        while time.time() - started < TIMEOUT:
+            with self.lock:
+                if condition(self.statuses):
+                    return True
+            time.sleep(.01)
+        return False
+
+    def played(self):
+        # The blocks that weren't underflow silence, end to end.
+        with self.lock:
+            played = [block for block, status in
+                      zip(self.blocks, self.statuses)
+                      if status != rawinput.INPUT_UNDERFLOW]
+        if not played:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate(played)
+
+
+def open_udp(receiver, settings, sample_format):
+    stream = rawinput.open_stream(('udp', ('127.0.0.1', 0)),
+                                  settings['channels'], receiver,
+                                  settings['blocksize'],
+                                  settings['samplerate'], sample_format,
+                                  settings['jitter'])
+    port = stream.udp_socket.getsockname()[1]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(('127.0.0.1', port))
+    return stream, sender
+
+
+def check_udp_in_order(settings, sample_format):
+    name = 'udp ' + sample_format
+    blocksize = settings['blocksize']
+    packets = 40
+    raw, expected = make_ramp(packets * blocksize, settings['channels'],
+                              sample_format)
+    packet_bytes = len(raw) // packets
+    receiver = Receiver()
+    stream, sender = open_udp(receiver, settings, sample_format)
+    try:
+        stream.start()
+        for index in range(packets):
+            sender.send(raw[index * packet_bytes:(index + 1) * packet_bytes])
+            time.sleep(blocksize / settings['samplerate'])
+        check(receiver.wait_for(
+            lambda statuses: rawinput.INPUT_UNDERFLOW in statuses),
+            name + ": an underflow is flagged once the sender stops")
+    finally:
+        stream.close()
+        sender.close()
+    played = receiver.played()
+    target_frames = stream.target_bytes // stream.frame_bytes
+    check(len(played) >= len(expected) - target_frames,
+          name + ": " + str(len(played)) + " of " + str(len(expected)) +
+          " frames played, all but at most the jitter buffer")
+    check(np.array_equal(played, expected[:len(played)]),
+          name + ": the frames played are the ramp, in order")
+    silent = [block for block, status in
+              zip(receiver.blocks, receiver.statuses)
+              if status == rawinput.INPUT_UNDERFLOW]
+    check(all(not block.any() for block in silent),
+          name + ": the underflow blocks are silence")
+    check(rawinput.INPUT_OVERFLOW not in receiver.statuses,
+          name + ": no overflow is flagged")
+    stats = stream.stats()
+    check(stats['packets'] == packets and stats['underflows'] >= 1 and
+          stats['overflows'] == 0,
+          name + ": stats " + repr(stats))
+
+
+def check_udp_overflow(settings):
+    name = 'udp overflow'
+    sample_format = 'float32'
+    blocksize = settings['blocksize']
+    receiver = Receiver()
+    stream, sender = open_udp(receiver, settings, sample_format)
+    capacity = len(stream.ring)
+    # Enough blocks, sent as fast as they'll go, to go round the ring
+    # several times before the first block plays.
+    packets = 4 * capacity // stream.block_bytes
+    raw, expected = make_ramp(packets * blocksize, settings['channels'],
+                              sample_format)
+    packet_bytes = len(raw) // packets
+    try:
+        stream.start()
+        for index in range(packets):
+            sender.send(raw[index * packet_bytes:(index + 1) * packet_bytes])
+        check(receiver.wait_for(
+            lambda statuses: rawinput.INPUT_UNDERFLOW in statuses),
+            name + ": the stream plays out what it kept and runs dry")
+    finally:
+        stream.close()
+        sender.close()
+    check(rawinput.INPUT_OVERFLOW in receiver.statuses,
+          name + ": an overflow is flagged")
+    played = receiver.played()
+    check(0 < len(played) < len(expected),
+          name + ": " + str(len(played)) + " of " + str(len(expected)) +
+          " frames played, the rest dropped")
+    flat = played.ravel()
+    check((np.diff(flat) > 0).all(),
+          name + ": what's played is still in order")
+    last = np.searchsorted(expected.ravel(), flat[-1])
+    check(expected.size - 1 - last < blocksize * settings['channels'],
+          name + ": the newest audio is what's kept")
+    stats = stream.stats()
+    check(stats['overflows'] >= 1, name + ": stats " + repr(stats))
+
+
+def check_fifo(settings, sample_format):
+    name = 'fifo ' + sample_format
+    blocksize = settings['blocksize']
+    writers = 2
+    blocks_each = 10
+    raw, expected = make_ramp(writers * blocks_each * blocksize,
+                              settings['channels'], sample_format)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'audio')
+    os.mkfifo(path)
+    receiver = Receiver()
+    stream = rawinput.open_stream(('fifo', path), settings['channels'],
+                                  receiver, blocksize,
+                                  settings['samplerate'], sample_format)
+    try:
+        stream.start()
+        share = len(raw) // writers
+        for writer in range(writers):
+            # Opening waits until the stream has the pipe open to read.
+            with open(path, 'wb') as fifo:
+                fifo.write(raw[writer * share:(writer + 1) * share])
+            count = (writer + 1) * blocks_each
+            check(receiver.wait_for(
+                lambda statuses: len(statuses) >= count),
+                name + ": writer " + str(writer + 1) + "'s blocks arrive")
+    finally:
+        stream.close()
+        # The stream is waiting for another writer. One that writes nothing
+        # lets it see it's closed.
+        if stream.thread is not None and stream.thread.is_alive():
+            with open(path, 'wb'):
+                pass
+            stream.thread.join(TIMEOUT)
+        shutil.rmtree(directory)
+    check(np.array_equal(receiver.played(), expected),
+          name + ": every block is the ramp, in order, across the reopen")
+    check(set(receiver.statuses) == set([0]),
+          name + ": nothing is flagged")
+
+
+def run(settings):
+    for sample_format in ('int16', 'float32'):
+        check_udp_in_order(settings, sample_format)
+    check_udp_overflow(settings)
+    if hasattr(os, 'mkfifo'):
+        for sample_format in ('int16', 'float32'):
+            check_fifo(settings, sample_format)
+    else:
+        print("--   no named pipes here, so no fifo checks")
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    settings = {'blocksize': int(arguments['--blocksize']),
+                'samplerate': int(arguments['--samplerate']),
+                'channels': int(arguments['--channels']),
+                'jitter': float(arguments['--jitter'])}
+    try:
+        run(settings)
+    except CheckFailed as error:
+        sys.exit("FAILED " + str(error))
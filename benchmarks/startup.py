@@ -0,0 +1,114 @@
+"""startup.py
+
+How long soundtomidi takes to get going. Each entry point is run in a fresh
+Python process, several times over, and the wall clock time until it exits is
+reported. The last one is a normal run: time from starting the process until
+the first MIDI message comes out. It doesn't need a sound card--synthetic
+clicks are fed straight into ProcessAudio.callback and MIDI goes to standard
+out.
+
+The first run of each is usually the slowest, since that's when the files
+come off the disk (or SD card), so both the first and the best times are
+shown. To be really cold, drop the OS file cache between runs.
+
+Usage:
+  startup.py [options]
+
+Options:
+  -h --help                     Show this screen.
+  --repeat=REPEAT               Times to run each entry point.
+                                [default: 5]
+  --save=FILE                   Also save the results as JSON to FILE.
+                                [default: None]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+SCRIPT = os.path.join(MODULE_DIRECTORY, 'soundtomidi.py')
+INIFILE = os.path.join(tempfile.gettempdir(), 'soundtomidi-startup.ini')
+
+# Feeds clicks at 120 BPM into ProcessAudio until something comes out. aubio
+# wants exactly one hop per call these days, hence the hop multipliers.
+FIRST_MIDI = """
+import numpy as np
+import soundtomidi
+options = soundtomidi.Options(['--inifile', '{inifile}', '--inputdevice', '0',
+                               '--midiout', 'False', '--stdout', 'True',
+                               '--outbaud', '0', '--thopmult', '1',
+                               '--phopmult', '1'])
+process_audio = soundtomidi.ProcessAudio(options)
+samples = np.zeros((process_audio.samplerate * 4, 1), dtype=np.float32)
+for start in range(0, len(samples), process_audio.samplerate // 2):
+    samples[start:start + 64] = .9
+blocksize = process_audio.blocksize
+for start in range(0, len(samples) - blocksize, blocksize):
+    process_audio.callback(samples[start:start + blocksize], blocksize,
+                           None, None)
+"""
+
+# Name, arguments, and whether to stop at the first line of output rather
+# than waiting for it to exit.
+ENTRY_POINTS = [
+    ('import', ['-c', 'import soundtomidi'], False),
+    ('help', [SCRIPT, '--help'], False),
+    ('writeinifile', [SCRIPT, '--writeinifile', '--inifile', INIFILE], False),
+    ('listmidiports', [SCRIPT, '--listmidiports'], False),
+    ('listsounddevices', [SCRIPT, '--listsounddevices'], False),
+    ('first MIDI message', ['-c', FIRST_MIDI.format(inifile=INIFILE)], True),
+]
+
+
+def run_once(arguments, first_output):
+    started = time.time()
+    process = subprocess.Popen([sys.executable] + arguments,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               cwd=MODULE_DIRECTORY)
+    if first_output:
+        line = process.stdout.readline()
+        elapsed = time.time() - started
+        process.kill()
+        process.communicate()
+        return elapsed, bool(line)
+    process.communicate()
+    return time.time() - started, process.returncode == 0
+
+
+def run(repeat):
+    results = []
+    for name, arguments, first_output in ENTRY_POINTS:
+        times = []
+        worked = True
+        for attempt in range(repeat):
+            elapsed, ok = run_once(arguments, first_output)
+            times.append(elapsed)
+            worked = worked and ok
+        results.append({'entry_point': name, 'first': times[0],
+                        'best': min(times),
+                        'median': sorted(times)[len(times) // 2],
+                        'ok': worked})
+    return results
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    results = run(int(arguments['--repeat']))
+    print("{:<20} {:>8} {:>8} {:>8}".format('entry point', 'first', 'best',
+                                            'median'))
+    for result in results:
+        print("{:<20} {:>8.3f} {:>8.3f} {:>8.3f}{}".format(
+            result['entry_point'], result['first'], result['best'],
+            result['median'], '' if result['ok'] else '  (failed)'))
+    if arguments['--save'] != 'None':
+        with open(arguments['--save'], 'w') as save_file:
+            json.dump({'python': sys.version, 'time': time.time(),
+                       'results': results}, save_file, indent=2)
@@ -0,0 +1,304 @@
+"""suite.py
+
+Speed and accuracy of each audio processor, on audio where the right answer
+is known. Signals come from soundtomidi/signals.py: click tracks at known
+BPMs, pure tones at known MIDI notes, a swept sine, and noise in one
+third-octave band at a time. Each audio processor gets the signals it has an
+answer for, and then the whole ProcessAudio pipeline (audio processors,
+FeatureBus, MIDI encoding and scheduling) gets clicks over a swept sine,
+straight into the callback with no sound card.
+
+For each it reports:
+
+    hops/s      analyses per second of processing time
+    realtime    seconds of audio handled per second of processing time
+    peak KB     most memory allocated at once while running (Python 3)
+    blocks      allocated memory blocks left over afterwards (Python 3)
+    accuracy    0.0-1.0, see below
+
+Accuracy is how close the BPM is for tempo, the F-measure of beats against
+clicks, how many pitches are the right note (and within a semitone along the
+sweep), how close RMS is to the known RMS of a tone, and how often the
+loudest frequency band is the one the noise was in.
+
+Save the results and compare them after a change:
+
+    python benchmarks/suite.py --save before.json
+    python benchmarks/suite.py --compare before.json
+
+Or compare aubio's filter bank with the octave pyramid:
+
+    python benchmarks/suite.py --save aubio.json
+    python benchmarks/suite.py --falg pyramid --compare aubio.json
+
+Usage:
+  suite.py [options]
+
+Options:
+  -h --help                     Show this screen.
+  --framesize=FRAMESIZE         Size of each block handed to the callback.
+                                [default: 512]
+  --seconds=SECONDS             Length of each signal, in seconds.
+                                [default: 8]
+  --falg=FALG                   Algorithm for the frequencies, "default" or
+                                "pyramid".
+                                [default: default]
+  --save=FILE                   Save the results as JSON to FILE.
+                                [default: None]
+  --compare=FILE                Show the change from results saved in FILE.
+                                [default: None]
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import subprocess
+import sys
+import time
+from docopt import docopt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIRECTORY = os.path.join(os.path.dirname(HERE), 'soundtomidi')
+sys.path.insert(0, MODULE_DIRECTORY)
+import numpy as np
+import soundtomidi
+import signals
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+CLICK_BPMS = (90, 120, 140)
+NOTES = (40, 45, 52, 57, 64, 69, 76, 81, 88)
+MISSING_INIFILE = os.path.join(HERE, 'no-such-file.ini')
+
+
+def make_options(framesize, falg='default'):
+    # aubio wants exactly one hop per call these days, hence the hop
+    # multipliers. MIDI goes nowhere; it's still built and scheduled.
+    return soundtomidi.Options(['--inifile', MISSING_INIFILE,
+                                '--inputdevice', '0', '--midiout', 'False',
+                                '--outbaud', '0', '--framesize',
+                                str(framesize), '--thopmult', '1',
+                                '--phopmult', '1', '--falg', falg])
+
+
+def measure_memory(run):
+    # Run it again under tracemalloc, which is too slow to time with.
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    run()
+    blocks_after = sys.getallocatedblocks()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024, blocks_after - blocks_before
+
+
+class Suite:
+    """Runs every benchmark and keeps the results by name."""
+
+    def __init__(self, framesize, seconds, falg='default'):
+        self.options = make_options(framesize, falg)
+        self.tuner = soundtomidi.AutoTuner(self.options)
+        self.samplerate = self.options.config.samplerate
+        self.seconds = seconds
+        self.results = {}
+
+    def window(self, feature):
+        return getattr(self.options.config, feature[0] + 'window')
+
+    def run_feature(self, name, feature, tests):
+        # tests is a list of (samples, score). score is handed the events
+        # and returns 0.0-1.0.
+        elapsed = 0.0
+        audio_seconds = 0.0
+        hops = 0
+        scores = []
+        for samples, score in tests:
+            events, seconds = self.tuner.run_finder(feature, self.options,
+                                                    samples)
+            elapsed += seconds
+            audio_seconds += len(samples) / self.samplerate
+            hops += len(samples) // self.window(feature)
+            scores.append(score(events))
+
+        def run_all():
+            for samples, score in tests:
+                self.tuner.run_finder(feature, self.options, samples)
+
+        peak, blocks = measure_memory(run_all)
+        self.results[name] = {'hops_per_second': hops / elapsed,
+                              'realtime': audio_seconds / elapsed,
+                              'peak_kb': peak, 'blocks': blocks,
+                              'accuracy': sum(scores) / len(scores)}
+
+    def tempo(self):
+        tests = []
+        for bpm in CLICK_BPMS:
+            samples, click_times = signals.click_track(bpm, self.seconds,
+                                                       self.samplerate)
+            tests.append((samples, self.scorer(self.tuner.score_tempo,
+                                               click_times, 'tempo')))
+        self.run_feature('tempo', 'tempo', tests)
+
+    def beats(self):
+        tests = []
+        for bpm in CLICK_BPMS:
+            samples, click_times = signals.click_track(bpm, self.seconds,
+                                                       self.samplerate)
+            tests.append((samples, self.scorer(self.tuner.score_beats,
+                                               click_times, 'beats')))
+        self.run_feature('beats', 'beats', tests)
+
+    def scorer(self, score, answer, feature):
+        window = self.window(feature)
+        return lambda events: score(events, answer, window)
+
+    def rms(self):
+        tests = []
+        for level in (.1, .5, .9):
+            samples = signals.tone(440, self.seconds, self.samplerate, level)
+            tests.append((samples, self.rms_scorer(level / 2 ** .5)))
+        self.run_feature('rms', 'rms', tests)
+
+    @staticmethod
+    def rms_scorer(expected):
+        def score(events):
+            values = [event.rms for event in events
+                      if isinstance(event, soundtomidi.RMSEvent)]
+            if not values:
+                return 0.0
+            return max(0.0, 1.0 - abs(np.mean(values) - expected) / expected)
+        return score
+
+    def frequencies(self):
+        tests = []
+        bands = self.options.config.fbuckets
+        for index, (low, high) in enumerate(signals.band_edges(bands)):
+            if high >= self.samplerate / 2:
+                break
+            samples = signals.band_noise(low, high, self.seconds / 4,
+                                         self.samplerate)
+            tests.append((samples, self.band_scorer(index)))
+        self.run_feature('frequencies', 'frequencies', tests)
+
+    @staticmethod
+    def band_scorer(index):
+        def score(events):
+            energies = [event.energies for event in events
+                        if isinstance(event, soundtomidi.FrequenciesEvent)]
+            if not energies:
+                return 0.0
+            return float(np.argmax(np.mean(energies, axis=0)) == index)
+        return score
+
+    def pitch(self):
+        samples, answers = signals.tones(NOTES, self.seconds / len(NOTES),
+                                         self.samplerate)
+        tests = [(samples, self.scorer(self.tuner.score_pitch, answers,
+                                       'pitch'))]
+        samples, frequency_at = signals.swept_sine(
+            signals.note_frequency(NOTES[0]),
+            signals.note_frequency(NOTES[-1]), self.seconds, self.samplerate)
+        tests.append((samples, self.sweep_scorer(frequency_at)))
+        self.run_feature('pitch', 'pitch', tests)
+
+    def sweep_scorer(self, frequency_at):
+        half_window = self.window('pitch') / self.samplerate / 2
+
+        def score(events):
+            right = 0
+            pitches = [event for event in events
+                       if isinstance(event, soundtomidi.PitchEvent)]
+            for event in pitches:
+                frequency = frequency_at(event.time - half_window)
+                note = 69 + 12 * np.log2(frequency / 440.0)
+                if abs(event.pitch - note) <= 1:
+                    right += 1
+            return right / max(len(pitches), 1)
+        return score
+
+    def pipeline(self):
+        clicks, click_times = signals.click_track(120, self.seconds,
+                                                  self.samplerate)
+        sweep, frequency_at = signals.swept_sine(55, 1760, self.seconds,
+                                                 self.samplerate, .3)
+        samples = (clicks + sweep).reshape(-1, 1)
+        blocksize = self.options.config.framesize
+
+        def run_all():
+            process_audio = soundtomidi.ProcessAudio(self.options)
+            started = time.time()
+            for start in range(0, len(samples) - blocksize + 1, blocksize):
+                process_audio.callback(samples[start:start + blocksize],
+                                       blocksize, None, None)
+            return time.time() - started, process_audio
+
+        elapsed, process_audio = run_all()
+        stats = process_audio.midi_processor.stats()
+        peak, blocks = measure_memory(run_all)
+        self.results['pipeline'] = {
+            'hops_per_second': (len(samples) // blocksize) / elapsed,
+            'realtime': len(samples) / self.samplerate / elapsed,
+            'peak_kb': peak, 'blocks': blocks,
+            'accuracy': None, 'midi_messages': stats['sent']}
+
+    def run(self):
+        for benchmark in (self.tempo, self.beats, self.rms, self.frequencies,
+                          self.pitch, self.pipeline):
+            benchmark()
+        return self.results
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def show(results, previous=None):
+    columns = ('hops_per_second', 'realtime', 'peak_kb', 'blocks',
+               'accuracy')
+    row = "{:<12}" + " {:>15}" * len(columns)
+    print(row.format('', 'hops/s', 'realtime', 'peak KB', 'blocks',
+                     'accuracy'))
+    for name in ('tempo', 'beats', 'rms', 'frequencies', 'pitch', 'pipeline'):
+        cells = []
+        for column in columns:
+            value = results[name][column]
+            cell = '-' if value is None else '{:.2f}'.format(value)
+            if previous and previous.get(name, {}).get(column) and value:
+                change = value / previous[name][column] - 1
+                cell += ' {:+.0%}'.format(change)
+            cells.append(cell)
+        print(row.format(name, *cells))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    suite = Suite(int(arguments['--framesize']),
+                  float(arguments['--seconds']), arguments['--falg'])
+    results = suite.run()
+    previous = None
+    if arguments['--compare'] != 'None':
+        with open(arguments['--compare']) as compare_file:
+            saved = json.load(compare_file)
+        previous = saved['results']
+        print("Compared with", saved['commit'], "from",
+              time.ctime(saved['time']))
+    show(results, previous)
+    if arguments['--save'] != 'None':
+        with open(arguments['--save'], 'w') as save_file:
+            json.dump({'commit': commit(), 'time': time.time(),
+                       'python': sys.version,
+                       'framesize': int(arguments['--framesize']),
+                       'seconds': float(arguments['--seconds']),
+                       'falg': arguments['--falg'],
+                       'results': results}, save_file, indent=2)
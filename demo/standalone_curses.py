@@ -64,6 +64,10 @@ Options:
                                 [default: 21]
   --psysexnum=PSYSEXNUM         Prefix for incoming pitch sysex messages.
                                 [default: 0x09]
+  --fps=FPS                     Screen updates per second. Messages are all
+                                taken in between updates, however many there
+                                are.
+                                [default: 30]
 
 """
 
@@ -76,6 +80,7 @@ import time
 from datetime import datetime as dt
 import mido
 import curses
+from soundtomidi.decoder import Decoder
 
 
 
@@ -100,7 +105,7 @@ class Options:
 
     def __init__(self):
         self.settings = docopt(__doc__, version='Standalone Curses Demo 0.1')
-        for key, value in self.settings.items():
+        for key, value in list(self.settings.items()):
             new_key = key[2:]
             self.settings[new_key] = self.settings.pop(key)
         config = configparser.ConfigParser(allow_no_value=True)
@@ -134,6 +139,7 @@ class Options:
         config.set('settings', 'pnoteoff', self.settings['pnoteoff'])
         config.set('settings', 'pcontrolnum', self.settings['pcontrolnum'])
         config.set('settings', 'psysexnum', self.settings['psysexnum'])
+        config.set('settings', 'fps', self.settings['fps'])
 
         if os.path.exists(self.settings['inifile']):
             os.rename(self.settings['inifile'],
@@ -142,31 +148,61 @@ class Options:
             config.write(configfile)
 
 
+class Status:
+    def __init__(self):
+        self.window = curses.newwin(1, 79, 0, 1)
+        self.messages_per_second = 0.0
+        self.frames_per_second = 0.0
+        self.dirty = True
+
+    def set_rates(self, messages_per_second, frames_per_second):
+        self.messages_per_second = messages_per_second
+        self.frames_per_second = frames_per_second
+        self.dirty = True
+
+    def draw(self):
+        if not self.dirty:
+            return
+        self.window.addstr(0, 0, "{:8.1f} messages/s {:5.1f} frames/s".format(
+            self.messages_per_second, self.frames_per_second))
+        self.window.noutrefresh()
+        self.dirty = False
+
+
 class BPM:
     def __init__(self):
         curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_CYAN)
         self.control_window = curses.newwin(3, 19, 10, 60)
         self.control_window.bkgd(' ', curses.color_pair(1))
         self.control_window.addstr(0, 0, "BPM (control msg)".center(19),curses.A_REVERSE)
-        self.control_window.refresh()
+        self.control_window.noutrefresh()
         self.sysex_window = curses.newwin(3, 19, 13, 60)
         self.sysex_window.bkgd(' ', curses.color_pair(1))
         self.sysex_window.addstr(0, 0, "BPM (sysex msg)".center(19),curses.A_REVERSE)
-        self.sysex_window.refresh()
+        self.sysex_window.noutrefresh()
 
         self.control_bpm = 0
         self.sysex_bpm = 0.0
+        self.control_dirty = False
+        self.sysex_dirty = False
 
     def set_control_bpm(self, bpm):
-        self.control_bpm = bpm + 60
-        self.control_window.addstr(1, 0, str(self.control_bpm).center(19))
-        self.control_window.refresh()
+        self.control_bpm = bpm
+        self.control_dirty = True
 
-    def set_sysex_bpm_two_bytes(self, two_byte_array):
-        self.sysex_bpm = round(
-            ((two_byte_array[0] * 128) + two_byte_array[1]) / 10.0, 1)
-        self.sysex_window.addstr(1, 0, str(self.sysex_bpm).center(19))
-        self.sysex_window.refresh()
+    def set_sysex_bpm(self, bpm):
+        self.sysex_bpm = round(bpm, 1)
+        self.sysex_dirty = True
+
+    def draw(self):
+        if self.control_dirty:
+            self.control_window.addstr(1, 0, str(self.control_bpm).center(19))
+            self.control_window.noutrefresh()
+            self.control_dirty = False
+        if self.sysex_dirty:
+            self.sysex_window.addstr(1, 0, str(self.sysex_bpm).center(19))
+            self.sysex_window.noutrefresh()
+            self.sysex_dirty = False
 
 
 class Beat:
@@ -175,26 +211,36 @@ class Beat:
         self.control_window = curses.newwin(3, 19, 17, 60)
         self.control_window.bkgd(' ', curses.color_pair(2))
         self.control_window.addstr(0, 0, "Beat (control msg)".center(19),curses.A_REVERSE)
-        self.control_window.refresh()
+        self.control_window.noutrefresh()
         self.sysex_window = curses.newwin(3, 19, 20, 60)
         self.sysex_window.bkgd(' ', curses.color_pair(2))
         self.sysex_window.addstr(0, 0, "Beat (sysex msg)".center(19),curses.A_REVERSE)
-        self.sysex_window.refresh()
+        self.sysex_window.noutrefresh()
 
         self.control_beat_location = 0
         self.sysex_beat_location = 0
+        self.control_dirty = False
+        self.sysex_dirty = False
 
     def set_control_beat(self, beat_location):
         self.control_beat_location = beat_location
-        self.control_window.addstr(1, 0,
-                                   str(self.control_beat_location).center(19))
-        self.control_window.refresh()
+        self.control_dirty = True
+
+    def set_sysex_beat(self, beat_location):
+        self.sysex_beat_location = beat_location
+        self.sysex_dirty = True
 
-    def set_sysex_beat(self, beat_location_array):
-        self.sysex_beat_location = beat_location_array[0]
-        self.sysex_window.addstr(1, 0,
-                                 str(self.sysex_beat_location).center(19))
-        self.sysex_window.refresh()
+    def draw(self):
+        if self.control_dirty:
+            self.control_window.addstr(
+                1, 0, str(self.control_beat_location).center(19))
+            self.control_window.noutrefresh()
+            self.control_dirty = False
+        if self.sysex_dirty:
+            self.sysex_window.addstr(
+                1, 0, str(self.sysex_beat_location).center(19))
+            self.sysex_window.noutrefresh()
+            self.sysex_dirty = False
 
 
 class RMS:
@@ -203,28 +249,38 @@ class RMS:
         self.control_window = curses.newwin(4, 19, 1, 60)
         self.control_window.bkgd(' ', curses.color_pair(3))
         self.control_window.addstr(0, 0, "RMS (control msg)".center(19),curses.A_REVERSE)
-        self.control_window.refresh()
+        self.control_window.noutrefresh()
         self.sysex_window = curses.newwin(4, 19, 5, 60)
         self.sysex_window.bkgd(' ', curses.color_pair(3))
         self.sysex_window.addstr(0, 0, "RMS (sysex msg)".center(19),curses.A_REVERSE)
-        self.sysex_window.refresh()
+        self.sysex_window.noutrefresh()
         self.segments = 19.0 / 127.0
         self.control_rms = 0
         self.sysex_rms = 0
+        self.control_dirty = False
+        self.sysex_dirty = False
 
     def set_control_rms(self, rms):
         self.control_rms = rms
-        rms_string = "*" * (int(self.control_rms*self.segments))
-        self.control_window.addstr(1, 0, rms_string.center(19))
-        self.control_window.addstr(2, 0, str(self.control_rms).center(19))
-        self.control_window.refresh()
+        self.control_dirty = True
+
+    def set_sysex_rms(self, rms):
+        self.sysex_rms = rms
+        self.sysex_dirty = True
 
-    def set_sysex_rms(self, rms_array):
-        self.sysex_rms = rms_array[0]
-        rms_string = "*" * (int(self.sysex_rms*self.segments))
-        self.sysex_window.addstr(1, 0, rms_string.center(19))
-        self.sysex_window.addstr(2, 0, str(self.sysex_rms).center(19))
-        self.sysex_window.refresh()
+    def draw_rms(self, window, rms):
+        rms_string = "*" * (int(rms * self.segments))
+        window.addstr(1, 0, rms_string.center(19))
+        window.addstr(2, 0, str(rms).center(19))
+        window.noutrefresh()
+
+    def draw(self):
+        if self.control_dirty:
+            self.draw_rms(self.control_window, self.control_rms)
+            self.control_dirty = False
+        if self.sysex_dirty:
+            self.draw_rms(self.sysex_window, self.sysex_rms)
+            self.sysex_dirty = False
 
 
 class Frequencies:
@@ -233,21 +289,65 @@ class Frequencies:
         self.sysex_window = curses.newwin(8, 57, 1, 1)
         self.sysex_window.bkgd(' ', curses.color_pair(4))
         self.sysex_window.addstr(0, 0, "Frequencies (sysex msg)".center(57),curses.A_REVERSE)
-        self.sysex_window.refresh()
+        self.sysex_window.noutrefresh()
         self.segments = 127.0 / 7.0
-        self.frequencies = []
+        self.frequencies = ()
+        # Height of the bar in each column as it is on screen, so only the
+        # cells that changed get written.
+        self.drawn_heights = {}
+        self.dirty = False
 
     def set_sysex_frequencies(self, frequency_array):
         self.frequencies = frequency_array
+        self.dirty = True
+
+    def draw(self):
+        if not self.dirty:
+            return
         column = int((57 - len(self.frequencies)) / 2)
+        heights = {}
         for value in self.frequencies:
-            for x in range(7):
-                if value >= self.segments * x:
-                    self.sysex_window.addstr(7 - x, column, "*")
-                else:
-                    self.sysex_window.addstr(7 - x, column, " ")
+            heights[column] = sum(1 for x in range(7)
+                                  if value >= self.segments * x)
             column += 1
-        self.sysex_window.refresh()
+        if set(heights) != set(self.drawn_heights):
+            # The number of bands changed. Start over.
+            for row in range(1, 8):
+                self.sysex_window.addstr(row, 0, " " * 56)
+            self.drawn_heights = {}
+        for column, height in heights.items():
+            drawn_height = self.drawn_heights.get(column, 0)
+            for x in range(min(height, drawn_height), max(height,
+                                                          drawn_height)):
+                self.sysex_window.addstr(7 - x, column,
+                                         "*" if x < height else " ")
+        self.drawn_heights = heights
+        self.sysex_window.noutrefresh()
+        self.dirty = False
+
+
+class PitchGrid:
+    """One of the pitch windows. Octaves across, notes up the side."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lit = set()
+        self.drawn = set()
+
+    @staticmethod
+    def cell(pitch):
+        octave = int(pitch / 12)
+        return 12 - (pitch - 12 * octave), octave
+
+    def draw(self):
+        if self.lit == self.drawn:
+            return
+        for row, column in self.drawn - self.lit:
+            self.window.addstr(row, column, " ")
+        for row, column in self.lit - self.drawn:
+            self.window.addstr(row, column, "*")
+        self.drawn = set(self.lit)
+        self.window.noutrefresh()
 
 
 class Pitch:
@@ -256,15 +356,15 @@ class Pitch:
         self.note_window = curses.newwin(13, 15, 10, 1)
         self.note_window.bkgd(' ', curses.color_pair(5))
         self.note_window.addstr(0, 0, "Pitch (n)".center(15),curses.A_REVERSE)
-        self.note_window.refresh()
+        self.note_window.noutrefresh()
         self.control_window = curses.newwin(13, 15, 10, 22)
         self.control_window.bkgd(' ', curses.color_pair(5))
         self.control_window.addstr(0, 0, "Pitch (c)".center(15),curses.A_REVERSE)
-        self.control_window.refresh()
+        self.control_window.noutrefresh()
         self.sysex_window = curses.newwin(13, 15, 10, 43)
         self.sysex_window.bkgd(' ', curses.color_pair(5))
         self.sysex_window.addstr(0, 0, "Pitch (s)".center(15),curses.A_REVERSE)
-        self.sysex_window.refresh()
+        self.sysex_window.noutrefresh()
         self.margin_window1 = curses.newwin(14, 2, 10, 18)
         self.margin_window1.addstr(1, 0, "B ")
         self.margin_window1.addstr(2, 0, "A#")
@@ -278,7 +378,7 @@ class Pitch:
         self.margin_window1.addstr(10, 0, "D ")
         self.margin_window1.addstr(11, 0, "C#")
         self.margin_window1.addstr(12, 0, "C ")
-        self.margin_window1.refresh()
+        self.margin_window1.noutrefresh()
         self.margin_window2 = curses.newwin(14, 2, 10, 39)
         self.margin_window2.addstr(1, 0, "B ")
         self.margin_window2.addstr(2, 0, "A#")
@@ -292,54 +392,27 @@ class Pitch:
         self.margin_window2.addstr(10, 0, "D ")
         self.margin_window2.addstr(11, 0, "C#")
         self.margin_window2.addstr(12, 0, "C ")
-        self.margin_window2.refresh()
-        self.pitch_note = 0
-        self.last_pitch_note = 0
-        self.pitch_control = 0
-        self.last_pitch_control = 0
-        self.pitch_sysex = 0
-        self.last_pitch_sysex = 0
+        self.margin_window2.noutrefresh()
+        self.note_grid = PitchGrid(self.note_window)
+        self.control_grid = PitchGrid(self.control_window)
+        self.sysex_grid = PitchGrid(self.sysex_window)
 
     def set_note_pitch(self, pitch):
-        self.pitch_note = pitch
-        pitch_note_octave = int(self.pitch_note / 12)
-        pitch_note_note = self.pitch_note - (12 * pitch_note_octave)
-        self.note_window.addstr(12 - pitch_note_note, pitch_note_octave, "*")
-        self.note_window.refresh()
+        self.note_grid.lit.add(PitchGrid.cell(pitch))
 
     def set_last_note_pitch(self, last_pitch):
-        self.last_pitch_note = last_pitch
-        pitch_note_octave = int(self.last_pitch_note / 12)
-        pitch_note_note = self.last_pitch_note - (12 * pitch_note_octave)
-        self.note_window.addstr(12 - pitch_note_note, pitch_note_octave, " ")
-        self.note_window.refresh()
+        self.note_grid.lit.discard(PitchGrid.cell(last_pitch))
 
     def set_control_pitch(self, pitch):
-        self.last_pitch_control = self.pitch_control
-        self.pitch_control = pitch
-        pitch_control_octave = int(self.pitch_control / 12)
-        pitch_control_note = self.pitch_control - (12 * pitch_control_octave)
-        self.control_window.addstr(12 - pitch_control_note, pitch_control_octave,
-                                "*")
-        last_pitch_control_octave = int(self.last_pitch_control / 12)
-        last_pitch_control_note = self.last_pitch_control - (
-        12 * last_pitch_control_octave)
-        self.control_window.addstr(12 - last_pitch_control_note,
-                                last_pitch_control_octave, " ")
-        self.control_window.refresh()
-
-    def set_sysex_pitch(self, pitch_array):
-        self.last_pitch_sysex = self.pitch_sysex
-        self.pitch_sysex = pitch_array[0]
-        pitch_sysex_octave = int(self.pitch_sysex / 12)
-        pitch_sysex_note = self.pitch_sysex - (12 * pitch_sysex_octave)
-        self.sysex_window.addstr(12 - pitch_sysex_note, pitch_sysex_octave, "*")
-        last_pitch_sysex_octave = int(self.last_pitch_sysex / 12)
-        last_pitch_sysex_note = self.last_pitch_sysex - (
-            12 * last_pitch_sysex_octave)
-        self.sysex_window.addstr(12 - last_pitch_sysex_note,
-                                last_pitch_sysex_octave, " ")
-        self.sysex_window.refresh()
+        self.control_grid.lit = set([PitchGrid.cell(pitch)])
+
+    def set_sysex_pitch(self, pitch):
+        self.sysex_grid.lit = set([PitchGrid.cell(pitch)])
+
+    def draw(self):
+        self.note_grid.draw()
+        self.control_grid.draw()
+        self.sysex_grid.draw()
 
 
 class MidiReceiver:
@@ -356,91 +429,101 @@ class MidiReceiver:
         else:
             self.midi_inport = options.settings['inport']
 
-        self.sysex_prefix = []
-        for manf_byte in options.settings['sysexmanf'].split(' '):
-            self.sysex_prefix.append(int(manf_byte, 0))
-        for channel in options.settings['inchannel'].split(' '):
-            self.sysex_prefix.append(int(channel, 0) - 1)
-        self.channel = int(options.settings['inchannel']) - 1
-
-        try:
-            self.bcontrolnum = int(options.settings['bcontrolnum'], 0)
-        except ValueError:
-            self.bcontrolnum = -1
-        try:
-            self.tcontrolnum = int(options.settings['tcontrolnum'], 0)
-        except ValueError:
-            self.tcontrolnum = -1
-        try:
-            self.rcontrolnum = int(options.settings['rcontrolnum'], 0)
-        except ValueError:
-            self.rcontrolnum = -1
-        try:
-            self.pcontrolnum = int(options.settings['pcontrolnum'], 0)
-        except ValueError:
-            self.pcontrolnum = -1
-
-        try:
-            self.bsysexnum = int(options.settings['bsysexnum'], 0)
-        except ValueError:
-            self.bsysexnum = -1
-        try:
-            self.tsysexnum = int(options.settings['tsysexnum'], 0)
-        except ValueError:
-            self.tsysexnum = -1
-        try:
-            self.rsysexnum = int(options.settings['rsysexnum'], 0)
-        except ValueError:
-            self.rsysexnum = -1
-        try:
-            self.fsysexnum = int(options.settings['fsysexnum'], 0)
-        except ValueError:
-            self.fsysexnum = -1
-        try:
-            self.psysexnum = int(options.settings['psysexnum'], 0)
-        except ValueError:
-            self.psysexnum = -1
-
+        # The decoder works out which message is which, and the handlers
+        # say which display each one goes to.
+        self.decoder = Decoder(
+            sysex_manufacturer=self.numbers(options.settings['sysexmanf']),
+            channels=(int(options.settings['inchannel']) - 1,),
+            controls={'tempo': self.number(options.settings['tcontrolnum']),
+                      'beats': self.number(options.settings['bcontrolnum']),
+                      'rms': self.number(options.settings['rcontrolnum']),
+                      'pitch': self.number(options.settings['pcontrolnum'])},
+            sysex_commands={
+                'tempo': self.numbers(options.settings['tsysexnum']),
+                'beats': self.numbers(options.settings['bsysexnum']),
+                'rms': self.numbers(options.settings['rsysexnum']),
+                'frequencies': self.numbers(options.settings['fsysexnum']),
+                'pitch': self.numbers(options.settings['psysexnum'])},
+            tempo_control_type=options.settings['tcontroltype'],
+            tempo_sysex_type=options.settings['tsysextype'])
+
+        self.fps = float(options.settings['fps'])
+        self.status = Status()
         self.bpm = BPM()
         self.beat = Beat()
         self.rms = RMS()
         self.frequencies = Frequencies()
         self.pitch = Pitch()
+        self.handlers = {
+            ('tempo', 'control'): self.bpm.set_control_bpm,
+            ('tempo', 'sysex'): self.bpm.set_sysex_bpm,
+            ('beats', 'control'): self.beat.set_control_beat,
+            ('beats', 'sysex'): self.beat.set_sysex_beat,
+            ('rms', 'control'): self.rms.set_control_rms,
+            ('rms', 'sysex'): self.rms.set_sysex_rms,
+            ('frequencies', 'sysex'): self.frequencies.set_sysex_frequencies,
+            ('pitch', 'control'): self.pitch.set_control_pitch,
+            ('pitch', 'sysex'): self.pitch.set_sysex_pitch,
+            ('pitch', 'note_on'): self.pitch.set_note_pitch,
+            ('pitch', 'note_off'): self.pitch.set_last_note_pitch}
+        curses.doupdate()
+
+    @staticmethod
+    def number(setting):
+        try:
+            return int(setting, 0)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def numbers(setting):
+        try:
+            return tuple(int(number, 0) for number in setting.split(' '))
+        except ValueError:
+            return None
 
     def start(self):
-        if self.midi_inport:
-            with mido.open_input(self.midi_inport) as input:
-                for message in input:
-                    if message.type == 'control_change':
-                        if message.channel == self.channel:
-                            if message.control == self.bcontrolnum:
-                                self.beat.set_control_beat(message.value)
-                            elif message.control == self.tcontrolnum:
-                                self.bpm.set_control_bpm(message.value)
-                            elif message.control == self.rcontrolnum:
-                                self.rms.set_control_rms(message.value)
-                            elif message.control == self.pcontrolnum:
-                                self.pitch.set_control_pitch(message.value)
-                    elif message.type == 'sysex':
-                        prefix = list(message.data[0:len(self.sysex_prefix)])
-                        command = message.data[len(self.sysex_prefix)]
-                        data = list(message.data[len(self.sysex_prefix) + 1:])
-                        if cmp(prefix, self.sysex_prefix) == 0:
-                            if command == self.bsysexnum:
-                                self.beat.set_sysex_beat(data)
-                            elif command == self.tsysexnum:
-                                self.bpm.set_sysex_bpm_two_bytes(data)
-                            elif command == self.rsysexnum:
-                                self.rms.set_sysex_rms(data)
-                            elif command == self.fsysexnum:
-                                self.frequencies.set_sysex_frequencies(data)
-                            elif command == self.psysexnum:
-                                self.pitch.set_sysex_pitch(data)
-                    elif message.channel == self.channel:
-                        if message.type == 'note_on':
-                            self.pitch.set_note_pitch(message.note)
-                        elif message.type == 'note_off':
-                            self.pitch.set_last_note_pitch(message.note)
+        # Messages only change what the displays hold. The screen is drawn
+        # fps times a second, and only the parts that changed, so a flood of
+        # messages can't make this fall behind.
+        if not self.midi_inport:
+            return
+        displays = (self.status, self.bpm, self.beat, self.rms,
+                    self.frequencies, self.pitch)
+        frame_seconds = 1.0 / self.fps
+        with mido.open_input(self.midi_inport) as input:
+            next_frame = time.time()
+            rate_start = next_frame
+            message_count = 0
+            frame_count = 0
+            while True:
+                wait = next_frame - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                next_frame += frame_seconds
+                messages = [message.bin() for message in input.iter_pending()]
+                self.handle_messages(messages)
+                message_count += len(messages)
+                now = time.time()
+                if next_frame < now:
+                    next_frame = now + frame_seconds
+                frame_count += 1
+                if now - rate_start >= 1:
+                    self.status.set_rates(message_count / (now - rate_start),
+                                          frame_count / (now - rate_start))
+                    rate_start = now
+                    message_count = 0
+                    frame_count = 0
+                for display in displays:
+                    display.draw()
+                curses.doupdate()
+
+    def handle_messages(self, messages):
+        handlers = self.handlers
+        for feature, source, value in self.decoder.decode_many(messages):
+            handler = handlers.get((feature, source))
+            if handler:
+                handler(value)
 
 
 def main(screen):
@@ -1 +1 @@
-from soundtomidi import *
\ No newline at end of file
+from .soundtomidi import *
@@ -0,0 +1,222 @@
+"""batch.py
+
+Runs the audio processors over audio files instead of a sound card, and keeps
+everything they find. Handy for going through a whole playlist ahead of a
+show to program cues against.
+
+Each file is read a block (framesize samples) at a time with aubio, mixed
+down to mono and resampled to samplerate, so no file is ever loaded whole.
+Files are handed out one at a time to a pool of processes, one per core
+unless told otherwise, and every process writes its own results, so it
+scales with the cores. The settings come from the ini file, same as
+soundtomidi.py (only the audio processor ones matter here).
+
+For each file there's a NumPy .npz in outdir with one array per field of
+each event, named feature_field, in the order they were found:
+
+    tempo_time, tempo_bpm, tempo_average_bpm, tempo_steady_bpm
+    beats_time, beats_position, beats_value
+    rms_time, rms_rms, rms_level
+    frequencies_time, frequencies_energies, frequencies_levels (one row per
+        event, one column per band)
+    pitch_time, pitch_pitch, pitch_confidence
+    notes_time, notes_note, notes_previous_note
+
+Times are seconds from the start of the file. manifest.json in outdir lists
+every file, where its results went, how long it was, how many of each event
+it got, and the settings used. Files that couldn't be read are listed with
+the reason.
+
+From Python, analyse_files(filenames, options, outdir) does the same and
+returns the manifest, and analyse_file(filename, options) returns the arrays
+for one file without writing anything.
+
+Usage:
+  batch.py [options] <audiofile>...
+
+Options:
+  -h --help                     Show this screen.
+  --inifile=FILE                soundtomidi ini file to take the audio
+                                processor settings from.
+                                [default: soundtomidi.ini]
+  --outdir=OUTDIR               Where the .npz files and manifest.json go.
+                                [default: .]
+  --processes=PROCESSES         Files to work on at once. 0 for one per core.
+                                [default: 0]
+  --compress                    Compress the .npz files. Smaller, slower.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    from . import soundtomidi
+except (ImportError, ValueError):
+    import soundtomidi
+
+MANIFEST = 'manifest.json'
+
+# Name used in the arrays, and the event it comes from.
+EVENT_NAMES = (('tempo', soundtomidi.TempoEvent),
+               ('beats', soundtomidi.BeatEvent),
+               ('rms', soundtomidi.RMSEvent),
+               ('frequencies', soundtomidi.FrequenciesEvent),
+               ('pitch', soundtomidi.PitchEvent),
+               ('notes', soundtomidi.NoteEvent))
+
+
+def analyse_file(filename, options):
+    """Returns a dictionary of arrays (see above) and the seconds of audio."""
+    np = soundtomidi.np
+    config = options.config
+    events = []
+    feature_bus = soundtomidi.FeatureBus()
+    feature_bus.subscribe(events.append)
+    finders = []
+    for feature, attribute, finder_class in \
+            soundtomidi.ProcessAudio.finder_classes:
+        if getattr(config, soundtomidi.LIVE_OPTIONS[feature][0]):
+            finder = finder_class(options)
+            finder.feature_bus = feature_bus
+            finders.append(finder)
+    framesize = config.framesize
+    source = soundtomidi.aubio.source(filename, config.samplerate, framesize)
+    frames_read = 0
+    try:
+        while True:
+            samples, read = source()
+            if not read:
+                break
+            # The last block is padded out with silence.
+            frames_read += read
+            feature_bus.stream_time = frames_read / config.samplerate
+            if samples.any():
+                for finder in finders:
+                    finder.add_frame(samples)
+            if read < framesize:
+                break
+    finally:
+        source.close()
+    fields = {}
+    for name, event_class in EVENT_NAMES:
+        for field in event_class._fields:
+            if field != 'input_index':
+                fields[name + '_' + field] = []
+    event_names = dict((event_class, name)
+                       for name, event_class in EVENT_NAMES)
+    for event in events:
+        name = event_names.get(type(event))
+        if name is None:
+            continue
+        # input_index is left off the end; there's only ever the one file.
+        for field, value in zip(event._fields[:-1], event):
+            fields[name + '_' + field].append(value)
+    arrays = {}
+    for key, values in fields.items():
+        if key == 'frequencies_time' or not key.startswith('frequencies'):
+            arrays[key] = np.array(values, dtype=np.float64)
+        elif values:
+            arrays[key] = np.array(values, dtype=np.float32)
+        else:
+            arrays[key] = np.zeros((0, config.fbands), dtype=np.float32)
+    return arrays, frames_read / config.samplerate
+
+
+def analyse_to_file(job):
+    # One file, in a pool process. Returns its manifest entry.
+    filename, output_name, options, outdir, compress = job
+    started = time.time()
+    entry = {'source': filename}
+    try:
+        arrays, seconds = analyse_file(filename, options)
+        if compress:
+            soundtomidi.np.savez_compressed(
+                os.path.join(outdir, output_name), **arrays)
+        else:
+            soundtomidi.np.savez(os.path.join(outdir, output_name), **arrays)
+    except (IOError, OSError, RuntimeError, ValueError) as error:
+        entry['error'] = str(error)
+        return entry
+    entry['features'] = output_name
+    entry['seconds'] = seconds
+    entry['counts'] = dict((name, len(arrays[name + '_time']))
+                           for name, event_class in EVENT_NAMES)
+    entry['elapsed'] = time.time() - started
+    return entry
+
+
+def output_names(filenames):
+    # name.npz for name.wav, with -2, -3... when names repeat.
+    names = []
+    used = set()
+    for filename in filenames:
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        name = stem + '.npz'
+        number = 1
+        while name in used:
+            number += 1
+            name = stem + '-' + str(number) + '.npz'
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def analyse_files(filenames, options, outdir='.', processes=None,
+                  compress=False):
+    """Analyses every file, writes the .npz files and manifest.json to
+    outdir, and returns the manifest. processes=None is one per core."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = [(filename, output_name, options, outdir, compress)
+            for filename, output_name in
+            zip(filenames, output_names(filenames))]
+    started = time.time()
+    if processes == 1:
+        entries = [analyse_to_file(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            # One file per task, so a long track doesn't hold up a queue of
+            # short ones behind it.
+            entries = list(pool.imap(analyse_to_file, jobs, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    manifest = {'version': 1,
+                'settings': options.settings,
+                'elapsed': time.time() - started,
+                'tracks': entries}
+    with open(os.path.join(outdir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    arguments = docopt(__doc__)
+    try:
+        batch_options = soundtomidi.Options(
+            ['--inifile', arguments['--inifile']])
+        process_count = int(arguments['--processes'])
+    except ValueError as error:
+        sys.exit(str(error))
+    batch_manifest = analyse_files(arguments['<audiofile>'], batch_options,
+                                   arguments['--outdir'],
+                                   process_count or None,
+                                   arguments['--compress'])
+    failed = 0
+    for track in batch_manifest['tracks']:
+        if 'error' in track:
+            failed += 1
+            print(track['source'] + ": " + track['error'], file=sys.stderr)
+        else:
+            print("{}: {:.1f}s of audio in {:.1f}s".format(
+                track['source'], track['seconds'], track['elapsed']))
+    print("{} files, {} failed, {:.1f}s. Manifest in {}".format(
+        len(batch_manifest['tracks']), failed, batch_manifest['elapsed'],
+        os.path.join(arguments['--outdir'], MANIFEST)))
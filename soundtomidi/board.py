@@ -0,0 +1,150 @@
+"""Shared memory feature board. Read what soundtomidi hears without MIDI.
+
+When soundtomidi is run with --boardout True, it keeps the latest value of
+every feature in a small memory-mapped file (--boardfile). Any number of
+programs on the same computer can map that file and read the current state
+straight out of memory--no MIDI port to open, no messages to decode, and no
+system calls once the file is mapped. On Linux, putting the file in /dev/shm
+keeps it off the disk entirely.
+
+The layout is fixed. A 16 byte header (magic, version, number of frequency
+bands), an 8 byte sequence number, then the body: one group of fields per
+feature, each with its own update count and the stream time (seconds of audio
+since the stream started) of its last update. All little endian.
+
+The sequence number works as a seqlock. soundtomidi bumps it to an odd number
+before it starts changing the body and to the next even number when it's
+done, once per block of audio. A reader grabs the sequence, copies the body,
+and checks the sequence again. If it was odd, or changed in the meantime, the
+copy may be half old and half new, so it just tries again. Writes are a
+single copy of a few hundred bytes, so in practice that hardly ever happens.
+
+Reading it looks like this::
+
+    from soundtomidi.board import FeatureBoardReader
+    reader = FeatureBoardReader('/dev/shm/soundtomidi.board')
+    last_sequence = 0
+    while True:
+        if reader.sequence() != last_sequence:
+            state = reader.read()
+            last_sequence = state['sequence']
+            print(state['steady_bpm'], state['beat_count'], state['levels'])
+
+This module only uses the standard library, so the programs reading the board
+don't need numpy, aubio or anything else soundtomidi uses.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import mmap
+import struct
+
+MAGIC = b'STMBOARD'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = HEADER.size
+BODY_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+
+# Each group is a feature: its struct format and the names of its fields.
+# "{bands}" is replaced by the number of frequency bands.
+GROUPS = [
+    ('block', 'dd', ('updated', 'stream_time')),
+    ('tempo', 'Qdddd', ('tempo_count', 'tempo_time', 'bpm', 'average_bpm',
+                        'steady_bpm')),
+    ('beat', 'Qdii', ('beat_count', 'beat_time', 'beat_position',
+                      'beat_value')),
+    ('rms', 'Qddd', ('rms_count', 'rms_time', 'rms', 'rms_level')),
+    ('frequencies', 'Qd{bands}d{bands}d', ('frequencies_count',
+                                           'frequencies_time', 'energies',
+                                           'levels')),
+    ('pitch', 'Qddd', ('pitch_count', 'pitch_time', 'pitch',
+                       'pitch_confidence')),
+    ('note', 'Qdii', ('note_count', 'note_time', 'note', 'previous_note')),
+]
+
+
+class BoardLayout:
+    """Works out where everything lives for a given number of bands.
+
+    Used by both the writer in soundtomidi and the reader below, so the two
+    can't disagree. Each group gets its own struct and offset into the body
+    so the writer can update one feature without touching the others, and
+    the whole body has a struct so the reader can copy it in one go.
+
+    """
+
+    def __init__(self, band_count):
+        self.band_count = band_count
+        self.group_structs = {}
+        self.group_offsets = {}
+        body_format = '<'
+        offset = 0
+        for name, group_format, fields in GROUPS:
+            group_format = group_format.format(bands=band_count)
+            group_struct = struct.Struct('<' + group_format)
+            self.group_structs[name] = group_struct
+            self.group_offsets[name] = offset
+            offset += group_struct.size
+            body_format += group_format
+        self.body_struct = struct.Struct(body_format)
+        self.body_size = offset
+        self.size = BODY_OFFSET + self.body_size
+
+    def pack_group(self, buffer, name, *values):
+        self.group_structs[name].pack_into(buffer, self.group_offsets[name],
+                                           *values)
+
+    def as_dict(self, sequence, values):
+        state = {'sequence': sequence}
+        position = 0
+        for name, group_format, fields in GROUPS:
+            for field in fields:
+                if field in ('energies', 'levels'):
+                    state[field] = values[position:position + self.band_count]
+                    position += self.band_count
+                else:
+                    state[field] = values[position]
+                    position += 1
+        return state
+
+
+class FeatureBoardReader:
+    """Reads the latest features from a board file written by soundtomidi.
+
+    Maps the file read only. sequence() is cheap enough to call in a tight
+    loop to see if anything has changed, and read() returns a consistent
+    copy of everything as a dictionary.
+
+    """
+
+    def __init__(self, filename):
+        self.board_file = open(filename, 'rb')
+        self.board = mmap.mmap(self.board_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, version, band_count = HEADER.unpack_from(self.board, 0)
+        if magic != MAGIC:
+            raise ValueError(filename + " is not a soundtomidi board file")
+        if version != VERSION:
+            raise ValueError("Board file version " + str(version) +
+                             " is not supported")
+        self.layout = BoardLayout(band_count)
+
+    def sequence(self):
+        return SEQUENCE.unpack_from(self.board, SEQUENCE_OFFSET)[0]
+
+    def read(self, attempts=1000):
+        for attempt in range(attempts):
+            before = SEQUENCE.unpack_from(self.board, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                continue
+            values = self.layout.body_struct.unpack_from(self.board,
+                                                         BODY_OFFSET)
+            if SEQUENCE.unpack_from(self.board, SEQUENCE_OFFSET)[0] == before:
+                return self.layout.as_dict(before, values)
+        raise RuntimeError("Board kept changing while being read. Is the "
+                           "writer stuck?")
+
+    def close(self):
+        self.board.close()
+        self.board_file.close()
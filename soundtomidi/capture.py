@@ -0,0 +1,136 @@
+"""Capture files. The audio exactly as ProcessAudio got it, to replay later.
+
+When soundtomidi is run with --capturefile, every block handed to
+ProcessAudio.callback is written to a file along with where it starts in the
+stream (in samples), the callback's timestamps and its status flags. Running
+again with --replayfile feeds those same blocks back in, with the same
+boundaries and, unless told otherwise, the same timing. So when beat
+tracking falls apart at a show, that exact audio can be run through any
+change to the audio processors afterwards.
+
+Writing happens on its own thread. The callback only copies the block and
+puts it on a bounded queue; if the disk falls behind and the queue fills up,
+blocks are dropped (and counted) rather than holding up the audio. A dropped
+block shows up as a jump in the sample positions.
+
+The layout is a 20 byte header (magic, version, sample rate, channels, bytes
+per sample), then one record per block: sample position, frames, status
+flags, the callback's inputBufferAdcTime and currentTime, then the samples
+as little endian 32 bit floats, channels interleaved. A file cut off by a
+crash just ends at the last whole block.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import struct
+import threading
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MAGIC = b'STMCAPT1'
+VERSION = 1
+HEADER = struct.Struct('<8sIIII')
+RECORD = struct.Struct('<QIIdd')
+SAMPLE_SIZE = 4
+
+# Same fields as the time argument sounddevice hands the callback.
+StreamTime = namedtuple('StreamTime', 'inputBufferAdcTime '
+                                      'outputBufferDacTime currentTime')
+
+# PortAudio's callback flags, as sounddevice names them.
+STATUS_FLAGS = (('input_underflow', 1), ('input_overflow', 2),
+                ('output_underflow', 4), ('output_overflow', 8),
+                ('priming_output', 16))
+
+
+def status_flags(status):
+    if not status:
+        return 0
+    if isinstance(status, int):
+        return status
+    flags = 0
+    for name, bit in STATUS_FLAGS:
+        if getattr(status, name, False):
+            flags |= bit
+    return flags
+
+
+class CaptureWriter:
+    """Writes blocks to a capture file from a background thread."""
+
+    def __init__(self, filename, samplerate, channels, queue_size):
+        self.capture_file = open(filename, 'wb')
+        self.capture_file.write(HEADER.pack(MAGIC, VERSION, samplerate,
+                                            channels, SAMPLE_SIZE))
+        self.blocks = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.writer_thread = threading.Thread(target=self.run_writer)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def write(self, position, data, time_info, status):
+        # Called from the audio thread. The copy has to happen here, since
+        # the sound card reuses its buffer.
+        record = RECORD.pack(position, len(data), status_flags(status),
+                             getattr(time_info, 'inputBufferAdcTime', 0.0),
+                             getattr(time_info, 'currentTime', 0.0))
+        try:
+            self.blocks.put_nowait(
+                record + data.astype('<f4', copy=False).tobytes())
+        except queue.Full:
+            self.dropped += 1
+
+    def run_writer(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            self.capture_file.write(block)
+            self.written += 1
+        self.capture_file.close()
+
+    def close(self):
+        self.blocks.put(None)
+        self.writer_thread.join()
+
+
+class CaptureReader:
+    """Reads back the blocks of a capture file, in order."""
+
+    def __init__(self, filename):
+        self.capture_file = open(filename, 'rb')
+        header = self.capture_file.read(HEADER.size)
+        if len(header) < HEADER.size or header[:8] != MAGIC:
+            raise ValueError(filename + " is not a soundtomidi capture file")
+        magic, version, self.samplerate, self.channels, sample_size = \
+            HEADER.unpack(header)
+        if version != VERSION or sample_size != SAMPLE_SIZE:
+            raise ValueError("Capture file version " + str(version) +
+                             " is not supported")
+
+    def blocks(self):
+        # Yields (position, data, time_info, status) for each block, with
+        # data shaped (frames, channels) like sounddevice's.
+        import numpy as np
+        while True:
+            record = self.capture_file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            position, frames, status, adc_time, current_time = \
+                RECORD.unpack(record)
+            size = frames * self.channels * SAMPLE_SIZE
+            samples = self.capture_file.read(size)
+            if len(samples) < size:
+                return
+            data = np.frombuffer(samples, dtype='<f4').reshape(
+                frames, self.channels)
+            yield (position, data, StreamTime(adc_time, 0.0, current_time),
+                   status)
+
+    def close(self):
+        self.capture_file.close()
@@ -0,0 +1,204 @@
+"""Decodes soundtomidi's MIDI messages back into values.
+
+Anything listening to soundtomidi has to undo what the MidiEncoder did: pick
+out the controllers and sysex commands it was configured with, undo the
+"minus60" and "twobytes" BPM encodings, and pull band strengths out of the
+frequencies sysex. This does that once, for everyone.
+
+Everything is worked out up front. Sysex messages are looked up in a
+dictionary keyed on (prefix bytes, command)--the prefix being the
+manufacturer bytes, the channel and any leading command bytes--and control
+changes and notes on their status byte (and controller number), each
+pointing straight at a small function that pulls the value out of the raw
+message. No lists get built along the way; band strengths come back as a
+memoryview into the message.
+
+Messages are the raw bytes of one complete MIDI message (a bytes,
+bytearray or memoryview, sysex including its F0 and F7), and each decodes
+to a (feature, source, value) tuple, or None if it isn't one of ours (or
+is cut short). It never raises on somebody else's messages:
+
+    ('tempo', 'control' or 'sysex', BPM)
+    ('beats', 'control' or 'sysex', beat position or value)
+    ('rms', 'control' or 'sysex', 0-127)
+    ('frequencies', 'sysex', memoryview of 0-127 band strengths, low to high)
+    ('pitch', 'control', 'sysex', 'note_on' or 'note_off', MIDI note)
+    ('summary', 'sysex', memoryview of beat position, part of the beat, RMS,
+     note (0 for none), then band strengths), with aggregate on
+
+For example, with the same options soundtomidi was started with::
+
+    from soundtomidi.decoder import Decoder
+    decoder = Decoder.from_config(options.config)
+    with mido.open_input(port_name) as port:
+        for feature, source, value in decoder.decode_many(
+                message.bin() for message in port.iter_pending()):
+            ...
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+SYSEX = 0xF0
+CONTROL_CHANGE = 0xB0
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+
+
+def control_value(feature, offset=0):
+    def decode(data):
+        return feature, 'control', data[2] + offset
+    return decode
+
+
+def sysex_value(feature, start, offset=0):
+    def decode(data):
+        # The value and F7, or it was cut short.
+        if len(data) < start + 2:
+            return None
+        return feature, 'sysex', data[start] + offset
+    return decode
+
+
+def sysex_two_bytes(feature, start):
+    def decode(data):
+        if len(data) < start + 3:
+            return None
+        return feature, 'sysex', (data[start] * 128 + data[start + 1]) / 10.0
+    return decode
+
+
+def sysex_values(feature, start):
+    def decode(data):
+        if len(data) < start + 1:
+            return None
+        return feature, 'sysex', memoryview(data)[start:len(data) - 1]
+    return decode
+
+
+def note_on(data):
+    # A note on with no velocity is a note off, as far as MIDI is concerned.
+    if data[2]:
+        return 'pitch', 'note_on', data[1]
+    return 'pitch', 'note_off', data[1]
+
+
+def note_off(data):
+    return 'pitch', 'note_off', data[1]
+
+
+class Decoder(object):
+    """Turns raw MIDI messages from soundtomidi back into values.
+
+    channels are 0-15, like mido's. controls maps a feature to its
+    controller number and sysex_commands to its sysex command bytes; leave a
+    feature out (or give None) if it isn't being sent that way.
+
+    """
+
+    def __init__(self, sysex_manufacturer=(0x7D,), channels=(13,),
+                 controls=None, sysex_commands=None,
+                 tempo_control_type='minus60', tempo_sysex_type='twobytes',
+                 notes=True):
+        self.control_table = {}
+        self.note_table = {}
+        self.sysex_table = {}
+        controls = controls or {}
+        sysex_commands = sysex_commands or {}
+        prefix_lengths = set()
+        for channel in channels:
+            for feature, control in controls.items():
+                if control is None:
+                    continue
+                offset = 0
+                if feature == 'tempo' and tempo_control_type == 'minus60':
+                    offset = 60
+                self.control_table[(CONTROL_CHANGE | channel, control)] = \
+                    control_value(feature, offset)
+            if notes:
+                self.note_table[NOTE_ON | channel] = note_on
+                self.note_table[NOTE_OFF | channel] = note_off
+            for feature, commands in sysex_commands.items():
+                if not commands:
+                    continue
+                commands = tuple(commands)
+                prefix = bytes(bytearray(tuple(sysex_manufacturer) +
+                                         (channel,) + commands[:-1]))
+                # Values start after F0, the prefix and the command.
+                start = len(prefix) + 2
+                if feature in ('frequencies', 'summary'):
+                    handler = sysex_values(feature, start)
+                elif feature == 'tempo' and tempo_sysex_type == 'twobytes':
+                    handler = sysex_two_bytes(feature, start)
+                elif feature == 'tempo':
+                    handler = sysex_value(feature, start, 60)
+                else:
+                    handler = sysex_value(feature, start)
+                self.sysex_table[(prefix, commands[-1])] = handler
+                prefix_lengths.add(len(prefix))
+        self.prefix_lengths = tuple(sorted(prefix_lengths))
+
+    @classmethod
+    def from_config(cls, config):
+        # A soundtomidi Config, so the decoder matches the encoder.
+        channels = []
+        for port_name, channel, baud, features in config.outputs:
+            if channel not in channels:
+                channels.append(channel)
+        for device, channel, features, worker in config.inputs:
+            if channel is not None and channel not in channels:
+                channels.append(channel)
+        return cls(sysex_manufacturer=config.sysexmanf, channels=channels,
+                   controls={'tempo': config.tcontrolnum,
+                             'beats': config.bcontrolnum,
+                             'rms': config.rcontrolnum,
+                             'pitch': config.pcontrolnum},
+                   sysex_commands={'tempo': config.tsysexnum,
+                                   'beats': config.bsysexnum,
+                                   'rms': config.rsysexnum,
+                                   'frequencies': config.fsysexnum,
+                                   'pitch': config.psysexnum,
+                                   'summary': config.aggregate and
+                                   config.asysexnum},
+                   tempo_control_type=config.tcontroltype,
+                   tempo_sysex_type=config.tsysextype,
+                   notes=config.pnoteon or config.pnoteoff)
+
+    def decode(self, data):
+        # Other devices on the port can send anything, so nothing here can
+        # count on a message being as long as ours are.
+        if len(data) < 3:
+            return None
+        status = data[0]
+        if status == SYSEX:
+            for length in self.prefix_lengths:
+                # F0, the prefix, the command and F7 at the least.
+                if len(data) < length + 3:
+                    break
+                handler = self.sysex_table.get(
+                    (bytes(data[1:length + 1]), data[length + 1]))
+                if handler:
+                    return handler(data)
+            return None
+        if status & 0xF0 == CONTROL_CHANGE:
+            handler = self.control_table.get((status, data[1]))
+        else:
+            handler = self.note_table.get(status)
+        if handler:
+            return handler(data)
+        return None
+
+    def decode_message(self, message):
+        # A mido Message.
+        return self.decode(message.bin())
+
+    def decode_many(self, messages):
+        # For a drained queue. Anything that isn't one of ours is left out.
+        decode = self.decode
+        results = []
+        append = results.append
+        for data in messages:
+            result = decode(data)
+            if result is not None:
+                append(result)
+        return results
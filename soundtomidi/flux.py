@@ -0,0 +1,302 @@
+"""Spectral flux tempo and beats, in NumPy. For audio in big blocks.
+
+aubio's tempo object wants one hop per call, so with a large framemult its
+hop is the whole block, and its BPM and beats fall apart. With talg or balg
+set to "flux", the finder uses a FluxTempo instead, which takes the same
+calls (tempo_object(samples) and get_bpm()) but steps through the audio at
+its own rate, whatever size it comes in:
+
+    Onsets. About 86 times a second, whatever the framesize and framemult,
+    the latest audio is averaged down by four (nothing above about 5 kHz
+    matters for finding a beat), and the Hann windowed DFT bins for five low
+    bands are worked out with one matrix product (cheaper than a whole FFT,
+    for the few bins needed) and summed into the bands. The onset strength
+    is how much the log energy of the bands went up since the last step.
+    When the audio comes in bigger pieces (a higher framemult), all the
+    steps in a piece go through numpy at once, which costs a lot less than
+    one at a time. The beat is only reported at the end of the piece,
+    though, the same as with aubio.
+
+    Tempo. Twice a second, the last six seconds of onset strength are
+    autocorrelated (with an FFT) and the period between 60 and 187 BPM
+    that lines up best with itself and its double and triple, leaning a
+    little towards 120, wins.
+
+    Beats. Each hop gets a cumulative score: its onset strength plus the
+    best score about one period back (so a run of onsets a period apart
+    piles up). Halfway through each beat, the scores are run forward for
+    one period with no onsets, and the best place for the next beat near
+    where the period says it should be is picked. The beat is reported when
+    the audio gets there, so it comes out on time instead of a window late.
+
+Everything that's kept (the audio for the next step, the onset and score
+histories, the DFT and band matrices) is allocated up front, and a call with
+one hop in it works in those; the histories slide back to the start of their
+buffers now and then instead of growing.
+
+It isn't cheaper than aubio's C code, though. A trip through numpy costs
+about the same however little is in it, so at a framemult of 1 this takes
+more CPU than aubio does running twice, and it only gets near even at a
+framemult of 8 or so. benchmarks/beattracking.py measures both.
+
+With both talg and balg on flux, the TempoFinder gets a FluxFollower, which
+reads the BPM off the BeatFinder's FluxTempo, so it only runs once.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import math
+
+# Steps of onset strength a second, roughly.
+ONSET_RATE = 86
+# Hz. Bands for the onset strength, between each pair of edges.
+BAND_EDGES = (30, 150, 400, 1000, 2500, 5000)
+DECIMATION = 4
+COMPRESSION = 1000.0
+HISTORY_SECONDS = 6.0
+LOWEST_BPM = 60.0
+HIGHEST_BPM = 187.0
+# How much of each score carries over from a period back, and how tightly
+# "a period back" is held to.
+ALPHA = .9
+TIGHTNESS = 5.0
+# Beats aren't reported while the onsets are this far under their peak.
+QUIET = .05
+
+
+class FluxTempo:
+    """Stands in for aubio.tempo. window and hop are only there to match;
+    it takes audio in whatever size it comes and steps through it ONSET_RATE
+    times a second or so."""
+
+    def __init__(self, window, hop, samplerate):
+        import numpy as np
+        self.np = np
+        # A power of two, so it halves cleanly. 512 at 44100 or 48000.
+        self.hop = 2 ** int(round(math.log(samplerate / ONSET_RATE, 2)))
+        self.samplerate = samplerate
+        self.decimation = DECIMATION
+        if self.hop % DECIMATION:
+            self.decimation = 1
+        self.small_hop = self.hop // self.decimation
+        frame_size = 2 * self.small_hop
+        # Only the DFT bins the bands need, as one matrix with the Hann
+        # window folded in: cosines, then sines. One matrix product gets
+        # them all, which is much cheaper than a whole FFT call.
+        bin_width = samplerate / self.decimation / frame_size
+        bins = np.arange(int(math.ceil(BAND_EDGES[0] / bin_width)),
+                         int(math.ceil(BAND_EDGES[-1] / bin_width)))
+        angles = 2 * np.pi * np.outer(np.arange(frame_size), bins) / \
+            frame_size
+        hann_window = np.hanning(frame_size)[:, np.newaxis]
+        self.dft_matrix = np.hstack((np.cos(angles) * hann_window,
+                                     np.sin(angles) * hann_window)).astype(
+                                         np.float32)
+        self.band_matrix = np.zeros((len(bins), len(BAND_EDGES) - 1),
+                                    dtype=np.float32)
+        for band in range(len(BAND_EDGES) - 1):
+            self.band_matrix[:, band] = (
+                (bins * bin_width >= BAND_EDGES[band]) &
+                (bins * bin_width < BAND_EDGES[band + 1]))
+        # The audio is summed down rather than averaged, so this keeps the
+        # levels the same. Folding it in here saves a step per hop.
+        self.band_matrix *= COMPRESSION / self.decimation ** 2
+        self.bin_count = len(bins)
+        self.frame_size = frame_size
+        # The last two hops of averaged down audio.
+        self.frame_buffer = np.zeros(frame_size, dtype=np.float32)
+        self.leftover = np.zeros(0, dtype=np.float32)
+        self.last_bands = np.zeros(len(BAND_EDGES) - 1)
+
+        self.frame_rate = samplerate / self.hop
+        self.shortest_period = self.frame_rate * 60.0 / HIGHEST_BPM
+        self.longest_period = self.frame_rate * 60.0 / LOWEST_BPM
+        self.history = max(int(HISTORY_SECONDS * self.frame_rate),
+                           int(4 * self.longest_period) + 1)
+        self.onsets = np.zeros(2 * self.history)
+        self.scores = np.zeros(2 * self.history)
+        self.position = 0
+        self.frame = 0
+        self.onset_peak = 0.0
+        self.tempo_every = max(1, int(self.frame_rate / 2))
+        self.bpm = 0.0
+        self.period = None
+        self.set_period(self.frame_rate * 60.0 / 120.0)
+        self.last_beat = None
+        self.next_beat = None
+
+    def set_period(self, period):
+        np = self.np
+        self.period = period
+        self.shortest_lag = max(1, int(round(period / 2)))
+        self.longest_lag = int(round(2 * period))
+        # Oldest first, to match a slice of the scores.
+        lags = np.arange(self.longest_lag, self.shortest_lag - 1, -1)
+        self.lag_weights = np.exp(-.5 * (TIGHTNESS *
+                                         np.log(lags / period)) ** 2)
+        self.projection = np.zeros(self.longest_lag + int(period) + 1)
+
+    def __call__(self, samples):
+        if len(samples) == self.hop and not len(self.leftover):
+            return self.add_onset(self.one_hop(samples))
+        return self.many_hops(samples)
+
+    def one_hop(self, samples):
+        # The usual case, a hop at a time, all in buffers made up front.
+        np = self.np
+        frame_buffer = self.frame_buffer
+        small_hop = self.small_hop
+        frame_buffer[:small_hop] = frame_buffer[small_hop:]
+        if self.decimation > 1:
+            np.add.reduce(samples.reshape(small_hop, self.decimation), axis=1,
+                          out=frame_buffer[small_hop:])
+        else:
+            frame_buffer[small_hop:] = samples
+        spectrum = frame_buffer.dot(self.dft_matrix)
+        np.square(spectrum, out=spectrum)
+        power = spectrum[:self.bin_count] + spectrum[self.bin_count:]
+        bands = power.dot(self.band_matrix)
+        np.log1p(bands, out=bands)
+        onset = np.maximum(bands - self.last_bands, 0).sum()
+        self.last_bands = bands
+        return float(onset)
+
+    def many_hops(self, samples):
+        # Any other size, with all the hops going through numpy at once.
+        np = self.np
+        if len(self.leftover):
+            samples = np.concatenate((self.leftover, samples))
+        hops = len(samples) // self.hop
+        self.leftover = samples[hops * self.hop:].copy()
+        if not hops:
+            return False
+        used = samples[:hops * self.hop]
+        if self.decimation > 1:
+            used = used.reshape(-1, self.decimation).sum(axis=1)
+        signal = np.concatenate((self.frame_buffer[self.small_hop:],
+                                 used.astype(np.float32)))
+        self.frame_buffer[:] = signal[len(signal) - self.frame_size:]
+        frames = np.lib.stride_tricks.as_strided(
+            signal, (hops, self.frame_size),
+            (self.small_hop * signal.strides[0], signal.strides[0]))
+        spectrum = frames.dot(self.dft_matrix)
+        np.square(spectrum, out=spectrum)
+        power = spectrum[:, :self.bin_count] + spectrum[:, self.bin_count:]
+        bands = np.log1p(power.dot(self.band_matrix))
+        rises = np.diff(np.vstack((self.last_bands, bands)), axis=0)
+        self.last_bands = bands[-1]
+        is_beat = False
+        for onset in np.maximum(rises, 0).sum(axis=1):
+            if self.add_onset(float(onset)):
+                is_beat = True
+        return is_beat
+
+    def add_onset(self, onset):
+        if self.position == len(self.onsets):
+            # Slide the history back to the start rather than grow.
+            self.onsets[:self.history] = self.onsets[-self.history:]
+            self.scores[:self.history] = self.scores[-self.history:]
+            self.position = self.history
+        position = self.position
+        best = 0.0
+        if position >= self.longest_lag:
+            best = (self.scores[position - self.longest_lag:
+                                position - self.shortest_lag + 1] *
+                    self.lag_weights).max()
+        self.onsets[position] = onset
+        self.scores[position] = (1 - ALPHA) * onset + ALPHA * best
+        self.position += 1
+        frame = self.frame
+        self.frame += 1
+        self.onset_peak = max(onset, self.onset_peak * .999)
+
+        if self.frame % self.tempo_every == 0 and \
+                self.frame >= 2 * self.longest_period:
+            self.estimate_tempo()
+        is_beat = False
+        if self.next_beat is not None and frame >= self.next_beat:
+            self.next_beat = None
+            self.last_beat = frame
+            recent = self.onsets[max(0, position - self.longest_lag):
+                                 position + 1]
+            is_beat = recent.max() > QUIET * self.onset_peak
+        if self.next_beat is None and self.position > self.longest_lag and \
+                (self.last_beat is None or
+                 self.frame - self.last_beat >= self.period / 2):
+            self.predict_beat()
+        return is_beat
+
+    def estimate_tempo(self):
+        np = self.np
+        count = min(self.frame, self.history)
+        onsets = self.onsets[self.position - count:self.position]
+        onsets = onsets - onsets.mean()
+        spectrum = np.fft.rfft(onsets, 2 * count)
+        correlation = np.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2)
+        if correlation[0] <= 0:
+            return
+        shortest = int(math.ceil(self.shortest_period))
+        longest = int(self.longest_period)
+        lags = np.arange(shortest, longest + 1)
+        fits = correlation[lags].copy()
+        for multiple, weight in ((2, .5), (3, .25)):
+            usable = lags * multiple < count
+            fits[usable] += weight * correlation[lags[usable] * multiple]
+        bpms = self.frame_rate * 60.0 / lags
+        fits *= np.exp(-.5 * (np.log2(bpms / 120.0) / 1.5) ** 2)
+        best = int(np.argmax(fits))
+        if fits[best] <= 0:
+            return
+        period = float(lags[best])
+        if 0 < best < len(fits) - 1:
+            # Between lags, from a parabola through the best and its
+            # neighbours.
+            before, peak, after = fits[best - 1:best + 2]
+            bend = before - 2 * peak + after
+            if bend < 0:
+                period += .5 * (before - after) / bend
+        if abs(period - self.period) > .25:
+            self.set_period(period)
+        self.bpm = self.frame_rate * 60.0 / period
+
+    def predict_beat(self):
+        # Run the scores forward a period with no onsets, and pick the best
+        # spot near where the next beat ought to be.
+        np = self.np
+        history = self.longest_lag
+        ahead = int(self.period)
+        projection = self.projection[:history + ahead]
+        projection[:history] = self.scores[self.position - history:
+                                           self.position]
+        for step in range(ahead):
+            index = history + step
+            projection[index] = ALPHA * (
+                projection[index - self.longest_lag:
+                           index - self.shortest_lag + 1] *
+                self.lag_weights).max()
+        expected = self.period / 2
+        if self.last_beat is not None:
+            expected = self.last_beat + self.period - self.frame
+        steps = np.arange(ahead)
+        nearby = np.exp(-.5 * ((steps - expected) /
+                               (self.period / 4)) ** 2)
+        self.next_beat = self.frame + int(np.argmax(projection[history:] *
+                                                    nearby))
+
+    def get_bpm(self):
+        return self.bpm
+
+
+class FluxFollower:
+    """For a tempo finder when the beats finder already has a FluxTempo
+    going over the same audio. Working it all out twice would be a waste, so
+    this just reads the BPM off that one."""
+
+    def __init__(self, leader):
+        self.leader = leader
+
+    def __call__(self, samples):
+        return False
+
+    def get_bpm(self):
+        return self.leader.get_bpm()
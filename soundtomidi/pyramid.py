@@ -0,0 +1,226 @@
+"""Octave pyramid. Band strengths with each band on a window that suits it.
+
+With falg set to "pyramid", the FrequenciesFinder uses an OctavePyramid
+instead of aubio's phase vocoder and filter bank. aubio works everything out
+from one FFT of fwindow samples, so every band gets the same window. At the
+default 2048, that's 21.5 Hz between FFT bins, and the third-octave bands
+below about 60 Hz are narrower than that, while the treble bands only
+change once per 46 milliseconds. Making the window big enough for the bass
+makes everything else slower, and most of the FFT goes on treble bins that
+didn't need it.
+
+The pyramid splits the audio into octaves instead. Each level below the top
+is the one above it run through a half-band filter (a short low pass where
+every other tap is zero) and cut to half the sample rate. Every level has
+the same small FFT, FFT_SIZE samples, on its own hop of half that, so each
+level down has bins half as far apart and a window twice as long. Each band
+is worked out on the shallowest level that still gets MIN_BINS bins across
+it. The treble comes from the top level, updated every 128 samples, and the
+lowest bands from a level with bins about a hertz or two apart.
+
+Audio can come in blocks of any size. Each level works through all the hops
+that finished in the block at once, and a band's energy is the most it got
+in any of them. Deeper levels only get a few samples a block, so they wait
+until they have a hop's worth. A level that needs only a few bins gets them
+from one matrix product, with the window folded in, rather than a whole FFT.
+A band on a level that didn't finish a hop in the block keeps its last
+value. Bands are triangles over fbuckets like aubio's, but scaled so the
+energy is the average magnitude across the band, which makes bands on
+different levels comparable. They're not the same numbers aubio gives.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import math
+
+FFT_SIZE = 256
+# Taps on each side of the half-band filter's center. Odd, so it ends on a
+# tap that isn't zero.
+HALF_BAND_SIDE = 15
+# How much of each level's range (up to half its sample rate) is clear of
+# what the half-band filter lets fold over from above.
+PASSBAND = .75
+MIN_BINS = 3
+# Up to this many bins, a level works them out with a matrix product rather
+# than a whole FFT.
+MATRIX_BINS = FFT_SIZE // 8
+MAX_DEPTH = 12
+
+
+class Octave:
+    """One level of the pyramid. Keeps what it needs between blocks to
+    filter, cut down and take FFTs across block boundaries."""
+
+    def __init__(self, np, depth, samplerate):
+        self.np = np
+        self.depth = depth
+        self.samplerate = samplerate / 2 ** depth
+        self.bin_width = self.samplerate / FFT_SIZE
+        self.hop = FFT_SIZE // 2
+        self.window = np.hanning(FFT_SIZE).astype(np.float32)
+        # The last FFT's worth, and how far into the next hop it is.
+        self.tail = np.zeros(FFT_SIZE, dtype=np.float32)
+        self.since = 0
+        # For the half-band filter into the next level.
+        self.history = np.zeros(2 * HALF_BAND_SIDE, dtype=np.float32)
+        self.phase = 0
+        # Audio from the level above that hasn't been worked on yet.
+        self.waiting = []
+        self.waiting_count = 0
+        self.band_indices = None
+        self.weights = None
+        self.dft_matrix = None
+        self.first_bin = 0
+        self.last_bin = 0
+
+    def set_bands(self, band_indices, triangles):
+        # triangles is (low, peak, high) in Hz for each band in band_indices.
+        np = self.np
+        self.band_indices = np.array(band_indices)
+        low = min(triangle[0] for triangle in triangles)
+        high = max(triangle[2] for triangle in triangles)
+        self.first_bin = max(0, int(math.floor(low / self.bin_width)))
+        self.last_bin = min(FFT_SIZE // 2 + 1,
+                            int(math.ceil(high / self.bin_width)) + 1)
+        frequencies = np.arange(self.first_bin, self.last_bin) * \
+            self.bin_width
+        self.weights = np.zeros((len(frequencies), len(triangles)),
+                                dtype=np.float32)
+        for column, (low, peak, high) in enumerate(triangles):
+            rising = (frequencies - low) / (peak - low)
+            falling = (high - frequencies) / (high - peak)
+            triangle = np.maximum(0, np.minimum(rising, falling))
+            if not triangle.any():
+                # Narrower than a bin. The nearest bin will have to do.
+                triangle[np.argmin(np.abs(frequencies - peak))] = 1
+            # The triangle's area comes to one, so it averages.
+            self.weights[:, column] = triangle / triangle.sum()
+        bins = np.arange(self.first_bin, self.last_bin)
+        if len(bins) <= MATRIX_BINS:
+            # Cosines, then sines, with the window folded in, as in flux.py.
+            angles = 2 * np.pi * np.outer(np.arange(FFT_SIZE), bins) / \
+                FFT_SIZE
+            window = self.window[:, np.newaxis]
+            self.dft_matrix = np.hstack((np.cos(angles) * window,
+                                         np.sin(angles) * window)).astype(
+                                             np.float32)
+
+    def decimate(self, samples, even_taps, center_tap):
+        # Half-band filtered, every other sample, for the level below. Only
+        # the samples that are kept get worked out, and only with the taps
+        # that aren't zero: the center one, and every other one from the
+        # ends in (the filter is symmetrical, so which way doesn't matter).
+        np = self.np
+        pending = np.concatenate((self.history, samples))
+        self.history = pending[len(samples):]
+        outputs = len(samples)
+        count = (outputs - self.phase + 1) // 2
+        itemsize = pending.itemsize
+        stepped = np.ndarray((count, len(even_taps)), pending.dtype, pending,
+                             self.phase * itemsize,
+                             (2 * itemsize, 2 * itemsize))
+        halved = stepped.dot(even_taps)
+        center = self.phase + HALF_BAND_SIDE
+        halved += center_tap * pending[center:center + 2 * count:2]
+        self.phase = (self.phase - outputs) % 2
+        return halved
+
+    def analyse(self, samples, energies):
+        # Every hop that ends in samples goes through the FFT at once.
+        np = self.np
+        count = len(samples)
+        first_end = self.hop - self.since - 1
+        buffer = np.concatenate((self.tail, samples))
+        self.tail = buffer[len(buffer) - FFT_SIZE:]
+        self.since = (self.since + count) % self.hop
+        if first_end >= count:
+            return
+        hops = (count - 1 - first_end) // self.hop + 1
+        itemsize = buffer.itemsize
+        frames = np.ndarray((hops, FFT_SIZE), buffer.dtype, buffer,
+                            (first_end + 1) * itemsize,
+                            (self.hop * itemsize, itemsize))
+        if self.dft_matrix is None:
+            spectrum = np.fft.rfft(frames * self.window, axis=1)
+            magnitudes = np.abs(spectrum[:, self.first_bin:self.last_bin])
+        else:
+            spectrum = frames.dot(self.dft_matrix)
+            np.square(spectrum, out=spectrum)
+            bin_count = len(self.weights)
+            magnitudes = np.sqrt(spectrum[:, :bin_count] +
+                                 spectrum[:, bin_count:])
+        energies[self.band_indices] = magnitudes.dot(self.weights).max(axis=0)
+
+
+class OctavePyramid:
+    """Takes blocks of audio and returns band energies, one per band in
+    bands (a low barrier, the band centers and a high barrier, like
+    fbuckets), as a float32 numpy array."""
+
+    def __init__(self, bands, samplerate):
+        import numpy as np
+        self.np = np
+        self.samplerate = samplerate
+        triangles = [tuple(bands[index:index + 3])
+                     for index in range(len(bands) - 2)]
+        depths = [self.depth_for(triangle) for triangle in triangles]
+        self.octaves = [Octave(np, depth, samplerate)
+                        for depth in range(max(depths) + 1)]
+        for octave in self.octaves:
+            band_indices = [index for index, depth in enumerate(depths)
+                            if depth == octave.depth]
+            if band_indices:
+                octave.set_bands(band_indices, [triangles[index]
+                                                for index in band_indices])
+        side = np.arange(-HALF_BAND_SIDE, HALF_BAND_SIDE + 1)
+        taps = np.sinc(side / 2.0) * np.kaiser(len(side), 6.0)
+        taps = (taps / taps.sum()).astype(np.float32)
+        self.even_taps = taps[::2].copy()
+        self.center_tap = taps[HALF_BAND_SIDE]
+        self.energies = np.zeros(len(triangles), dtype=np.float32)
+
+    def depth_for(self, triangle):
+        # The shallowest level with MIN_BINS bins across the band, unless
+        # the band is too high for a level that deep.
+        low, peak, high = triangle
+        depth = 0
+        while depth < MAX_DEPTH and \
+                self.samplerate / 2 ** depth / FFT_SIZE * MIN_BINS > \
+                high - low and \
+                high <= PASSBAND * self.samplerate / 2 ** (depth + 2):
+            depth += 1
+        return depth
+
+    def __call__(self, samples):
+        energies = self.energies
+        np = self.np
+        last = len(self.octaves) - 1
+        for octave in self.octaves:
+            if octave.depth:
+                # Deeper levels only get a few samples a block, and going
+                # through numpy costs about the same for a few as for a
+                # hop's worth. So they wait for a hop's worth, and then so
+                # does everything under them.
+                octave.waiting.append(samples)
+                octave.waiting_count += len(samples)
+                if octave.waiting_count < octave.hop:
+                    break
+                if len(octave.waiting) > 1:
+                    samples = np.concatenate(octave.waiting)
+                octave.waiting = []
+                octave.waiting_count = 0
+            if octave.band_indices is not None:
+                octave.analyse(samples, energies)
+            if octave.depth < last:
+                samples = octave.decimate(samples, self.even_taps,
+                                          self.center_tap)
+        return energies
+
+    def depths(self):
+        # Which level each band is on, for anyone curious.
+        depths = [0] * len(self.energies)
+        for octave in self.octaves:
+            if octave.band_indices is not None:
+                for index in octave.band_indices:
+                    depths[index] = octave.depth
+        return depths
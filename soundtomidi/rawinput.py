@@ -0,0 +1,333 @@
+"""Raw input. Audio from standard input, a named pipe or UDP, not a sound card.
+
+Sometimes the audio isn't on this computer's sound card: it's a mixer's
+network stream, arecord on another box, or some other program. Give one of
+these as an inputdevice instead of a device ID:
+
+    stdin                   standard input. EG:
+                            arecord -t raw -f S16_LE -r 44100 -c 1 |
+                            python soundtomidi.py --inputdevice stdin
+                            --rawformat int16
+    fifo:PATH               a named pipe. When whatever is writing to it
+                            goes away, it waits for the next one.
+    udp:PORT                UDP datagrams sent to PORT (on any address),
+    udp:HOST:PORT           or to HOST:PORT.
+
+The audio is raw PCM, samples interleaved like a sound card's, in rawformat
+(float32 or int16, little endian) with channels channels at samplerate. It
+goes through ProcessAudio.callback just like sounddevice's blocks do.
+
+Each stream reads straight into one block-sized buffer made up front (with
+readinto or recv_into), which numpy looks at in place, so nothing new is
+allocated per block. int16 is scaled into a float32 buffer, also made up
+front. Like sounddevice's, that buffer is reused for the next block.
+
+Pipes are read a block at a time, as fast as the audio comes. Network
+packets don't show up evenly, so UDP goes through a jitter buffer: nothing
+is played out until rawjitter seconds of audio have arrived, and then a
+block is handed over every block's worth of time. If the buffer runs dry
+the block is silence, flagged as an input underflow, and it fills up to
+rawjitter again before playing. If it overflows (the sender is running
+fast), the oldest audio is dropped and the next block is flagged as an input
+overflow. Packets should hold whole frames; any leftover bytes are dropped.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import io
+import socket
+import sys
+import threading
+import time
+
+try:
+    from .capture import StreamTime
+except (ImportError, ValueError):
+    from capture import StreamTime
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# Little endian numpy types, and what to scale them by to get -1 to 1.
+FORMATS = {'float32': ('<f4', 1.0), 'int16': ('<i2', 1.0 / 32768)}
+# PortAudio's callback flags, as in capture.STATUS_FLAGS.
+INPUT_UNDERFLOW = 1
+INPUT_OVERFLOW = 2
+MAX_PACKET = 65536
+
+
+def parse_source(name):
+    """Returns (kind, address) for a raw input name, or None if it's a sound
+    card."""
+    name = str(name)
+    if name in ('stdin', '-'):
+        return 'stdin', None
+    if name.startswith('fifo:'):
+        if not name[5:]:
+            raise ValueError("'" + name + "' needs the path of a named pipe")
+        return 'fifo', name[5:]
+    if name.startswith('udp:'):
+        address = name[4:].rsplit(':', 1)
+        if len(address) == 1:
+            address.insert(0, '0.0.0.0')
+        try:
+            return 'udp', (address[0], int(address[1]))
+        except ValueError:
+            raise ValueError("'" + name + "' needs a port number")
+    return None
+
+
+def open_stream(source, channels, callback, blocksize, samplerate,
+                sample_format='float32', jitter=.05, finished_callback=None):
+    """Makes a stream for a parse_source() result. Like sd.InputStream, it
+    does nothing until start()."""
+    kind, address = source
+    if kind == 'udp':
+        return UdpInputStream(address, channels, callback, blocksize,
+                              samplerate, sample_format, jitter,
+                              finished_callback)
+    return PipeInputStream(kind, address, channels, callback, blocksize,
+                           samplerate, sample_format, finished_callback)
+
+
+class RawInputStream:
+    """What the raw streams have in common: the block buffers, and handing
+    blocks to the callback."""
+
+    def __init__(self, channels, callback, blocksize, samplerate,
+                 sample_format, finished_callback):
+        import numpy as np
+        dtype, self.scale = FORMATS[sample_format]
+        self.channels = channels
+        self.callback = callback
+        self.blocksize = blocksize
+        self.samplerate = samplerate
+        self.finished_callback = finished_callback
+        self.frame_bytes = channels * np.dtype(dtype).itemsize
+        self.block_bytes = blocksize * self.frame_bytes
+        self.raw = bytearray(self.block_bytes)
+        self.raw_view = memoryview(self.raw)
+        self.samples = np.frombuffer(self.raw, dtype=dtype).reshape(
+            blocksize, channels)
+        if self.scale == 1.0:
+            self.data = self.samples
+        else:
+            self.data = np.empty((blocksize, channels), dtype=np.float32)
+        self.np = np
+        self.thread = None
+        self.closed = False
+        self.blocks = 0
+
+    def deliver(self, status=0):
+        if self.data is not self.samples:
+            self.np.multiply(self.samples, self.scale, out=self.data)
+        now = monotonic()
+        self.blocks += 1
+        self.callback(self.data, self.blocksize,
+                      StreamTime(now - self.blocksize / self.samplerate, 0.0,
+                                 now), status)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def finish(self):
+        if not self.closed and self.finished_callback:
+            self.finished_callback()
+
+    def stats(self):
+        return {'blocks': self.blocks}
+
+
+class PipeInputStream(RawInputStream):
+    """Reads standard input or a named pipe, a block at a time."""
+
+    def __init__(self, kind, path, channels, callback, blocksize, samplerate,
+                 sample_format, finished_callback):
+        RawInputStream.__init__(self, channels, callback, blocksize,
+                                samplerate, sample_format, finished_callback)
+        self.kind = kind
+        self.path = path
+        self.source_file = None
+
+    def open(self):
+        # Unbuffered, so readinto goes straight into the block.
+        if self.kind == 'stdin':
+            return io.open(sys.stdin.fileno(), 'rb', buffering=0,
+                           closefd=False)
+        return io.open(self.path, 'rb', buffering=0)
+
+    def fill(self):
+        # False at the end of the stream. A partial block at the end is
+        # dropped.
+        filled = 0
+        while filled < self.block_bytes:
+            count = self.source_file.readinto(self.raw_view[filled:])
+            if not count:
+                return False
+            filled += count
+        return True
+
+    def run(self):
+        try:
+            while not self.closed:
+                # Opening a named pipe waits until something opens it to
+                # write.
+                self.source_file = self.open()
+                try:
+                    while not self.closed and self.fill():
+                        self.deliver()
+                finally:
+                    self.source_file.close()
+                if self.kind == 'stdin':
+                    break
+        except (IOError, OSError, ValueError) as error:
+            if not self.closed:
+                print("Raw input stopped. " + str(error), file=sys.stderr)
+        self.finish()
+
+    def close(self):
+        # A read that's waiting can't be interrupted, so this doesn't wait
+        # for the thread. It's a daemon, and it won't deliver again.
+        self.closed = True
+
+
+class UdpInputStream(RawInputStream):
+    """Receives UDP datagrams into a jitter buffer, and plays them out a
+    block at a time on a steady clock."""
+
+    def __init__(self, address, channels, callback, blocksize, samplerate,
+                 sample_format, jitter, finished_callback):
+        RawInputStream.__init__(self, channels, callback, blocksize,
+                                samplerate, sample_format, finished_callback)
+        self.address = address
+        self.packet = bytearray(MAX_PACKET)
+        self.target_bytes = max(blocksize, int(jitter * samplerate)) * \
+            self.frame_bytes
+        capacity = 2 * self.target_bytes + self.block_bytes
+        self.ring = bytearray(capacity)
+        self.ring_view = memoryview(self.ring)
+        # Bytes in and out since the start. Where they fall in the ring is
+        # the remainder.
+        self.written = 0
+        self.read = 0
+        self.lock = threading.Lock()
+        self.buffering = True
+        self.overflowed = False
+        self.underflows = 0
+        self.overflows = 0
+        self.packets = 0
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(address)
+        self.udp_socket.settimeout(.1)
+        self.receive_thread = None
+
+    def start(self):
+        self.receive_thread = threading.Thread(target=self.run_receiver)
+        self.receive_thread.daemon = True
+        self.receive_thread.start()
+        RawInputStream.start(self)
+
+    def run_receiver(self):
+        whole_packet = memoryview(self.packet)
+        capacity = len(self.ring)
+        while not self.closed:
+            try:
+                count = self.udp_socket.recv_into(self.packet)
+            except socket.timeout:
+                continue
+            except (IOError, OSError):
+                break
+            count -= count % self.frame_bytes
+            if not count:
+                continue
+            if count > capacity:
+                packet_view = whole_packet[count - capacity:count]
+                count = capacity
+            else:
+                packet_view = whole_packet[:count]
+            with self.lock:
+                self.packets += 1
+                overflow = self.written + count - self.read - capacity
+                if overflow > 0:
+                    # Throw away the oldest, in whole frames.
+                    overflow += -overflow % self.frame_bytes
+                    self.read += overflow
+                    self.overflows += 1
+                    self.overflowed = True
+                self.copy_in(packet_view)
+
+    def copy_in(self, view):
+        # Into the ring at written, in two pieces if it wraps.
+        capacity = len(self.ring)
+        start = self.written % capacity
+        first = min(len(view), capacity - start)
+        self.ring_view[start:start + first] = view[:first]
+        if first < len(view):
+            self.ring_view[:len(view) - first] = view[first:]
+        self.written += len(view)
+
+    def copy_out(self):
+        capacity = len(self.ring)
+        start = self.read % capacity
+        first = min(self.block_bytes, capacity - start)
+        self.raw_view[:first] = self.ring_view[start:start + first]
+        if first < self.block_bytes:
+            self.raw_view[first:] = self.ring_view[:self.block_bytes - first]
+        self.read += self.block_bytes
+
+    def run(self):
+        block_seconds = self.blocksize / self.samplerate
+        due = None
+        while not self.closed:
+            status = None
+            with self.lock:
+                level = self.written - self.read
+                if self.buffering and level >= self.target_bytes:
+                    self.buffering = False
+                if not self.buffering and level >= self.block_bytes:
+                    self.copy_out()
+                    status = 0
+                    if self.overflowed:
+                        status = INPUT_OVERFLOW
+                        self.overflowed = False
+                elif due is not None:
+                    # Ran dry. Silence until it has filled up again.
+                    if not self.buffering:
+                        self.buffering = True
+                        self.underflows += 1
+                    self.samples.fill(0)
+                    status = INPUT_UNDERFLOW
+            if status is None:
+                # Nothing's arrived yet, so there's no clock to keep.
+                time.sleep(block_seconds / 4)
+                continue
+            self.deliver(status)
+            now = monotonic()
+            if due is None or now - due > self.target_bytes / \
+                    self.frame_bytes / self.samplerate:
+                # Starting, or so far behind that catching up would only
+                # empty the buffer.
+                due = now
+            due += block_seconds
+            wait = due - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.finish()
+
+    def close(self):
+        self.closed = True
+        self.udp_socket.close()
+        if self.thread is not None:
+            self.thread.join()
+        if self.receive_thread is not None:
+            self.receive_thread.join()
+
+    def stats(self):
+        return {'packets': self.packets, 'blocks': self.blocks,
+                'underflows': self.underflows, 'overflows': self.overflows,
+                'buffered_seconds': (self.written - self.read) /
+                self.frame_bytes / self.samplerate}
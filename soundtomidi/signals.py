@@ -0,0 +1,102 @@
+"""Synthetic test signals. Audio where the right answer is known ahead of time.
+
+Used by --autotune to score candidate settings, and handy any time you want
+to push something through the audio processors without a sound card. Every
+signal is a mono float32 numpy array, the same as one channel of what
+sounddevice hands to ProcessAudio.callback, and comes with the answer:
+click times, notes, and so on. Noise always comes from a fixed seed, so the
+same call always makes the same audio.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+
+def silence(seconds, samplerate=44100):
+    return np.zeros(int(seconds * samplerate), dtype=np.float32)
+
+
+def click_track(bpm, seconds, samplerate=44100, click_seconds=.01,
+                level=.9):
+    """Short decaying noise bursts, one per beat. Returns samples and the
+    times of the clicks in seconds."""
+    samples = silence(seconds, samplerate)
+    click_length = int(click_seconds * samplerate)
+    envelope = np.exp(-np.linspace(0, 8, click_length)).astype(np.float32)
+    random_state = np.random.RandomState(1)
+    click = (random_state.uniform(-1, 1, click_length).astype(np.float32) *
+             envelope * level)
+    beat_seconds = 60.0 / bpm
+    click_times = []
+    click_time = 0.0
+    while click_time + click_seconds < seconds:
+        start = int(round(click_time * samplerate))
+        samples[start:start + click_length] += click
+        click_times.append(click_time)
+        click_time += beat_seconds
+    return samples, click_times
+
+
+def note_frequency(note):
+    return 440.0 * 2 ** ((note - 69) / 12.0)
+
+
+def tone(frequency, seconds, samplerate=44100, level=.5):
+    times = np.arange(int(seconds * samplerate)) / samplerate
+    return (level * np.sin(2 * np.pi * frequency * times)).astype(np.float32)
+
+
+def tones(notes, note_seconds, samplerate=44100, level=.5):
+    """Pure tones at MIDI notes, one after another, note_seconds each.
+    Returns samples and the (start, end, note) of each."""
+    pieces = []
+    answers = []
+    for index, note in enumerate(notes):
+        pieces.append(tone(note_frequency(note), note_seconds, samplerate,
+                           level))
+        answers.append((index * note_seconds, (index + 1) * note_seconds,
+                        note))
+    return np.concatenate(pieces), answers
+
+
+def swept_sine(low, high, seconds, samplerate=44100, level=.5):
+    """A sine gliding from low to high Hz, evenly through the octaves.
+    Returns samples and a function giving the frequency at a time."""
+    times = np.arange(int(seconds * samplerate)) / samplerate
+    ratio = high / low
+    rate = np.log(ratio) / seconds
+    phase = 2 * np.pi * low * (np.exp(rate * times) - 1) / rate
+    samples = (level * np.sin(phase)).astype(np.float32)
+
+    def frequency_at(time):
+        return low * ratio ** (time / seconds)
+
+    return samples, frequency_at
+
+
+def band_noise(low, high, seconds, samplerate=44100, level=.5, seed=1):
+    """White noise with everything outside low to high Hz cut out. Returns
+    samples scaled so the loudest is level."""
+    count = int(seconds * samplerate)
+    random_state = np.random.RandomState(seed)
+    spectrum = np.fft.rfft(random_state.uniform(-1, 1, count))
+    frequencies = np.fft.rfftfreq(count, 1.0 / samplerate)
+    spectrum[(frequencies < low) | (frequencies > high)] = 0
+    samples = np.fft.irfft(spectrum, count)
+    peak = np.max(np.abs(samples))
+    if peak > 0:
+        samples *= level / peak
+    return samples.astype(np.float32)
+
+
+def band_edges(bands):
+    """For filter bank frequencies (a low barrier, the band centers, and a
+    high barrier), where each band's noise should start and stop: half way,
+    in octaves, to the neighbouring centers."""
+    edges = []
+    for index in range(1, len(bands) - 1):
+        low = (bands[index - 1] * bands[index]) ** .5
+        high = (bands[index] * bands[index + 1]) ** .5
+        edges.append((low, high))
+    return edges
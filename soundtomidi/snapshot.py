@@ -0,0 +1,78 @@
+"""State files. What the audio processors have learned, to pick up again later.
+
+The audio processors take a while to get their bearings. RMS and band
+strengths are fractions of the loudest seen so far, so right after a start
+the first loud hit pins everything at 127, and the tempo finder needs a run
+of BPMs before the steady BPM means anything. With statefile set, that's
+saved every statesave seconds and loaded at startup (if it isn't older than
+statemaxage), so a crash or a reboot in the middle of a set is back to
+useful output within a beat or two.
+
+A state is a dictionary of names to lists of numbers. The layout is a 24
+byte header (magic, version, entry count and the time it was saved, in
+seconds since the epoch), then for each entry the length of its name and
+its number of values, the name in UTF-8, and the values as little endian
+doubles. The file is written next to where it goes and then renamed into
+place, so a crash while saving leaves the last good one.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import struct
+import time
+
+MAGIC = b'STMSTAT1'
+VERSION = 1
+HEADER = struct.Struct('<8sIId')
+ENTRY = struct.Struct('<HI')
+
+
+def write(filename, state, saved_at=None):
+    if saved_at is None:
+        saved_at = time.time()
+    pieces = [HEADER.pack(MAGIC, VERSION, len(state), saved_at)]
+    for name, values in sorted(state.items()):
+        encoded_name = name.encode('utf-8')
+        values = [float(value) for value in values]
+        pieces.append(ENTRY.pack(len(encoded_name), len(values)))
+        pieces.append(encoded_name)
+        pieces.append(struct.pack('<' + str(len(values)) + 'd', *values))
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'wb') as state_file:
+        state_file.write(b''.join(pieces))
+    replace = getattr(os, 'replace', os.rename)
+    replace(temporary_filename, filename)
+
+
+def read(filename, max_age=None):
+    """Returns the state and how many seconds ago it was saved, or None if
+    there's no file or it's older than max_age."""
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as state_file:
+        contents = state_file.read()
+    if len(contents) < HEADER.size or contents[:8] != MAGIC:
+        raise ValueError(filename + " is not a soundtomidi state file")
+    magic, version, count, saved_at = HEADER.unpack_from(contents)
+    if version != VERSION:
+        raise ValueError("State file version " + str(version) +
+                         " is not supported")
+    age = time.time() - saved_at
+    if max_age is not None and age > max_age:
+        return None
+    state = {}
+    offset = HEADER.size
+    try:
+        for index in range(count):
+            name_length, value_count = ENTRY.unpack_from(contents, offset)
+            offset += ENTRY.size
+            name = contents[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            values = struct.unpack_from('<' + str(value_count) + 'd',
+                                        contents, offset)
+            offset += value_count * 8
+            state[name] = list(values)
+    except struct.error:
+        raise ValueError(filename + " is cut short")
+    return state, age
@@ -35,18 +35,84 @@ Options:
   --writeinifile                Write options to ini file, as specified by
                                 inifile option. If the file already present,
                                 a backup is made of original.
+  --autotune                    Try out settings for each audio processor on
+                                synthetic audio, and write the ones that do
+                                best within tunecpu and tunelatency to the
+                                ini file, as specified by inifile.
+                                Quits after.
+  --tunecpu=TUNECPU             Percent of one CPU core that all the audio
+                                processors together may use, for autotune.
+                                [default: 25]
+  --tunelatency=TUNELATENCY     Longest time, in seconds, an audio processor
+                                may take to come up with an answer, for
+                                autotune.
+                                [default: .1]
   --inifile=FILE                Name of options settings file.
                                 [default: soundtomidi.ini]
   --inputdevice=DEVICE          ID of the sound input device. System default
                                 audio input device will be used if not
                                 specified.
+                                Separate several devices with commas to
+                                listen to all of them at once, each with its
+                                own audio processors. The next three options
+                                then take one comma separated value per
+                                device, or a single value for all of them.
+                                For raw audio from another program or the
+                                network, "stdin", "fifo:PATH", "udp:PORT" or
+                                "udp:HOST:PORT". See soundtomidi/rawinput.py.
                                 [default: default]
+  --inchannel=INCHANNEL         MIDI channel (1-16) to send the device's
+                                messages on, instead of each port's
+                                outchannel, so devices can be told apart.
+                                If "None", outchannel is used.
+                                [default: None]
+  --infeatures=INFEATURES       Which features to find for the device. "all",
+                                or features joined with "+" like outfeatures.
+                                Each still has to be turned on with its get
+                                option.
+                                [default: all]
+  --inworker=INWORKER           Name of a thread to run the device's audio
+                                processors on, so the sound card's callback
+                                only copies the block. Devices given the same
+                                name share the thread.
+                                If "None", they run in the callback.
+                                [default: None]
+  --inqueue=INQUEUE             Number of blocks that can wait for a worker
+                                thread. If it falls behind, blocks are
+                                dropped rather than holding up the audio.
+                                [default: 64]
+  --rawformat=RAWFORMAT         Sample format of raw input (stdin, fifo or
+                                udp): float32 or int16, little endian.
+                                [default: float32]
+  --rawjitter=RAWJITTER         Seconds of audio to hold back from udp input,
+                                to even out packets that arrive unevenly.
+                                More is smoother, less is sooner.
+                                [default: .05]
   --channels=CHANNELS           Number of channels to capture.
                                 [default: 1]
   --samplerate=SAMPLERATE       Capture rate for audio samples.
                                 [default: 44100]
   --framesize=FRAMESIZE         Size of each frame captured.
                                 [default: 512]
+  --capturefile=CAPTUREFILE     Record the audio exactly as it arrives, block
+                                by block, with its timing and status flags,
+                                so it can be replayed later. See
+                                soundtomidi/capture.py.
+                                If "None", nothing is recorded.
+                                [default: None]
+  --capturequeue=CAPTUREQUEUE   Number of blocks that can wait to be written
+                                to the capture file. If the disk can't keep
+                                up, blocks are dropped rather than holding
+                                up the audio.
+                                [default: 1000]
+  --replayfile=REPLAYFILE       Instead of the sound card, read the audio
+                                from a capture file, in the same blocks and
+                                with the same timing. Quits at the end.
+                                If "None", the sound card is used.
+                                [default: None]
+  --replayspeed=REPLAYSPEED     How fast to replay. 1 is as it was recorded,
+                                2 is twice as fast, 0 is as fast as possible.
+                                [default: 1]
   --stdout=STDOUT               Echo message to standard out.
                                 [default: False]
   --stdoutformat=STDOUTFORMAT   Format for standard out messages. Options are
@@ -56,16 +122,107 @@ Options:
                                 [default: True]
   --outport=MIDIOUTPORT         Name of the MIDI output port. If left as
                                 default, uses first MIDI port found.
+                                Separate several ports with commas to send
+                                to all of them. The next three options then
+                                take one comma separated value per port, or
+                                a single value for all of them.
                                 [default: default]
   --outchannel=OUTCHANNEL       Number of the MIDI channel to send messages on.
                                 Valid numbers 1-16.
                                 [default: 14]
+  --outbaud=OUTBAUD             Wire rate of the MIDI output, in baud. Output
+                                is paced so no more than OUTBAUD / 10 bytes a
+                                second are sent. 31250 is the DIN MIDI rate.
+                                Set to 0 to send as fast as possible.
+                                [default: 31250]
+  --outfeatures=OUTFEATURES     Which features to send to the port. "all", or
+                                any of "tempo", "beats", "rms", "frequencies"
+                                and "pitch" joined with "+".
+                                EG: "beats,frequencies+rms" sends beats to
+                                the first port, frequencies and RMS to the
+                                second.
+                                [default: all]
+  --outmaxlag=OUTMAXLAG         Seconds a message may wait for the wire before
+                                it is dropped as stale. Notes are never
+                                dropped. Set to 0 to never drop.
+                                [default: .25]
+  --outlatency=OUTLATENCY       Send each message this many seconds after the
+                                audio that produced it reached the sound card,
+                                instead of whenever the analysis finishes.
+                                Steadier timing for a little delay; it needs
+                                to cover the longest window plus the time to
+                                analyse it, or messages go out late.
+                                If "None", they're sent as soon as they can.
+                                [default: None]
+  --outqueue=OUTQUEUE           Number of messages that can wait to be handed
+                                to the MIDI output thread.
+                                [default: 256]
+  --outqueuefull=OUTQUEUEFULL   What to do when that queue is full.
+                                "dropoldest" throws away the oldest waiting
+                                message, "dropnewest" throws away the one
+                                being added. Either way the audio callback
+                                never waits on the output.
+                                [default: dropoldest]
   --sysexmanf=MANF              Manufacturer prefix code for sysex messages.
                                 Int or hex values, separarated by space.
                                 [default: 0x7D]
+  --recordfile=RECORDFILE       Record every MIDI message that is sent to this
+                                Standard MIDI File, timed by the audio stream
+                                to the millisecond. If "None", nothing is
+                                recorded.
+                                [default: None]
+  --recordflush=RECORDFLUSH     Seconds between writes to the record file. A
+                                crash loses at most this much of the recording.
+                                [default: 2]
+  --oscout=OSCOUT               Send OSC messages over UDP as well? Values are
+                                sent as full precision floats, with everything
+                                from one block of audio in a single bundle.
+                                [default: False]
+  --oschost=OSCHOST             Host to send OSC messages to.
+                                [default: 127.0.0.1]
+  --oscport=OSCPORT             UDP port to send OSC messages to.
+                                [default: 9000]
+  --oscprefix=OSCPREFIX         Prefix for the OSC address of each message.
+                                EG: /soundtomidi/bpm, /soundtomidi/rms.
+                                [default: /soundtomidi]
+  --boardout=BOARDOUT           Keep the latest value of every feature in a
+                                shared memory file that other programs on this
+                                computer can read. See soundtomidi/board.py.
+                                [default: False]
+  --boardfile=BOARDFILE         Name of the shared memory file. On Linux,
+                                somewhere in /dev/shm keeps it off the disk.
+                                [default: soundtomidi.board]
+  --aggregate=AGGREGATE         Instead of sending RMS, frequencies and pitch
+                                as often as they're found, sum them up between
+                                beats and send one summary sysex for each
+                                beat, or for each of this many parts of a beat
+                                (2 for eighths, 4 for sixteenths). Needs beats
+                                on every input device that sends them.
+                                If "None", they're sent as they're found.
+                                [default: None]
+  --asysexnum=ASYSEXNUM         Prefix to send prior to each summary: beat
+                                position, part of the beat, RMS, the most
+                                heard note (0 if none), then band strengths.
+                                [default: 0x0C]
+  --statefile=STATEFILE         Save what the audio processors have learned
+                                (the loudest RMS and band energies so far, the
+                                last BPMs) to this file as it runs, and pick it
+                                up again at startup, so a restart doesn't
+                                begin from nothing. See
+                                soundtomidi/snapshot.py. If "None", nothing is
+                                saved.
+                                [default: None]
+  --statesave=STATESAVE         Seconds between saves. It's saved on the way
+                                out too.
+                                [default: 10]
+  --statemaxage=STATEMAXAGE     Seconds after which a saved state is too old
+                                to pick up (it's probably a different gig).
+                                [default: 600]
   --gettempo=TEMPO              Get the tempo of the audio.
                                 [default: True]
-  --talg=TALG                   Aubio algorithm for determining the tempo.
+  --talg=TALG                   Aubio algorithm for determining the tempo, or
+                                "flux" for a NumPy one that stays accurate at
+                                large framemults. See soundtomidi/flux.py.
                                 [default: default]
   --tframemult=TFRAMEMULT       Number of frames to use in calculation.
                                 [default: 1]
@@ -99,7 +256,8 @@ Options:
                                 [default: twobytes]
   --getbeats=BEATS              Get the beats of the audio.
                                 [default: True]
-  --balg=BALG                   Aubio algorithm to use for the beat.
+  --balg=BALG                   Aubio algorithm to use for the beat, or
+                                "flux", as for talg.
                                 [default: default]
   --bframemult=BFRAMEMULT       Number of frames to use in calculation.
                                 [default: 1]
@@ -148,8 +306,13 @@ Options:
                                 [default: .5]
   --getfrequencies=FREQS        Get the strength of filtered frequencies.
                                 [default: True]
-  --falg=FALG                   Aubio algorithm to use for determining
-                                the strength of the frequencies.
+  --falg=FALG                   Algorithm to use for determining the
+                                strength of the frequencies. "default" for
+                                aubio's filter bank over one FFT of the whole
+                                window, or "pyramid" for an octave pyramid,
+                                with long windows for the bass bands and short
+                                ones for the treble. See
+                                soundtomidi/pyramid.py.
                                 [default: default]
   --fframemult=FFRAMEMULT       Number of frames to use in calculation.
                                 [default: 4]
@@ -220,17 +383,395 @@ from __future__ import print_function
 from __future__ import division
 from docopt import docopt
 import configparser
+import copy
+import heapq
+import mmap
 import os.path
+import signal
+import socket
+import struct
 import sys
 import time
-import numpy as np
-import sounddevice as sd
+import threading
+import importlib
 from datetime import datetime as dt
-from collections import Counter
-from aubio import pitch, tempo, pvoc, filterbank, fvec
-import mido
+from collections import Counter, OrderedDict, namedtuple
 import math
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from . import board
+    from . import capture
+    from . import flux
+    from . import pyramid
+    from . import rawinput
+    from . import snapshot
+except (ImportError, ValueError):
+    import board
+    import capture
+    import flux
+    import pyramid
+    import rawinput
+    import snapshot
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+
+class LazyModule(object):
+    """Stands in for a module until something actually uses it.
+
+    numpy, sounddevice, aubio and mido take seconds to import on a Pi, and
+    listing MIDI ports or writing an ini file doesn't need most (or any) of
+    them. The first time anything is looked up on one of these, the real
+    module is imported and put in this module's globals in place of the
+    stand in, so after that there's no difference at all.
+
+    """
+
+    def __init__(self, module_name, global_name):
+        self.module_name = module_name
+        self.global_name = global_name
+
+    def load(self):
+        module = importlib.import_module(self.module_name)
+        globals()[self.global_name] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+np = LazyModule('numpy', 'np')
+sd = LazyModule('sounddevice', 'sd')
+aubio = LazyModule('aubio', 'aubio')
+mido = LazyModule('mido', 'mido')
+
+
+THIRD_OCTAVE_BANDS = [22.4,
+                      25, 31.5, 40, 50, 63,
+                      80, 100, 125, 160, 200,
+                      250, 315, 400, 500, 630,
+                      800, 1000, 1250, 1600, 2000,
+                      2500, 3150, 4000, 5000, 6300,
+                      8000, 10000, 12500, 16000, 20000,
+                      22390]
+OCTAVE_BANDS = [22,
+                31.5, 63, 125, 250, 500,
+                1000, 2000, 4000, 8000, 16000,
+                22720]
+FEATURES = ('tempo', 'beats', 'rms', 'frequencies', 'pitch')
+# What a summary stands in for, with aggregate on.
+AGGREGATED_FEATURES = ('rms', 'frequencies', 'pitch')
+OPTION_NAMES = tuple(key[2:] for key in docopt(__doc__, argv=[]))
+
+
+def as_bool(value):
+    if value is True or value is False:
+        return value
+    if value.lower() == 'true':
+        return True
+    if value.lower() == 'false':
+        return False
+    raise ValueError("expected True or False, not '" + value + "'")
+
+
+def as_midi_number(value):
+    if value == 'None':
+        return None
+    number = int(value, 0)
+    if not 0 <= number <= 127:
+        raise ValueError("MIDI values are 0-127, not " + value)
+    return number
+
+
+def as_midi_bytes(value):
+    if value == 'None':
+        return ()
+    return tuple(as_midi_number(item) for item in value.split(' '))
+
+
+def as_optional(convert):
+    def convert_optional(value):
+        if value == 'None':
+            return None
+        return convert(value)
+    return convert_optional
+
+
+def as_choice(*choices):
+    def convert_choice(value):
+        if value not in choices:
+            raise ValueError("expected one of " + ", ".join(choices) +
+                             ", not '" + value + "'")
+        return value
+    return convert_choice
+
+
+def as_device(value):
+    if value == 'default':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def as_int_list(value):
+    return tuple(int(item.strip()) for item in value.split(','))
+
+
+def as_bands(value):
+    if value == 'third-octave':
+        return tuple(THIRD_OCTAVE_BANDS)
+    if value == 'octave':
+        return tuple(OCTAVE_BANDS)
+    return tuple(float(item) for item in value.split(','))
+
+
+def as_port_list(value):
+    return tuple(item.strip() for item in value.split(','))
+
+
+# Option name and the function that turns the string into what is actually
+# used. Anything not listed here stays a string.
+CONVERTERS = {
+    'listsounddevices': as_bool, 'listmidiports': as_bool,
+    'writeinifile': as_bool,
+    'autotune': as_bool, 'tunecpu': float, 'tunelatency': float,
+    'inputdevice': as_port_list, 'inchannel': as_port_list,
+    'infeatures': as_port_list, 'inworker': as_port_list, 'inqueue': int,
+    'rawformat': as_choice('float32', 'int16'), 'rawjitter': float,
+    'channels': int, 'samplerate': int,
+    'framesize': int,
+    'capturefile': as_optional(str), 'capturequeue': int,
+    'replayfile': as_optional(str), 'replayspeed': float,
+    'stdout': as_bool,
+    'stdoutformat': as_choice('verbose', 'bytes', 'bin', 'hex'),
+    'midiout': as_bool, 'outport': as_port_list, 'outchannel': as_port_list,
+    'outbaud': as_port_list, 'outfeatures': as_port_list,
+    'outmaxlag': float, 'outlatency': as_optional(float), 'outqueue': int,
+    'outqueuefull': as_choice('dropoldest', 'dropnewest'),
+    'recordfile': as_optional(str), 'recordflush': float,
+    'oscout': as_bool, 'oscport': int,
+    'boardout': as_bool,
+    'aggregate': as_optional(int), 'asysexnum': as_midi_bytes,
+    'statefile': as_optional(str), 'statesave': float, 'statemaxage': float,
+    'sysexmanf': as_midi_bytes,
+    'gettempo': as_bool, 'tframemult': int, 'thopmult': float,
+    'taverage': int, 'tcount': int, 'tcontrolnum': as_midi_number,
+    'tcontroltype': as_choice('minus60'), 'tsysexnum': as_midi_bytes,
+    'tsysextype': as_choice('twobytes', 'minus60'),
+    'getbeats': as_bool, 'bframemult': int, 'bhopmult': float,
+    'bcontrolnum': as_midi_number, 'bsysexnum': as_midi_bytes,
+    'bvaltype': as_int_list, 'bclock': as_bool,
+    'getrms': as_bool, 'rframemult': int, 'rhopmult': float,
+    'rcontrolnum': as_midi_number, 'rsysexnum': as_midi_bytes,
+    'rgraceful': float,
+    'getfrequencies': as_bool, 'fframemult': int, 'fhopmult': float,
+    'falg': as_choice('default', 'pyramid'),
+    'fcount': int, 'fbuckets': as_bands, 'fsysexnum': as_midi_bytes,
+    'fgraceful': float,
+    'getpitch': as_bool, 'pframemult': int, 'phopmult': float,
+    'ptolerance': as_optional(float), 'pcount': int, 'plowcutoff': int,
+    'phighcutoff': int, 'pfoldoctaves': as_bool, 'pnumoffset': int,
+    'pnoteon': as_bool, 'pnoteoff': as_bool,
+    'pcontrolnum': as_midi_number, 'psysexnum': as_midi_bytes,
+}
+
+# Options that can be changed while running (see ProcessAudio.reconfigure).
+# Changing one of these rebuilds just that feature's audio processor.
+LIVE_OPTIONS = {
+    'tempo': ('gettempo', 'talg', 'tframemult', 'thopmult', 'taverage',
+              'tcount'),
+    'beats': ('getbeats', 'balg', 'bframemult', 'bhopmult', 'bvaltype'),
+    'rms': ('getrms', 'rframemult', 'rhopmult'),
+    'frequencies': ('getfrequencies', 'falg', 'fframemult', 'fhopmult',
+                    'fcount', 'fbuckets', 'fgraceful'),
+    'pitch': ('getpitch', 'palg', 'pframemult', 'phopmult', 'ptolerance',
+              'pcount', 'plowcutoff', 'phighcutoff', 'pfoldoctaves',
+              'pnumoffset'),
+}
+# Changing one of these rebuilds the MidiEncoder.
+ENCODER_OPTIONS = ('tcontrolnum', 'tcontroltype', 'tsysexnum', 'tsysextype',
+                   'bcontrolnum', 'bsysexnum', 'rcontrolnum', 'rsysexnum',
+                   'rgraceful', 'fsysexnum', 'pcontrolnum', 'psysexnum',
+                   'pnoteon', 'pnoteoff', 'asysexnum')
+# These only mean something when starting up, so changing them later is
+# neither applied nor complained about.
+STARTUP_OPTIONS = ('help', 'inifile', 'writeinifile', 'listsounddevices',
+                   'listmidiports', 'autotune', 'tunecpu', 'tunelatency')
+
+
+class Config(object):
+    """Every option, checked and turned into the type it's used as.
+
+    Built once at startup from the merged strings in Options.settings, so
+    nothing after that has to parse "0x0B" or compare against "True". It
+    also works out the window and hop sizes for each audio processor and
+    expands the per device input options and per port output options to
+    one entry per device and per port.
+
+    Anything that doesn't make sense is caught here, with a ValueError that
+    says which option is wrong, rather than halfway through a show. That
+    includes hop sizes that don't come out to a whole number of samples.
+
+    """
+
+    __slots__ = OPTION_NAMES + (
+        'inputs', 'outputs',
+        'twindow', 'thop', 'bwindow', 'bhop', 'rwindow',
+        'fwindow', 'fhop', 'fbands', 'pwindow', 'phop')
+
+    def __init__(self, settings):
+        for name in self.__slots__:
+            if name not in settings:
+                continue
+            convert = CONVERTERS.get(name)
+            value = settings[name]
+            if convert and value is not None:
+                try:
+                    value = convert(value)
+                except ValueError as error:
+                    raise ValueError("Option " + name + ": " + str(error))
+            setattr(self, name, value)
+        self.twindow, self.thop = self.window_and_hop('t')
+        self.bwindow, self.bhop = self.window_and_hop('b')
+        self.rwindow, ignore_hop = self.window_and_hop('r')
+        self.fwindow, self.fhop = self.window_and_hop('f')
+        self.pwindow, self.phop = self.window_and_hop('p')
+        for name in ('taverage', 'tcount', 'fcount', 'pcount', 'channels',
+                     'samplerate', 'outqueue', 'capturequeue', 'inqueue'):
+            if getattr(self, name) < 1:
+                raise ValueError("Option " + name + " must be at least 1")
+        if self.replayspeed < 0:
+            raise ValueError("Option replayspeed can't be negative")
+        if self.rawjitter < 0:
+            raise ValueError("Option rawjitter can't be negative")
+        if self.outlatency is not None and self.outlatency < 0:
+            raise ValueError("Option outlatency can't be negative")
+        if self.aggregate is not None and self.aggregate < 1:
+            raise ValueError("Option aggregate must be at least 1")
+        if self.statesave <= 0:
+            raise ValueError("Option statesave must be more than 0")
+        if len(self.fbuckets) < 3:
+            raise ValueError("Option fbuckets needs at least three values")
+        self.fbands = len(self.fbuckets) - 2
+        if not self.bvaltype:
+            self.bvaltype = (64,)
+        self.inputs = self.expand_inputs()
+        self.outputs = self.expand_outputs()
+        if self.aggregate is not None:
+            self.check_aggregate()
+
+    def check_aggregate(self):
+        # Summaries go out on beats, and the RMS, frequencies and pitch
+        # messages they replace aren't sent at all. Without beats, those
+        # would just go quiet.
+        if not self.getbeats:
+            raise ValueError("Option aggregate needs getbeats on")
+        for device, channel, features, worker in self.inputs:
+            if features is None or 'beats' in features:
+                continue
+            if [feature for feature in features
+                    if feature in AGGREGATED_FEATURES]:
+                raise ValueError("Option aggregate needs beats in "
+                                 "infeatures for input device " +
+                                 str(device))
+
+    def window_and_hop(self, prefix):
+        frame_multiplier = getattr(self, prefix + 'framemult')
+        if frame_multiplier < 1:
+            raise ValueError("Option " + prefix + "framemult must be at "
+                             "least 1")
+        window = self.framesize * frame_multiplier
+        hop = window * getattr(self, prefix + 'hopmult')
+        if hop != int(hop) or not 0 < hop <= window:
+            raise ValueError("Option " + prefix + "hopmult gives a hop of " +
+                             str(hop) + " samples. It needs to be a whole "
+                             "number from 1 to the window size of " +
+                             str(window) + ".")
+        return window, int(hop)
+
+    def columns(self, names, count, what):
+        # Per device or per port options: one value each, or one for all.
+        columns = []
+        for name in names:
+            values = getattr(self, name)
+            if len(values) == 1:
+                values *= count
+            if len(values) != count:
+                raise ValueError("Option " + name + " needs one value, or "
+                                 "one for each of the " + str(count) + " " +
+                                 what)
+            columns.append(values)
+        return columns
+
+    @staticmethod
+    def channel(name, value):
+        try:
+            channel = int(value, 0)
+        except ValueError:
+            channel = 0
+        if not 1 <= channel <= 16:
+            raise ValueError("Option " + name + ": MIDI channels are 1-16, "
+                             "not " + value)
+        return channel - 1
+
+    @staticmethod
+    def features(name, value):
+        if value == 'all':
+            return None
+        features = tuple(value.split('+'))
+        for feature in features:
+            if feature not in FEATURES:
+                raise ValueError("Option " + name + ": unknown feature '" +
+                                 feature + "'")
+        return features
+
+    def expand_inputs(self):
+        device_count = len(self.inputdevice)
+        columns = self.columns(('inchannel', 'infeatures', 'inworker'),
+                               device_count, "input devices")
+        inputs = []
+        for index in range(device_count):
+            channel = None
+            if columns[0][index] != 'None':
+                channel = self.channel('inchannel', columns[0][index])
+            worker = None
+            if columns[2][index] != 'None':
+                worker = columns[2][index]
+            try:
+                rawinput.parse_source(self.inputdevice[index])
+            except ValueError as error:
+                raise ValueError("Option inputdevice: " + str(error))
+            inputs.append((as_device(self.inputdevice[index]), channel,
+                           self.features('infeatures', columns[1][index]),
+                           worker))
+        return tuple(inputs)
+
+    def expand_outputs(self):
+        port_count = len(self.outport)
+        columns = self.columns(('outchannel', 'outbaud', 'outfeatures'),
+                               port_count, "output ports")
+        outputs = []
+        for index in range(port_count):
+            channel = self.channel('outchannel', columns[0][index])
+            try:
+                baud = float(columns[1][index])
+            except ValueError:
+                raise ValueError("Option outbaud: '" + columns[1][index] +
+                                 "' is not a number")
+            outputs.append((self.outport[index], channel, baud,
+                            self.features('outfeatures', columns[2][index])))
+        return tuple(outputs)
+
 
 class Options:
     """Take configuration options as arguments or from an inifile.
@@ -238,8 +779,11 @@ class Options:
     Docopt is used to describe the various configuration options, and
     there are many. This is handy for one off changes, but having a nice
     .ini file, organized by function, makes things a little clearer. This
-    class mushes together command line arguments and ini file options into
-    an dictionary used throughout the program.
+    class mushes together the docopt defaults, the ini file, and command
+    line arguments, in that order, so an ini file can change the defaults
+    and the command line can change either. The merged strings are kept in
+    settings (that's what gets written back out to an ini file), and turned
+    into a typed Config, which is what everything else reads.
 
     Other than loading all this up, it also is capable of generating a
     template .ini file organized by section with the defaults from docopt
@@ -251,30 +795,68 @@ class Options:
 
     """
 
-    def __init__(self):
-        self.settings = docopt(__doc__, version='Audio Processor 0.1')
-        for key, value in self.settings.items():
-            new_key = key[2:]
-            self.settings[new_key] = self.settings.pop(key)
+    def __init__(self, argv=None):
+        defaults = self.strip_dashes(docopt(__doc__, argv=[]))
+        arguments = self.strip_dashes(docopt(__doc__, argv=argv,
+                                             version='Audio Processor 0.1'))
+        if argv is None:
+            argv = sys.argv[1:]
+        self.argv = list(argv)
+        self.settings = dict(defaults)
+        self.settings.update(self.read_ini(arguments['inifile']))
+        for key, value in arguments.items():
+            given = [arg for arg in argv
+                     if arg == '--' + key or arg.startswith('--' + key + '=')]
+            if given or value != defaults[key]:
+                self.settings[key] = value
+        self.config = Config(self.settings)
+
+    def reload(self):
+        # Same command line, fresh look at the ini file.
+        return Options(self.argv)
+
+    def with_settings(self, changes):
+        # A copy with some settings changed, checked like any other.
+        options = copy.copy(self)
+        options.settings = dict(self.settings)
+        options.settings.update(changes)
+        options.config = Config(options.settings)
+        return options
+
+    @staticmethod
+    def strip_dashes(arguments):
+        return dict((key[2:], value) for key, value in arguments.items())
+
+    @staticmethod
+    def read_ini(filename):
+        settings = {}
         config = configparser.ConfigParser(allow_no_value=True)
-        filename = self.settings['inifile']
         if os.path.isfile(filename) and config.read(filename)[0] == filename:
             for section in config.sections():
                 for key, value in config.items(section):
                     if value is None:
                         value = True
-                    # This is messy right now.  INI files will override default
-                    #  or arguments. Should be docopt defaults, which INI can
-                    # replace, which arguments can replace.
-                    self.settings[key] = value
+                    settings[key] = value
+        return settings
 
     def write_options_ini(self):
         config = configparser.ConfigParser(allow_no_value=True)
         config.add_section('soundcard')
         config.set('soundcard', 'inputdevice', self.settings['inputdevice'])
+        config.set('soundcard', 'inchannel', self.settings['inchannel'])
+        config.set('soundcard', 'infeatures', self.settings['infeatures'])
+        config.set('soundcard', 'inworker', self.settings['inworker'])
+        config.set('soundcard', 'inqueue', self.settings['inqueue'])
+        config.set('soundcard', 'rawformat', self.settings['rawformat'])
+        config.set('soundcard', 'rawjitter', self.settings['rawjitter'])
         config.set('soundcard', 'channels', self.settings['channels'])
         config.set('soundcard', 'samplerate', self.settings['samplerate'])
         config.set('soundcard', 'framesize', self.settings['framesize'])
+        config.add_section('capture')
+        config.set('capture', 'capturefile', self.settings['capturefile'])
+        config.set('capture', 'capturequeue', self.settings['capturequeue'])
+        config.set('capture', 'replayfile', self.settings['replayfile'])
+        config.set('capture', 'replayspeed', self.settings['replayspeed'])
         config.add_section('stdout')
         config.set('stdout', 'stdout', self.settings['stdout'])
         config.set('stdout', 'stdoutformat', self.settings['stdoutformat'])
@@ -282,7 +864,30 @@ class Options:
         config.set('midi', 'midiout', self.settings['midiout'])
         config.set('midi', 'outport', self.settings['outport'])
         config.set('midi', 'outchannel', self.settings['outchannel'])
+        config.set('midi', 'outbaud', self.settings['outbaud'])
+        config.set('midi', 'outfeatures', self.settings['outfeatures'])
+        config.set('midi', 'outmaxlag', self.settings['outmaxlag'])
+        config.set('midi', 'outlatency', self.settings['outlatency'])
+        config.set('midi', 'outqueue', self.settings['outqueue'])
+        config.set('midi', 'outqueuefull', self.settings['outqueuefull'])
+        config.set('midi', 'recordfile', self.settings['recordfile'])
+        config.set('midi', 'recordflush', self.settings['recordflush'])
         config.set('midi', 'sysexmanf', self.settings['sysexmanf'])
+        config.add_section('osc')
+        config.set('osc', 'oscout', self.settings['oscout'])
+        config.set('osc', 'oschost', self.settings['oschost'])
+        config.set('osc', 'oscport', self.settings['oscport'])
+        config.set('osc', 'oscprefix', self.settings['oscprefix'])
+        config.add_section('board')
+        config.set('board', 'boardout', self.settings['boardout'])
+        config.set('board', 'boardfile', self.settings['boardfile'])
+        config.add_section('aggregate')
+        config.set('aggregate', 'aggregate', self.settings['aggregate'])
+        config.set('aggregate', 'asysexnum', self.settings['asysexnum'])
+        config.add_section('state')
+        config.set('state', 'statefile', self.settings['statefile'])
+        config.set('state', 'statesave', self.settings['statesave'])
+        config.set('state', 'statemaxage', self.settings['statemaxage'])
         config.add_section('tempo')
         config.set('tempo', 'gettempo', self.settings['gettempo'])
         config.set('tempo', 'talg', self.settings['talg'])
@@ -335,70 +940,180 @@ class Options:
         config.set('pitch', 'pnoteoff', self.settings['pnoteoff'])
         config.set('pitch', 'pcontrolnum', self.settings['pcontrolnum'])
         config.set('pitch', 'psysexnum', self.settings['psysexnum'])
+        config.add_section('autotune')
+        config.set('autotune', 'tunecpu', self.settings['tunecpu'])
+        config.set('autotune', 'tunelatency', self.settings['tunelatency'])
 
         if os.path.exists(self.settings['inifile']):
             os.rename(self.settings['inifile'],
                       self.settings['inifile'] + "." + dt.now().strftime("%s"))
-        with open(self.settings['inifile'], 'wb') as configfile:
+        with open(self.settings['inifile'], 'w') as configfile:
             config.write(configfile)
 
 
+def event_type(name, fields):
+    # Every event ends with the index of the input device it came from,
+    # which is 0 unless it's left out.
+    event_class = namedtuple(name, fields + ' input_index')
+    event_class.__new__.__defaults__ = (0,)
+    return event_class
+
+
+TempoEvent = event_type('TempoEvent', 'time bpm average_bpm steady_bpm')
+BeatEvent = event_type('BeatEvent', 'time position value')
+RMSEvent = event_type('RMSEvent', 'time rms level')
+FrequenciesEvent = event_type('FrequenciesEvent', 'time energies levels')
+PitchEvent = event_type('PitchEvent', 'time pitch confidence')
+NoteEvent = event_type('NoteEvent', 'time note previous_note')
+BlockEvent = event_type('BlockEvent', 'time frames')
+SummaryEvent = event_type('SummaryEvent',
+                          'time position part level levels note')
+
+
+class FeatureBus:
+    """Hands feature events from the audio processors to whoever is listening.
+
+    The audio processors don't know anything about MIDI anymore. When one of
+    them comes up with something--a tempo, a beat, an RMS value, band
+    strengths, a pitch--it publishes an event, and every subscriber that
+    asked for that type of event gets called with it. The MidiEncoder and
+    the OscProcessor are just subscribers, and so is anything a library user
+    wants to hook up.
+
+    The events are namedtuples, so they're cheap to make and can be passed
+    around without worrying about someone changing them:
+
+    TempoEvent(time, bpm, average_bpm, steady_bpm)
+        bpm is this run's value (pulled into 60-187), average_bpm is the
+        running average, steady_bpm the most common recent average.
+    BeatEvent(time, position, value)
+        position in the beat sequence, and the configured value for it.
+    RMSEvent(time, rms, level)
+        raw RMS, and as a fraction of the loudest so far.
+    FrequenciesEvent(time, energies, levels)
+        numpy arrays of raw band energies and 0.0-1.0 levels, low to high.
+    PitchEvent(time, pitch, confidence)
+        aubio's pitch as a float MIDI note, and its confidence.
+    NoteEvent(time, note, previous_note)
+        the voted on note changed. -1 means no note.
+    SummaryEvent(time, position, part, level, levels, note)
+        with aggregate on, what was heard since the last beat (or part of
+        one): average RMS level and band levels, and the note heard for the
+        most blocks (-1 for none). position is the beat's, part counts from
+        0 within the beat.
+    BlockEvent(time, frames)
+        a block of audio has been handed to every audio processor, and
+        everything it produced has been published.
+
+    Every event also has input_index last: which input device it came from
+    (0 for the first, or the only one), which is the FeatureBus's own
+    input_index. With several devices, each has a FeatureBus of its own.
+
+    Time is stream time, in seconds of audio since the stream started, as
+    of the end of the block that produced the event. While the events for a
+    block are being published, capture_time is when the end of that block
+    reached the sound card, on the monotonic clock (worked out from the
+    callback's timestamps), or None when there isn't one.
+
+    Subscribers are called from the audio thread, so they should be quick
+    about it. If there is real work to do, subscribe a queue instead and
+    deal with it elsewhere.
+
+    """
+
+    def __init__(self, input_index=0):
+        self.subscribers = []
+        self.input_index = input_index
+        self.stream_time = 0.0
+        self.capture_time = None
+
+    def subscribe(self, handler, event_types=None, owner=None):
+        if event_types is not None:
+            event_types = tuple(event_types)
+        # Replace the list rather than append to it, so publish never sees
+        # it change halfway through.
+        self.subscribers = self.subscribers + [
+            (handler, event_types, owner or handler)]
+        return handler
+
+    def unsubscribe(self, handler_or_owner):
+        self.subscribers = [subscriber for subscriber in self.subscribers
+                            if subscriber[2] is not handler_or_owner]
+
+    def replace(self, old_owner, handler, event_types=None, owner=None):
+        # Swap one subscriber for another in a single step, so no event goes
+        # to both of them or to neither.
+        if event_types is not None:
+            event_types = tuple(event_types)
+        new_subscriber = (handler, event_types, owner or handler)
+        subscribers = []
+        for subscriber in self.subscribers:
+            if subscriber[2] is old_owner:
+                subscribers.append(new_subscriber)
+                new_subscriber = None
+            else:
+                subscribers.append(subscriber)
+        if new_subscriber is not None:
+            subscribers.append(new_subscriber)
+        self.subscribers = subscribers
+        return handler
+
+    def publish(self, event):
+        for handler, event_types, owner in self.subscribers:
+            if event_types is None or isinstance(event, event_types):
+                handler(event)
+
+
+def make_tempo_object(algorithm, window, hop, samplerate):
+    # aubio's tempo object, or the NumPy stand in from flux.py.
+    if algorithm == 'flux':
+        return flux.FluxTempo(window, hop, samplerate)
+    return aubio.tempo(algorithm, window, hop, samplerate)
+
+
+def share_tempo_object(beat_finder, tempo_finder):
+    # With both on flux, the tempo finder follows the beats finder's
+    # FluxTempo instead of running its own. If the beats finder it followed
+    # goes away, it takes that FluxTempo over, so nothing is lost.
+    if tempo_finder is None:
+        return
+    tempo_object = tempo_finder.tempo_object
+    if isinstance(tempo_object, flux.FluxFollower):
+        if beat_finder is not None and \
+                beat_finder.beat_object is tempo_object.leader:
+            return
+        tempo_object = tempo_object.leader
+    if beat_finder is not None and \
+            isinstance(tempo_object, flux.FluxTempo) and \
+            isinstance(beat_finder.beat_object, flux.FluxTempo):
+        tempo_object = flux.FluxFollower(beat_finder.beat_object)
+    tempo_finder.tempo_object = tempo_object
+
+
 class TempoFinder:
-    """Tempo finder object that receives frames and sends MIDI messages.
+    """Tempo finder object that receives frames and publishes tempo events.
 
     Sticky object that initializes with the Aubio tempo object, as adjusted
     by the many configuration options that are available. Sets up a holder
     for incoming frames of audio data.  Once there are enough frames to work
     with, the data is combined and processed by the tempo object. Results
-    are cleaned up, and MIDI messages as configured are sent out.
-
-    There appear to be many ways of trying to send this information via MIDI.
-    The issue is that MIDI data bytes are 0-127. Two options are built in.
-    One, just subtract 60 from the rounded BPM value and use that. On the
-    receiving end, just add 60 back to the value and there you go. Another
-    option is to spread the number out across two 7 bit bytes (that sounds
-    wrong), which is the default for sysex messages. The BPM is multiplied
-    by 10, rounded, then bit shifted across two bytes. On the receiving end,
-    reassemble to value like this:
-
-    (first_data_byte*128)+second_data_byte) / 10.0
+    are cleaned up and published as a TempoEvent.
 
     """
 
     def __init__(self, options):
-        self.tempo_object = tempo(options.settings['talg'],
-                                  int(float(options.settings['framesize']) *
-                                      float(options.settings['tframemult'])),
-                                  int(float(options.settings['framesize']) *
-                                      float(options.settings['tframemult']) *
-                                      float(options.settings['thopmult'])),
-                                  int(float(options.settings['samplerate'])))
-        self.frame_arrays = np.zeros(
-            (int(float(options.settings['tframemult'])),
-             int(float(options.settings['framesize']))),
-            dtype=np.float32)
-        self.midi_processor = None
-        self.sysex_command_array = []
-        for command in options.settings['tsysexnum'].split(' '):
-            self.sysex_command_array.append(int(command, 0))
-        self.bpm_sysex_rule = self.bpm_to_two_bytes
-        if options.settings['tsysextype'] == 'twobytes':
-            self.bpm_sysex_rule = self.bpm_to_two_bytes
-        elif options.settings['tsysextype'] == 'minus60':
-            self.bpm_sysex_rule = self.bpm_minus_sixty
-        self.control_number = False
-        if options.settings['tcontrolnum'] != 'None':
-            self.control_number = int(options.settings['tcontrolnum'], 0)
-        self.bpm_control_rule = self.bpm_minus_sixty
-        if options.settings['tcontroltype'] == 'minus60':
-            self.bpm_control_rule = self.bpm_minus_sixty
+        config = options.config
+        self.tempo_object = make_tempo_object(config.talg, config.twindow,
+                                              config.thop, config.samplerate)
+        self.frame_arrays = np.zeros((config.tframemult, config.framesize),
+                                     dtype=np.float32)
+        self.feature_bus = None
         self.frame_count = 0
         self.BPMs = []
         self.average_BPMs = []
-        self.last_BPM = 0.0
-        self.average = int(options.settings['taverage'])
-        self.count = int(options.settings['tcount'])
-        self.frame_multiplier = int(options.settings['tframemult'])
+        self.average = config.taverage
+        self.count = config.tcount
+        self.frame_multiplier = config.tframemult
 
     def add_frame(self, frame_array):
         self.frame_arrays[self.frame_count] = frame_array
@@ -418,48 +1133,37 @@ class TempoFinder:
             self.BPMs.append(bpm)
             if len(self.BPMs) > self.average:
                 del self.BPMs[0]
-            self.average_BPMs.append(round(sum(self.BPMs) /
-                                           len(self.BPMs), 1))
+            average_bpm = sum(self.BPMs) / len(self.BPMs)
+            self.average_BPMs.append(round(average_bpm, 1))
             if len(self.average_BPMs) > self.count:
                 del self.average_BPMs[0]
             most_bpm, foo = Counter(self.average_BPMs).most_common(1)[0]
-            if most_bpm != self.last_BPM:
-                self.last_BPM = most_bpm
-                if self.control_number:
-                    self.midi_processor.add_control_message(
-                        self.control_number, self.bpm_control_rule(most_bpm)[0]
-                    )
-                if self.sysex_command_array:
-                    self.midi_processor.add_sysex_message(
-                        self.sysex_command_array,
-                        self.bpm_sysex_rule(most_bpm)
-                    )
+            self.feature_bus.publish(TempoEvent(self.feature_bus.stream_time,
+                                                bpm, average_bpm, most_bpm,
+                                                self.feature_bus.input_index))
             self.frame_count = 0
 
-    @staticmethod
-    def bpm_to_two_bytes(bpm):
-        bpm = int(bpm * 10)
-        bytesarray = [bpm >> 7, bpm & 0x7F]
-        return bytesarray
+    def save_state(self):
+        # The last BPMs and averages, so a restart has a steady BPM to go on
+        # right away.
+        return {'bpms': list(self.BPMs),
+                'average_bpms': list(self.average_BPMs)}
 
-    @staticmethod
-    def bpm_minus_sixty(bpm):
-        bpm = int(bpm - 60)
-        if bpm < 0:
-            bpm = 0
-        elif bpm > 127:
-            bpm = 127
-        return [bpm]
+    def load_state(self, state):
+        if 'bpms' in state and 'average_bpms' in state:
+            self.BPMs = list(state['bpms'])[-self.average:]
+            self.average_BPMs = [round(bpm, 1) for bpm in
+                                 state['average_bpms']][-self.count:]
 
 
 class BeatFinder:
-    """Beat finder object that receives frames and sends MIDI messages.
+    """Beat finder object that receives frames and publishes beat events.
 
     Sticky object that initializes with the Aubio tempo object, as adjusted
     by the many configuration options that are available. Sets up a holder
     for incoming frames of audio data.  Once there are enough frames to work
-    with, the data is combined and processed by the tempo object. Results
-    are cleaned up, and MIDI messages as configured are sent out.
+    with, the data is combined and processed by the tempo object. Each beat
+    found is published as a BeatEvent.
 
     TODO: Add a mechanism for sending 24 clock tick messages. Trivial to
     just send 24 messages to the MidiProcessor right away after a beat,
@@ -471,32 +1175,16 @@ class BeatFinder:
     """
 
     def __init__(self, options):
-        self.beat_object = tempo(options.settings['balg'],
-                                 int(float(options.settings['framesize']) *
-                                     float(options.settings['bframemult'])),
-                                 int(float(options.settings['framesize']) *
-                                     float(options.settings['bframemult']) *
-                                     float(options.settings['bhopmult'])),
-                                 int(float(options.settings['samplerate'])))
-        self.frame_arrays = np.zeros(
-            (int(float(options.settings['bframemult'])),
-             int(float(options.settings['framesize']))),
-            dtype=np.float32)
-        self.midi_processor = None
-        self.sysex_command_array = []
-        for command in options.settings['bsysexnum'].split(' '):
-            self.sysex_command_array.append(int(command, 0))
-        self.control_number = False
-        if options.settings['bcontrolnum'] != 'None':
-            self.control_number = int(options.settings['bcontrolnum'], 0)
-        self.beat_sequence = []
-        for item in options.settings['bvaltype'].split(','):
-            self.beat_sequence.append(int(item.strip()))
-        if not self.beat_sequence:
-            self.beat_sequence = [64]
+        config = options.config
+        self.beat_object = make_tempo_object(config.balg, config.bwindow,
+                                             config.bhop, config.samplerate)
+        self.frame_arrays = np.zeros((config.bframemult, config.framesize),
+                                     dtype=np.float32)
+        self.feature_bus = None
+        self.beat_sequence = config.bvaltype
         self.beat_sequence_position = 0
         self.frame_count = 0
-        self.frame_multiplier = int(options.settings['bframemult'])
+        self.frame_multiplier = config.bframemult
 
     def add_frame(self, frame_array):
         self.frame_arrays[self.frame_count] = frame_array
@@ -505,15 +1193,11 @@ class BeatFinder:
             combined_array = np.ravel(self.frame_arrays)
             is_beat = self.beat_object(combined_array)
             if is_beat:
-                value_data = [self.beat_sequence[self.beat_sequence_position]]
-                if self.control_number:
-                    self.midi_processor.add_control_message(
-                        self.control_number, self.beat_sequence_position
-                    )
-                if self.sysex_command_array:
-                    self.midi_processor.add_sysex_message(
-                        self.sysex_command_array, value_data
-                    )
+                self.feature_bus.publish(BeatEvent(
+                    self.feature_bus.stream_time,
+                    self.beat_sequence_position,
+                    self.beat_sequence[self.beat_sequence_position],
+                    self.feature_bus.input_index))
                 self.beat_sequence_position += 1
                 if self.beat_sequence_position == len(self.beat_sequence):
                     self.beat_sequence_position = 0
@@ -521,35 +1205,25 @@ class BeatFinder:
 
 
 class RMSFinder:
-    """RMS finder object that receives frames and sends MIDI messages.
+    """RMS finder object that receives frames and publishes RMS events.
 
     Sticky object that sets up a holder for incoming frames of audio data.
     Once there are enough frames to work with, the data is combined and
-    processed by the filter object. Results are cleaned up, and MIDI messages
-    as configured are sent out.
+    the RMS is worked out. It's published as an RMSEvent, both as is and as
+    a fraction of the loudest RMS seen so far.
 
     This function does not rely on the Aubio library.
 
     """
 
     def __init__(self, options):
-        self.midi_processor = None
-        self.sysex_rms_command_array = []
-        for command in options.settings['rsysexnum'].split(' '):
-            self.sysex_rms_command_array.append(int(command, 0))
-        self.rms_control_number = False
-        if options.settings['rcontrolnum'] != 'None':
-            self.rms_control_number = \
-                int(options.settings['rcontrolnum'], 0)
-        self.frame_arrays = np.zeros(
-            (int(float(options.settings['rframemult'])),
-             int(float(options.settings['framesize']))),
-            dtype=np.float32)
+        config = options.config
+        self.feature_bus = None
+        self.frame_arrays = np.zeros((config.rframemult, config.framesize),
+                                     dtype=np.float32)
         self.frame_count = 0
         self.max_rms = 0
-        self.last_scaled_rms = 0
-        self.frame_multiplier = int(options.settings['rframemult'])
-        self.graceful = float(options.settings['rgraceful'])
+        self.frame_multiplier = config.rframemult
 
     def add_frame(self, frame_array):
         self.frame_arrays[self.frame_count] = frame_array
@@ -561,18 +1235,16 @@ class RMSFinder:
             if rms > self.max_rms:
                 self.max_rms = rms
             if self.max_rms > 0:
-                scaled_rms = int(127 * (rms / self.max_rms))
-                if scaled_rms != self.last_scaled_rms:
-                    graceful_rms = int(self.last_scaled_rms * self.graceful)
-                    if scaled_rms < graceful_rms:
-                        scaled_rms = graceful_rms
-                    if self.rms_control_number:
-                        self.midi_processor.add_control_message(
-                            self.rms_control_number, scaled_rms)
-                    if self.sysex_rms_command_array:
-                        self.midi_processor.add_sysex_message(
-                            self.sysex_rms_command_array, [scaled_rms])
-                    self.last_scaled_rms = scaled_rms
+                self.feature_bus.publish(RMSEvent(
+                    self.feature_bus.stream_time, rms, rms / self.max_rms,
+                    self.feature_bus.input_index))
+
+    def save_state(self):
+        return {'max_rms': [self.max_rms]}
+
+    def load_state(self, state):
+        if state.get('max_rms'):
+            self.max_rms = state['max_rms'][0]
 
     @staticmethod
     def qmean(num):
@@ -580,13 +1252,14 @@ class RMSFinder:
 
 
 class FrequenciesFinder:
-    """Frequency finder object that receives frames and sends MIDI messages.
+    """Frequency finder object that receives frames and publishes band events.
 
     Sticky object that initializes with the Aubio filter object, as adjusted
     by the many configuration options that are available. Sets up a holder
     for incoming frames of audio data.  Once there are enough frames to work
     with, the data is combined and processed by the filter object. Results
-    are cleaned up, and MIDI messages as configured are sent out.
+    are cleaned up and published as a FrequenciesEvent. With falg set to
+    "pyramid", an OctavePyramid from pyramid.py does the filtering instead.
 
     Note that this is definitely the most challenging processing work, and
     there is potential memory leak issue as described below.
@@ -594,55 +1267,49 @@ class FrequenciesFinder:
     """
 
     def __init__(self, options):
-        if options.settings['fbuckets'] == 'third-octave':
-            options.settings['fbuckets'] = [22.4,
-                                            25, 31.5, 40, 50, 63,
-                                            80, 100, 125, 160, 200,
-                                            250, 315, 400, 500, 630,
-                                            800, 1000, 1250, 1600, 2000,
-                                            2500, 3150, 4000, 5000, 6300,
-                                            8000, 10000, 12500, 16000, 20000,
-                                            22390]
-        elif options.settings['fbuckets'] == 'octave':
-            options.settings['fbuckets'] = [22,
-                                            31.5, 63, 125, 250, 500,
-                                            1000, 2000, 4000, 8000, 16000,
-                                            22720]
-        self.midi_processor = None
-        self.sysex_command_array = []
-        for command in options.settings['fsysexnum'].split(' '):
-            self.sysex_command_array.append(int(command, 0))
-        self.filter_bank = filterbank(len(options.settings['fbuckets']) - 2,
-                                      (int(options.settings['framesize']) *
-                                       int(options.settings['fframemult'])))
-        self.frequencies = fvec(options.settings['fbuckets'])
-        self.filter_bank.set_triangle_bands(self.frequencies,
-                                            int(options.settings[
-                                                    'samplerate']))
-        self.phase_vocoder = pvoc(int(float(options.settings['framesize']) *
-                                      float(options.settings['fframemult'])),
-                                  int(float(options.settings['framesize']) *
-                                      float(options.settings['fframemult']) *
-                                      float(options.settings['fhopmult'])))
-
-        self.frame_arrays = np.zeros(
-            (int(float(options.settings['fframemult'])),
-             int(float(options.settings['framesize']))),
-            dtype=np.float32)
+        config = options.config
+        self.feature_bus = None
+        # What the maxima depend on, so saved ones are only used if they
+        # still mean the same thing. The pyramid has no one window, so it's
+        # 0 there.
+        self.band_settings = [config.samplerate, config.fwindow] + \
+            list(config.fbuckets)
+        if config.falg == 'pyramid':
+            self.band_energies = pyramid.OctavePyramid(config.fbuckets,
+                                                       config.samplerate)
+            self.band_settings[1] = 0
+        else:
+            self.filter_bank = aubio.filterbank(config.fbands,
+                                                config.fwindow)
+            self.frequencies = aubio.fvec(config.fbuckets)
+            self.filter_bank.set_triangle_bands(self.frequencies,
+                                                config.samplerate)
+            self.phase_vocoder = aubio.pvoc(config.fwindow, config.fhop)
+            self.band_energies = self.filter_bank_energies
+
+        self.frame_arrays = np.zeros((config.fframemult, config.framesize),
+                                     dtype=np.float32)
         self.frame_count = 0
-        self.maximum_frequencies = np.zeros(
-            (len(options.settings['fbuckets']) - 2,), dtype=np.float32)
-        self.last_energies = np.zeros((len(options.settings['fbuckets']) - 2,),
-                                      dtype=np.float32)
-        self.count_energies = np.zeros((int(options.settings['fcount']),
-                                        (len(options.settings[
-                                                 'fbuckets']) - 2)),
+        self.maximum_frequencies = np.zeros((config.fbands,),
+                                            dtype=np.float32)
+        self.last_energies = np.zeros((config.fbands,), dtype=np.float32)
+        self.count_energies = np.zeros((config.fcount, config.fbands),
                                        dtype=np.float32)
         self.energy_count = 0
         self.rest_stop = 0
-        self.frame_multiplier = int(options.settings['fframemult'])
-        self.count = int(options.settings['fcount'])
-        self.graceful = float(options.settings['fgraceful'])
+        self.frame_multiplier = config.fframemult
+        self.count = config.fcount
+        self.graceful = config.fgraceful
+
+    def filter_bank_energies(self, samples):
+        # This is causing a memory leak on a OSX Brew installed version of
+        # Aubio, at least according to "top". Even creating and destroying
+        # the phase vocoder each time through the loop doesn't seem to
+        # solve the problem. I believe the intent is for the phase vocoder
+        # to hold previous runs to match up previous calls with data, but
+        # it appears to be a little too sticky.
+        fftgrain = self.phase_vocoder(samples)
+        return self.filter_bank(fftgrain)
 
     def add_frame(self, frame_array):
         self.frame_arrays[self.frame_count] = frame_array
@@ -650,89 +1317,65 @@ class FrequenciesFinder:
         if self.frame_count == self.frame_multiplier:
             self.frame_count = 0
             combined_array = np.ravel(self.frame_arrays)
-            # This is causing a memory leak on a OSX Brew installed version of
-            # Aubio, at least according to "top". Even creating and destroying
-            # the phase vocoder each time through the loop doesn't seem to
-            # solve the problem. I believe the intent is for the phase vocoder
-            # to hold previous runs to match up previous calls with data, but
-            # it appears to be a little too sticky.
-            fftgrain = self.phase_vocoder(combined_array)
-            self.count_energies[self.energy_count] = self.filter_bank(fftgrain)
+            self.count_energies[self.energy_count] = \
+                self.band_energies(combined_array)
             self.energy_count += 1
             if self.energy_count == self.count:
                 self.energy_count = 0
-                energies = np.amax(self.count_energies, axis=0)
-                self.maximum_frequencies = np.maximum(energies,
+                band_energies = np.amax(self.count_energies, axis=0)
+                self.maximum_frequencies = np.maximum(band_energies,
                                                       self.maximum_frequencies)
-                energies = np.divide(energies, self.maximum_frequencies)
+                # A band that's had nothing yet (the pyramid's deepest ones,
+                # before their first hop) stays at 0 rather than 0/0.
+                energies = np.divide(band_energies, self.maximum_frequencies,
+                                     out=np.zeros_like(band_energies),
+                                     where=self.maximum_frequencies > 0)
                 energies = np.maximum(energies, self.last_energies)
                 self.last_energies = energies * self.graceful
-                energies *= 127.0
-                int_energies = energies.astype(int)
-                if self.sysex_command_array:
-                    self.midi_processor.add_sysex_message(
-                        self.sysex_command_array, int_energies)
+                self.feature_bus.publish(FrequenciesEvent(
+                    self.feature_bus.stream_time, band_energies, energies,
+                    self.feature_bus.input_index))
+
+    def save_state(self):
+        return {'maximum': self.maximum_frequencies.tolist(),
+                'settings': self.band_settings}
+
+    def load_state(self, state):
+        if state.get('settings') == self.band_settings and \
+                len(state.get('maximum', ())) == len(self.maximum_frequencies):
+            self.maximum_frequencies = np.array(state['maximum'],
+                                                dtype=np.float32)
 
 
 class PitchFinder:
-    """Pitch finder object that receives frames and sends MIDI messages.
+    """Pitch finder object that receives frames and publishes pitch events.
 
     Sticky object that initializes with the Aubio pitch object, as adjusted
     by the many configuration options that are available. Sets up a holder
     for incoming frames of audio data.  Once there are enough frames to work
-    with, the data is combined and processed by the pitch object. Results
-    are cleaned up, and MIDI messages as configured are sent out.
-
-    You can send (and probably should) both note_on and note_off messages
-    here.  Note_off messages are sent when an incoming note doesn't match
-    the previously sent one. The control and sysex message types on the other
-    hand only send when there is new note on information.
+    with, the data is combined and processed by the pitch object. Every
+    result is published as a PitchEvent. Results are also voted on, weighted
+    by confidence, and when the winning note changes a NoteEvent goes out.
 
     """
 
     def __init__(self, options):
-        self.algorithm = options.settings['palg']
-        self.frame_size = float(options.settings['framesize'])
-        self.frame_multiplier = int(options.settings['pframemult'])
-        self.hop_multiplier = float(options.settings['phopmult'])
-        self.samplerate = float(options.settings['samplerate'])
-        self.tolerance = float(options.settings['ptolerance'])
-        self.sysexnumber = options.settings['psysexnum']
-        self.sysex_command_array = []
-        if options.settings['psysexnum'] != 'None':
-            for command in options.settings['psysexnum'].split(' '):
-                self.sysex_command_array.append(int(command, 0))
-        self.control_number = False
-        if options.settings['pcontrolnum'] != 'None':
-            self.control_number = int(options.settings['pcontrolnum'], 0)
-        self.send_note_ons = False
-        if options.settings['pnoteon'] == 'True':
-            self.send_note_ons = True
-        if options.settings['pnoteoff'] == 'True':
-            self.send_note_offs = True
-        self.count = int(options.settings['pcount'])
-        self.low_cutoff = int(options.settings['plowcutoff'])
-        self.high_cutoff = int(options.settings['phighcutoff'])
-        self.fold_octaves = False
-        if options.settings['pfoldoctaves'] == 'True':
-            self.fold_octaves = True
-        self.num_offset = int(options.settings['pnumoffset'])
-        self.midi_processor = None
-
-        self.pitch_object = pitch(self.algorithm,
-                                  int(self.frame_size *
-                                      self.frame_multiplier),
-                                  int(self.frame_size *
-                                      self.frame_multiplier *
-                                      self.hop_multiplier),
-                                  int(self.samplerate))
-        if self.tolerance != 'None':
-            self.pitch_object.set_tolerance(self.tolerance)
+        config = options.config
+        self.frame_multiplier = config.pframemult
+        self.count = config.pcount
+        self.low_cutoff = config.plowcutoff
+        self.high_cutoff = config.phighcutoff
+        self.fold_octaves = config.pfoldoctaves
+        self.num_offset = config.pnumoffset
+        self.feature_bus = None
+
+        self.pitch_object = aubio.pitch(config.palg, config.pwindow,
+                                        config.phop, config.samplerate)
+        if config.ptolerance is not None:
+            self.pitch_object.set_tolerance(config.ptolerance)
         self.pitch_object.set_unit('midi')
-        self.frame_arrays = np.zeros(
-            (int(self.frame_multiplier),
-             int(self.frame_size)),
-            dtype=np.float32)
+        self.frame_arrays = np.zeros((config.pframemult, config.framesize),
+                                     dtype=np.float32)
         self.frame_count = 0
         self.most_pitches = [-1]
         self.pitch_count = 0
@@ -745,41 +1388,20 @@ class PitchFinder:
             self.frame_count = 0
             combined_array = np.ravel(self.frame_arrays)
             pitches = self.pitch_object(combined_array)
-            for x in range(
-                    int(round(self.pitch_object.get_confidence() * 10))):
+            confidence = self.pitch_object.get_confidence()
+            self.feature_bus.publish(PitchEvent(self.feature_bus.stream_time,
+                                                pitches[0], confidence,
+                                                self.feature_bus.input_index))
+            for x in range(int(round(confidence * 10))):
                 self.most_pitches.append(self.midify_pitch(pitches))
             self.pitch_count += 1
             if self.pitch_count == self.count:
                 self.pitch_count = 0
                 most_pitch, foo = Counter(self.most_pitches).most_common(1)[0]
                 if most_pitch != self.last_pitch:
-                    if most_pitch == -1:
-                        if self.send_note_offs:
-                            self.midi_processor.add_note_off_message(
-                                self.last_pitch)
-                    elif self.last_pitch == -1:
-                        if self.send_note_ons:
-                            self.midi_processor.add_note_on_message(most_pitch)
-                        if self.control_number:
-                            self.midi_processor.add_control_message(
-                                self.control_number, most_pitch)
-                        if self.sysex_command_array:
-                            self.midi_processor.add_sysex_message(
-                                self.sysex_command_array, [most_pitch]
-                            )
-                    else:
-                        if self.send_note_offs:
-                            self.midi_processor.add_note_off_message(
-                                self.last_pitch)
-                        if self.send_note_offs:
-                            self.midi_processor.add_note_on_message(most_pitch)
-                        if self.control_number:
-                            self.midi_processor.add_control_message(
-                                self.control_number, most_pitch)
-                        if self.sysex_command_array:
-                            self.midi_processor.add_sysex_message(
-                                self.sysex_command_array, [most_pitch]
-                            )
+                    self.feature_bus.publish(NoteEvent(
+                        self.feature_bus.stream_time, most_pitch,
+                        self.last_pitch, self.feature_bus.input_index))
                     self.last_pitch = most_pitch
                 self.most_pitches = [-1]
 
@@ -801,71 +1423,1120 @@ class PitchFinder:
         return _pitch
 
 
-class MidiProcessor:
-    """Wrapper class for receiving messages and sending out via mido library.
+class MidiEncoder:
+    """Turns feature events into MIDI messages for the MidiProcessor.
 
-    Sticky object that receives messages from the various audio processing
-    classes and MIDIfies them using the mido library.  Deals with
-    the custom manufacturer sysex prefix bytes.
+    This is where all the squeezing into 7 bits happens. It subscribes to
+    the FeatureBus like anything else, and for each event works out which
+    controller, sysex or note messages are configured and what values they
+    should carry. Messages are only sent when the MIDI value has actually
+    changed, so a steady tempo or a held note doesn't flood the port.
+
+    There appear to be many ways of trying to send a BPM via MIDI. The issue
+    is that MIDI data bytes are 0-127. Two options are built in. One, just
+    subtract 60 from the rounded BPM value and use that. On the receiving
+    end, just add 60 back to the value and there you go. Another option is
+    to spread the number out across two 7 bit bytes (that sounds wrong),
+    which is the default for sysex messages. The BPM is multiplied by 10,
+    rounded, then bit shifted across two bytes. On the receiving end,
+    reassemble to value like this:
+
+    (first_data_byte*128)+second_data_byte) / 10.0
+
+    RMS and frequency strengths come in as fractions of the loudest value
+    seen so far and go out as 0-127. RMS gets the graceful treatment here:
+    when it drops, it only drops so far each time.
+
+    For pitches you can send (and probably should) both note_on and
+    note_off messages. Note_off messages are sent when an incoming note
+    doesn't match the previously sent one. The control and sysex message
+    types on the other hand only send when there is new note on information.
+
+    With aggregate on, RMS, frequencies and pitch aren't sent as they come
+    in. The BeatAggregator sums them up, and each SummaryEvent goes out as
+    one sysex instead.
 
     """
 
-    def __init__(self, options):
+    def __init__(self, options, midi_processor):
+        self.midi_processor = midi_processor
+        config = options.config
+        self.tempo_control_number = config.tcontrolnum
+        self.tempo_sysex_command_array = config.tsysexnum
+        self.bpm_control_rule = self.bpm_minus_sixty
+        self.bpm_sysex_rule = self.bpm_to_two_bytes
+        if config.tsysextype == 'minus60':
+            self.bpm_sysex_rule = self.bpm_minus_sixty
+        self.last_BPM = 0.0
+        self.beat_control_number = config.bcontrolnum
+        self.beat_sysex_command_array = config.bsysexnum
+        self.rms_control_number = config.rcontrolnum
+        self.rms_sysex_command_array = config.rsysexnum
+        self.rms_graceful = config.rgraceful
+        self.last_scaled_rms = 0
+        self.frequencies_sysex_command_array = config.fsysexnum
+        self.pitch_control_number = config.pcontrolnum
+        self.pitch_sysex_command_array = config.psysexnum
+        self.send_note_ons = config.pnoteon
+        self.send_note_offs = config.pnoteoff
+        self.summary_sysex_command_array = config.asysexnum
+        self.handlers = {TempoEvent: self.handle_tempo,
+                         BeatEvent: self.handle_beat,
+                         BlockEvent: self.handle_block}
+        if config.aggregate is None:
+            self.handlers[RMSEvent] = self.handle_rms
+            self.handlers[FrequenciesEvent] = self.handle_frequencies
+            self.handlers[NoteEvent] = self.handle_note
+        else:
+            self.handlers[SummaryEvent] = self.handle_summary
+
+    def handle_event(self, event):
+        handler = self.handlers.get(type(event))
+        if handler:
+            self.midi_processor.stream_time = event.time
+            handler(event)
+
+    def handle_tempo(self, event):
+        if event.steady_bpm != self.last_BPM:
+            self.last_BPM = event.steady_bpm
+            if self.tempo_control_number is not None:
+                self.midi_processor.add_control_message(
+                    self.tempo_control_number,
+                    self.bpm_control_rule(event.steady_bpm)[0], 'tempo')
+            if self.tempo_sysex_command_array:
+                self.midi_processor.add_sysex_message(
+                    self.tempo_sysex_command_array,
+                    self.bpm_sysex_rule(event.steady_bpm), 'tempo')
+
+    def handle_beat(self, event):
+        if self.beat_control_number is not None:
+            self.midi_processor.add_control_message(
+                self.beat_control_number, event.position, 'beats')
+        if self.beat_sysex_command_array:
+            self.midi_processor.add_sysex_message(
+                self.beat_sysex_command_array, [event.value], 'beats')
+
+    def handle_rms(self, event):
+        scaled_rms = int(127 * event.level)
+        if scaled_rms != self.last_scaled_rms:
+            graceful_rms = int(self.last_scaled_rms * self.rms_graceful)
+            if scaled_rms < graceful_rms:
+                scaled_rms = graceful_rms
+            if self.rms_control_number is not None:
+                self.midi_processor.add_control_message(
+                    self.rms_control_number, scaled_rms, 'rms')
+            if self.rms_sysex_command_array:
+                self.midi_processor.add_sysex_message(
+                    self.rms_sysex_command_array, [scaled_rms], 'rms')
+            self.last_scaled_rms = scaled_rms
+
+    def handle_frequencies(self, event):
+        if self.frequencies_sysex_command_array:
+            int_energies = (event.levels * 127.0).astype(int)
+            self.midi_processor.add_sysex_message(
+                self.frequencies_sysex_command_array, int_energies,
+                'frequencies')
+
+    def handle_note(self, event):
+        if event.note == -1:
+            if self.send_note_offs:
+                self.midi_processor.add_note_off_message(event.previous_note,
+                                                         'pitch')
+            return
+        if event.previous_note != -1 and self.send_note_offs:
+            self.midi_processor.add_note_off_message(event.previous_note,
+                                                     'pitch')
+        if self.send_note_ons:
+            self.midi_processor.add_note_on_message(event.note, 'pitch')
+        if self.pitch_control_number is not None:
+            self.midi_processor.add_control_message(
+                self.pitch_control_number, event.note, 'pitch')
+        if self.pitch_sysex_command_array:
+            self.midi_processor.add_sysex_message(
+                self.pitch_sysex_command_array, [event.note], 'pitch')
+
+    def handle_summary(self, event):
+        if self.summary_sysex_command_array:
+            note = event.note
+            if note < 0:
+                note = 0
+            datas = [min(event.position, 127), min(event.part, 127),
+                     int(127 * event.level), note]
+            datas.extend((event.levels * 127.0).astype(int))
+            self.midi_processor.add_sysex_message(
+                self.summary_sysex_command_array, datas, 'summary')
+
+    def handle_block(self, event):
+        self.midi_processor.end_block()
+
+    @staticmethod
+    def bpm_to_two_bytes(bpm):
+        bpm = int(bpm * 10)
+        bytesarray = [bpm >> 7, bpm & 0x7F]
+        return bytesarray
+
+    @staticmethod
+    def bpm_minus_sixty(bpm):
+        bpm = int(bpm - 60)
+        if bpm < 0:
+            bpm = 0
+        elif bpm > 127:
+            bpm = 127
+        return [bpm]
+
+
+class MidiScheduler:
+    """Latest-value-wins holding pen for outgoing MIDI messages.
+
+    Every message is filed under a destination key--the controller number,
+    the sysex command, or the note on or off and its note--and a newer
+    message for the same destination simply overwrites one that hasn't made
+    it out yet. There is no point in sending an RMS value that is already
+    stale just because it got in line first. Overwritten messages are
+    counted as coalesced. A note on or off that overwrites one goes to the
+    back of the line instead, so it still comes out after anything for that
+    note that came in between.
+
+    Beats and notes go into an urgent lane that is always emptied before
+    anything else, so a burst of frequency sysex can't push a beat back.
+
+    Keys start with the index of the input device the message is about.
+    When several input devices share an output, the scheduler takes turns
+    between them within each lane, so a busy device can't crowd out a
+    quiet one.
+
+    Output is paced to the wire rate of the port. A DIN MIDI cable moves
+    31250 bits a second, and with start and stop bits that's 10 bits for
+    each byte, so roughly one byte every 320 microseconds. The scheduler
+    keeps track of when the wire will be free again and holds anything else
+    until then. Control changes and sysex that end up waiting longer than
+    the maximum lag are thrown away and counted as dropped. Notes never are:
+    a note off that never arrives leaves a note stuck on.
+
+    A message can also come with a due time (see outlatency). It waits in a
+    heap, out of the lanes, until then, so it doesn't overwrite an earlier
+    one for the same destination that isn't due yet. Once due, it goes into
+    its lane as if it had just been added, and the lag and latency are
+    counted from when it was due. Ones that were already past due when they
+    were added are counted as late.
+
+    """
+
+    # Kinds of key where only the latest value matters, so a stale one can
+    # be thrown away.
+    LATEST_VALUE = ('control', 'sysex')
+
+    def __init__(self, bytes_per_second, max_lag):
+        self.bytes_per_second = bytes_per_second
+        self.max_lag = max_lag
+        self.urgent = OrderedDict()
+        self.pending = OrderedDict()
+        self.waiting = []
+        self.waiting_sequence = 0
+        self.late_count = 0
+        self.wire_free_at = 0.0
+        self.last_source = None
+        self.several_sources = False
+        self.sent_count = 0
+        self.sent_by_input = Counter()
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add(self, key, mido_message, urgent=False, now=None,
+            stream_time=None, due=None):
+        if now is None:
+            now = monotonic()
+        if due is not None:
+            if due > now:
+                # The sequence number keeps messages due at the same time
+                # in order, and keeps heapq from comparing messages.
+                heapq.heappush(self.waiting, (due, self.waiting_sequence, key,
+                                              mido_message, urgent,
+                                              stream_time))
+                self.waiting_sequence += 1
+                return
+            self.late_count += 1
+            now = due
+        lane = self.urgent if urgent else self.pending
+        if key in lane:
+            self.coalesced_count += 1
+            if key[1] not in self.LATEST_VALUE:
+                del lane[key]
+        elif key[0]:
+            self.several_sources = True
+        lane[key] = (mido_message, now, stream_time)
+
+    def next_key(self, lane):
+        # The oldest message, or when several input devices are sharing
+        # the port, the oldest one from a different device than last time.
+        if self.several_sources:
+            for key in lane:
+                if key[0] != self.last_source:
+                    return key
+        return next(iter(lane))
+
+    def release(self, now=None):
+        # Moves waiting messages that are due by now into their lanes. None
+        # for all of them.
+        waiting = self.waiting
+        while waiting and (now is None or waiting[0][0] <= now):
+            due, sequence, key, mido_message, urgent, stream_time = \
+                heapq.heappop(waiting)
+            self.add(key, mido_message, urgent, due, stream_time)
+
+    def service(self, send, now=None):
+        if now is None:
+            now = monotonic()
+        if self.waiting:
+            self.release(now)
+        while self.urgent or self.pending:
+            if self.bytes_per_second and self.wire_free_at > now:
+                break
+            lane = self.urgent if self.urgent else self.pending
+            key = self.next_key(lane)
+            mido_message, queued, stream_time = lane.pop(key)
+            if self.max_lag and now - queued > self.max_lag and \
+                    key[1] in self.LATEST_VALUE:
+                self.dropped_count += 1
+                continue
+            send(mido_message, stream_time)
+            self.last_source = key[0]
+            self.sent_count += 1
+            self.sent_by_input[key[0]] += 1
+            latency = now - queued
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+            if self.bytes_per_second:
+                self.wire_free_at = (max(self.wire_free_at, now) +
+                                     len(mido_message.bytes()) /
+                                     self.bytes_per_second)
+
+    def next_send_time(self):
+        next_send = None
+        if self.urgent or self.pending:
+            next_send = self.wire_free_at
+        if self.waiting and (next_send is None or
+                             self.waiting[0][0] < next_send):
+            next_send = self.waiting[0][0]
+        return next_send
+
+    def stats(self):
+        average_latency = 0.0
+        if self.sent_count:
+            average_latency = self.latency_total / self.sent_count
+        return {'sent': self.sent_count,
+                'sent_by_input': dict(self.sent_by_input),
+                'coalesced': self.coalesced_count,
+                'dropped': self.dropped_count,
+                'late': self.late_count,
+                'pending': len(self.urgent) + len(self.pending) +
+                len(self.waiting),
+                'latency_average': average_latency,
+                'latency_max': self.latency_max}
+
+
+class OutputQueue:
+    """Bounded hand-off between the audio callback and the output thread.
+
+    A ring of slots that is allocated once up front, so queueing a message
+    from the audio callback never grows anything. The lock is only ever
+    held for a few assignments, so the callback doesn't wait on it in any
+    meaningful way--and it never waits on the output port itself.
+
+    When the ring is full something has to give. With the "dropoldest"
+    policy the oldest waiting message is overwritten, which is usually what
+    you want since it's the stalest. With "dropnewest" the incoming message
+    is thrown away instead. Either way it's counted as an overflow.
+
+    """
+
+    def __init__(self, size, policy='dropoldest'):
+        self.size = size
+        self.slots = [None] * size
+        self.head = 0
+        self.tail = 0
+        self.drop_oldest = policy != 'dropnewest'
+        self.lock = threading.Lock()
+        self.overflow_count = 0
+        self.high_water = 0
+
+    def put(self, item):
+        with self.lock:
+            depth = self.head - self.tail
+            if depth == self.size:
+                self.overflow_count += 1
+                if not self.drop_oldest:
+                    return False
+                self.tail += 1
+                depth -= 1
+            self.slots[self.head % self.size] = item
+            self.head += 1
+            if depth + 1 > self.high_water:
+                self.high_water = depth + 1
+        return True
+
+    def drain(self, handler):
+        # Takes everything out under the lock, but hands it over after, so
+        # a put() from the callback never waits on the handler.
+        items = []
+        with self.lock:
+            while self.tail != self.head:
+                index = self.tail % self.size
+                items.append(self.slots[index])
+                self.slots[index] = None
+                self.tail += 1
+        for item in items:
+            handler(item)
+
+    def depth(self):
+        return self.head - self.tail
+
+
+class MidiRecorder:
+    """Writes sent MIDI messages to a Standard MIDI File as they go out.
+
+    Timing comes from the audio stream rather than the wall clock, so the
+    recording lines up with the audio that produced it, no matter how late
+    the message actually left. The file is set up with 1000 ticks per beat
+    and a tempo of one beat a second, which makes every tick exactly one
+    millisecond of audio.
+
+    Messages are encoded into a buffer, and the buffer is written out every
+    few seconds (recordflush). Each write puts an end of track marker on the
+    end and fixes up the track length in the header, so the file on disk is
+    always a valid MIDI file, just missing whatever was still in the buffer.
+    This all happens in the MidiOutput's sender thread, not in the audio
+    callback. The sender checks every time it wakes up (at least ten times a
+    second), so the buffer still gets written out when nothing is being
+    sent.
+
+    """
+
+    END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+    def __init__(self, filename, flush_seconds):
+        self.record_file = open(filename, 'wb')
+        self.record_file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, 1000))
+        self.record_file.write(b'MTrk' + struct.pack('>I', 0))
+        self.track_start = self.record_file.tell()
+        self.track_length = 0
+        # Tempo meta event: 1,000,000 microseconds per beat.
+        self.buffer = bytearray(b'\x00\xff\x51\x03\x0f\x42\x40')
+        self.last_tick = 0
+        self.flush_seconds = flush_seconds
+        self.next_flush = monotonic() + flush_seconds
+
+    @staticmethod
+    def variable_length(value):
+        encoded = bytearray([value & 0x7F])
+        value >>= 7
+        while value:
+            encoded.insert(0, (value & 0x7F) | 0x80)
+            value >>= 7
+        return encoded
+
+    def write(self, mido_message, stream_time=None):
+        tick = self.last_tick
+        if stream_time is not None:
+            tick = max(self.last_tick, int(stream_time * 1000))
+        self.buffer += self.variable_length(tick - self.last_tick)
+        self.last_tick = tick
+        message_bytes = mido_message.bytes()
+        if message_bytes[0] == 0xF0:
+            self.buffer.append(0xF0)
+            self.buffer += self.variable_length(len(message_bytes) - 1)
+            self.buffer += bytearray(message_bytes[1:])
+        else:
+            self.buffer += bytearray(message_bytes)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        self.record_file.seek(self.track_start + self.track_length)
+        self.record_file.write(bytes(self.buffer) + self.END_OF_TRACK)
+        self.track_length += len(self.buffer)
+        del self.buffer[:]
+        self.record_file.seek(self.track_start - 4)
+        self.record_file.write(
+            struct.pack('>I', self.track_length + len(self.END_OF_TRACK)))
+        self.record_file.flush()
+        self.next_flush = monotonic() + self.flush_seconds
+
+    def close(self):
+        self.flush()
+        self.record_file.close()
+
+
+class MidiOutput:
+    """One MIDI output port, serviced on its own.
+
+    Each output has its own channel, its own list of features it wants, its
+    own wire rate, and its own OutputQueue, MidiScheduler and sender thread.
+    So a DIN interface crawling along at 31250 baud can't hold up a virtual
+    port that takes messages as fast as they come, and vice versa.
+
+    Messages aren't sent right away, and never from inside the audio
+    callback. They are dropped into the OutputQueue, and the sender thread
+    moves them into the MidiScheduler and sends whatever the wire has room
+    for. ProcessAudio pokes the sender once per block of audio so it wakes
+    up once with everything from that block rather than once for every
+    message. If the sender thread isn't running (say, when feeding the
+    callback by hand), calling send_pending does the same work in the
+    calling thread.
+
+    The first output also handles echoing to standard out and recording to
+    a MIDI file with a MidiRecorder, if either is turned on. Each message
+    carries the stream time of the event that produced it, and that's what
+    the recording is timed by. With outlatency set, each one also carries
+    when it's due, and the sender thread wakes up for the next one due.
+
+    """
+
+    def __init__(self, options, port_name, channel, baud, features,
+                 primary=False):
+        self.port_name = port_name
         self.midi_outport = None
-        self.sysex_prefix = []
-        for manf_byte in options.settings['sysexmanf'].split(' '):
-            self.sysex_prefix.append(int(manf_byte, 0))
-        for channel in options.settings['outchannel'].split(' '):
-            self.sysex_prefix.append(int(channel, 0) - 1)
-        self.channel = int(options.settings['outchannel']) - 1
+        self.channel = channel
+        if features is not None and [feature for feature in features
+                                     if feature in AGGREGATED_FEATURES]:
+            # Summaries go wherever what they sum up would have gone.
+            features = features + ('summary',)
+        self.features = features
+        config = options.config
+        self.scheduler = MidiScheduler(baud / 10.0, config.outmaxlag)
+        self.queue = OutputQueue(config.outqueue, config.outqueuefull)
+        self.wakeup = threading.Event()
+        self.sender_thread = None
+        self.running = False
+        self.stdout_batch = []
+        self.recorder = None
         self.stdout = False
-        if options.settings['stdout'] == 'True':
+        if not primary:
+            return
+        if config.recordfile is not None:
+            self.recorder = MidiRecorder(config.recordfile,
+                                         config.recordflush)
+        if config.stdout:
             self.stdout = True
-            if options.settings['stdoutformat'] == 'bytes':
+            if config.stdoutformat == 'bytes':
                 self.stdoutformat = 1
-            elif options.settings['stdoutformat'] == 'bin':
+            elif config.stdoutformat == 'bin':
                 self.stdoutformat = 2
-            elif options.settings['stdoutformat'] == 'hex':
+            elif config.stdoutformat == 'hex':
                 self.stdoutformat = 3
             else:
                 self.stdoutformat = 0
 
-    def add_control_message(self, control, value):
-        self.send_message(mido.Message('control_change',
-                                       channel=self.channel,
-                                       control=control,
-                                       value=value))
-
-    def add_note_on_message(self, note):
-        self.send_message(mido.Message('note_on',
-                                       channel=self.channel,
-                                       note=note))
-
-    def add_note_off_message(self, note):
-        self.send_message(mido.Message('note_off',
-                                       channel=self.channel,
-                                       note=note))
-
-    def add_sysex_message(self, commands, datas):
-        sysexdata = self.sysex_prefix[:]
-        for command in commands:
-            sysexdata.append(command)
-        for data in datas:
-            sysexdata.append(data)
-        self.send_message(mido.Message('sysex', data=sysexdata))
+    def wants(self, feature):
+        return self.features is None or feature in self.features
+
+    def end_block(self):
+        if self.running:
+            self.wakeup.set()
+        else:
+            self.send_pending()
 
-    def send_message(self, mido_message):
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.sender_thread = threading.Thread(target=self.run_sender)
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            self.sender_thread.join()
+            self.sender_thread = None
+        # Whatever isn't due yet goes now rather than never.
+        self.queue.drain(self.queue_message)
+        self.scheduler.release()
+        self.send_pending()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def run_sender(self):
+        while self.running:
+            timeout = .1
+            next_send = self.scheduler.next_send_time()
+            if next_send is not None:
+                timeout = max(0.0, min(timeout, next_send - monotonic()))
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            self.send_pending()
+            if self.recorder:
+                self.recorder.flush_if_due()
+
+    def queue_message(self, item):
+        key, mido_message, urgent, queued, stream_time, due = item
+        self.scheduler.add(key, mido_message, urgent, queued, stream_time,
+                           due)
+
+    def send_pending(self):
+        self.queue.drain(self.queue_message)
+        self.scheduler.service(self.send_message)
+        if self.stdout_batch:
+            sys.stdout.write(''.join(self.stdout_batch))
+            sys.stdout.flush()
+            del self.stdout_batch[:]
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        stats['port'] = self.port_name
+        stats['queue_depth'] = self.queue.depth()
+        stats['queue_high_water'] = self.queue.high_water
+        stats['queue_overflow'] = self.queue.overflow_count
+        return stats
+
+    def send_message(self, mido_message, stream_time=None):
         if self.midi_outport:
             self.midi_outport.send(mido_message)
+        if self.recorder:
+            self.recorder.write(mido_message, stream_time)
         if self.stdout:
             if self.stdoutformat == 0:
-                print(mido_message)
+                self.stdout_batch.append(str(mido_message) + '\n')
             elif self.stdoutformat == 1:
-                sys.stdout.write(str(mido_message.bytes()))
+                self.stdout_batch.append(str(mido_message.bytes()))
             elif self.stdoutformat == 2:
-                sys.stdout.write(mido_message.bin())
+                self.stdout_batch.append(mido_message.bin())
             elif self.stdoutformat == 3:
-                sys.stdout.write(mido_message.hex() + ' ')
+                self.stdout_batch.append(mido_message.hex() + ' ')
+
+
+class MidiProcessor:
+    """Wrapper class for receiving messages and sending out via mido library.
+
+    Sticky object that receives messages from the various audio processing
+    classes and MIDIfies them using the mido library.  Deals with
+    the custom manufacturer sysex prefix bytes.
+
+    There can be several MidiOutputs--say beats to a lighting desk on a DIN
+    interface, and frequencies and RMS to a visualizer on a virtual port.
+    outport, outchannel, outbaud and outfeatures all take comma separated
+    lists, one entry per port (a single entry applies to every port). Each
+    message is built once for each channel that needs it and the same
+    message object is handed to every output on that channel that wants the
+    feature. Beat messages and notes are marked urgent so they jump the line
+    on every output.
+
+    With several input devices, they all share the one MidiProcessor, each
+    through its own MidiSource, which marks the messages with the device
+    and (with inchannel) sends them on the device's channel instead.
+
+    With outlatency set, every message is due outlatency seconds after the
+    capture time of the block that produced it, so they all go out the same
+    time after the sound no matter how long the analysis took or where in
+    its window the block fell.
+
+    """
+
+    def __init__(self, options):
+        config = options.config
+        self.sysex_manufacturer = list(config.sysexmanf)
+        self.latency = config.outlatency
+        self.set_urgent(config)
+        self.outputs = []
+        for port_name, channel, baud, features in config.outputs:
+            self.outputs.append(MidiOutput(options, port_name, channel, baud,
+                                           features,
+                                           primary=not self.outputs))
+        self.stream_time = None
+        self.capture_time = None
+
+    def set_urgent(self, config):
+        urgent_controls = []
+        if config.bcontrolnum is not None:
+            urgent_controls.append(config.bcontrolnum)
+        urgent_sysex_commands = []
+        if config.bsysexnum:
+            urgent_sysex_commands.append(config.bsysexnum)
+        self.urgent_controls = urgent_controls
+        self.urgent_sysex_commands = urgent_sysex_commands
+
+    def fan_out(self, feature, key, urgent, build_message, source=None):
+        messages = {}
+        queued = monotonic()
+        index = 0
+        source_channel = None
+        stream_time = self.stream_time
+        capture_time = self.capture_time
+        if source is not None:
+            index = source.index
+            source_channel = source.channel
+            stream_time = source.stream_time
+            capture_time = source.capture_time
+        due = None
+        if self.latency is not None:
+            if capture_time is None:
+                capture_time = queued
+            due = capture_time + self.latency
+        key = (index,) + key
+        for output in self.outputs:
+            if output.wants(feature):
+                channel = output.channel
+                if source_channel is not None:
+                    channel = source_channel
+                if channel not in messages:
+                    messages[channel] = build_message(channel)
+                output.queue.put((key, messages[channel], urgent, queued,
+                                  stream_time, due))
+
+    def add_control_message(self, control, value, feature=None, source=None):
+        self.fan_out(feature, ('control', control),
+                     control in self.urgent_controls,
+                     lambda channel: mido.Message('control_change',
+                                                  channel=channel,
+                                                  control=control,
+                                                  value=value), source)
+
+    def add_note_on_message(self, note, feature=None, source=None):
+        self.fan_out(feature, ('note_on', note), True,
+                     lambda channel: mido.Message('note_on',
+                                                  channel=channel,
+                                                  note=note), source)
+
+    def add_note_off_message(self, note, feature=None, source=None):
+        self.fan_out(feature, ('note_off', note), True,
+                     lambda channel: mido.Message('note_off',
+                                                  channel=channel,
+                                                  note=note), source)
+
+    def add_sysex_message(self, commands, datas, feature=None, source=None):
+        commands = tuple(commands)
+        payload = list(commands)
+        for data in datas:
+            payload.append(data)
+
+        def build_message(channel):
+            return mido.Message('sysex', data=self.sysex_manufacturer +
+                                [channel] + payload)
+
+        self.fan_out(feature, ('sysex', commands),
+                     commands in self.urgent_sysex_commands, build_message,
+                     source)
+
+    def end_block(self):
+        for output in self.outputs:
+            output.end_block()
+
+    def start(self):
+        for output in self.outputs:
+            output.start()
+
+    def stop(self):
+        for output in self.outputs:
+            output.stop()
+
+    def send_pending(self):
+        for output in self.outputs:
+            output.send_pending()
+
+    def stats(self):
+        output_stats = [output.stats() for output in self.outputs]
+        stats = {'outputs': output_stats}
+        for name in ('sent', 'coalesced', 'dropped', 'late', 'pending',
+                     'queue_overflow'):
+            stats[name] = sum(output[name] for output in output_stats)
+        sent_by_input = Counter()
+        for output in output_stats:
+            sent_by_input.update(output['sent_by_input'])
+        stats['sent_by_input'] = dict(sent_by_input)
+        return stats
+
+
+class MidiSource:
+    """One input device's way in to a shared MidiProcessor.
+
+    Looks just like a MidiProcessor to the MidiEncoder, but every message
+    is marked with the device's index, so the schedulers can take turns
+    between devices and one device's RMS doesn't overwrite another's, and
+    goes out on the device's channel if it has one. It also keeps its own
+    stream time and capture time, since each device has its own stream.
+
+    """
+
+    def __init__(self, midi_processor, index, channel):
+        self.midi_processor = midi_processor
+        self.index = index
+        self.channel = channel
+        self.stream_time = None
+        self.capture_time = None
+
+    def add_control_message(self, control, value, feature=None):
+        self.midi_processor.add_control_message(control, value, feature,
+                                                self)
+
+    def add_note_on_message(self, note, feature=None):
+        self.midi_processor.add_note_on_message(note, feature, self)
+
+    def add_note_off_message(self, note, feature=None):
+        self.midi_processor.add_note_off_message(note, feature, self)
+
+    def add_sysex_message(self, commands, datas, feature=None):
+        self.midi_processor.add_sysex_message(commands, datas, feature, self)
+
+    def end_block(self):
+        self.midi_processor.end_block()
+
+
+class OscProcessor:
+    """Sends feature values as OSC messages over UDP.
+
+    A sibling of the MidiProcessor for when the thing listening is on the
+    same computer or the same network. MIDI squeezes everything into 7 bits;
+    OSC just sends the float. It subscribes to the FeatureBus, adds a
+    message for each event as it comes in, and on the BlockEvent at the end
+    of each block of audio wraps everything from that block into one OSC
+    bundle and sends it as a single UDP datagram.
+
+    The OSC encoding is simple enough to do by hand with struct, so there's
+    no extra library to install. Addresses, under the configured prefix:
+
+    /bpm f          averaged BPM
+    /beat i         position in the beat sequence
+    /rms ff         raw RMS, and RMS as a fraction of the loudest so far
+    /frequencies f* strength of each band, 0.0-1.0, low to high
+    /pitch ff       MIDI note as a float, and aubio's confidence in it
+
+    """
+
+    def __init__(self, options):
+        self.address = (options.config.oschost, options.config.oscport)
+        prefix = options.config.oscprefix.rstrip('/')
+        self.bpm_address = self.osc_string(prefix + '/bpm')
+        self.beat_address = self.osc_string(prefix + '/beat')
+        self.rms_address = self.osc_string(prefix + '/rms')
+        self.frequencies_address = self.osc_string(prefix + '/frequencies')
+        self.pitch_address = self.osc_string(prefix + '/pitch')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.bundle = bytearray()
+        self.message_count = 0
+        self.sent_count = 0
+        self.error_count = 0
+        self.handlers = {TempoEvent: self.handle_tempo,
+                         BeatEvent: self.handle_beat,
+                         RMSEvent: self.handle_rms,
+                         FrequenciesEvent: self.handle_frequencies,
+                         PitchEvent: self.handle_pitch,
+                         BlockEvent: self.handle_block}
+
+    @staticmethod
+    def osc_string(value):
+        if not isinstance(value, bytes):
+            value = value.encode('ascii')
+        return value + b'\0' * (4 - len(value) % 4)
+
+    def add_message(self, address, type_tags, values):
+        message = (address + self.osc_string(',' + type_tags) +
+                   struct.pack('>' + type_tags, *values))
+        self.bundle += struct.pack('>i', len(message))
+        self.bundle += message
+        self.message_count += 1
+
+    def handle_event(self, event):
+        handler = self.handlers.get(type(event))
+        if handler:
+            handler(event)
+
+    def handle_tempo(self, event):
+        self.add_message(self.bpm_address, 'f', (event.average_bpm,))
+
+    def handle_beat(self, event):
+        self.add_message(self.beat_address, 'i', (event.position,))
+
+    def handle_rms(self, event):
+        self.add_message(self.rms_address, 'ff', (event.rms, event.level))
+
+    def handle_frequencies(self, event):
+        self.add_message(self.frequencies_address, 'f' * len(event.levels),
+                         event.levels)
+
+    def handle_pitch(self, event):
+        self.add_message(self.pitch_address, 'ff',
+                         (event.pitch, event.confidence))
+
+    def handle_block(self, event):
+        self.end_block()
+
+    def end_block(self):
+        if not self.message_count:
+            return
+        # "#bundle", then a time tag of 1, which OSC says means "right now".
+        datagram = b'#bundle\0' + struct.pack('>II', 0, 1) + self.bundle
+        del self.bundle[:]
+        self.message_count = 0
+        try:
+            self.socket.sendto(datagram, self.address)
+            self.sent_count += 1
+        except socket.error:
+            self.error_count += 1
+
+    def stats(self):
+        return {'sent': self.sent_count,
+                'errors': self.error_count}
+
+
+class FeatureBoard:
+    """Keeps the latest value of every feature in a memory-mapped file.
+
+    Another FeatureBus subscriber. As events come in, their values are
+    packed into a staging copy of the board body. On each BlockEvent the
+    sequence number goes odd, the staging copy is written into the mapped
+    file in one slice, and the sequence number goes even again. That's the
+    writing half of the seqlock described in board.py, which also has the
+    layout and a reader for other programs to use.
+
+    """
+
+    def __init__(self, options, band_count):
+        self.layout = board.BoardLayout(band_count)
+        self.board_file = open(options.config.boardfile, 'w+b')
+        self.board_file.truncate(self.layout.size)
+        self.board = mmap.mmap(self.board_file.fileno(), self.layout.size)
+        board.HEADER.pack_into(self.board, 0, board.MAGIC, board.VERSION,
+                               band_count)
+        self.sequence = 0
+        board.SEQUENCE.pack_into(self.board, board.SEQUENCE_OFFSET,
+                                 self.sequence)
+        self.staging = bytearray(self.layout.body_size)
+        self.counts = {}
+        for name, group_format, fields in board.GROUPS:
+            self.counts[name] = 0
+        self.handlers = {TempoEvent: self.handle_tempo,
+                         BeatEvent: self.handle_beat,
+                         RMSEvent: self.handle_rms,
+                         FrequenciesEvent: self.handle_frequencies,
+                         PitchEvent: self.handle_pitch,
+                         NoteEvent: self.handle_note,
+                         BlockEvent: self.handle_block}
+
+    def handle_event(self, event):
+        handler = self.handlers.get(type(event))
+        if handler:
+            handler(event)
+
+    def update(self, name, event_time, *values):
+        self.counts[name] += 1
+        self.layout.pack_group(self.staging, name, self.counts[name],
+                               event_time, *values)
+
+    def handle_tempo(self, event):
+        self.update('tempo', event.time, event.bpm, event.average_bpm,
+                    event.steady_bpm)
+
+    def handle_beat(self, event):
+        self.update('beat', event.time, event.position, event.value)
+
+    def handle_rms(self, event):
+        self.update('rms', event.time, event.rms, event.level)
+
+    def handle_frequencies(self, event):
+        if len(event.levels) != self.layout.band_count:
+            # fbuckets was changed while running. The layout is fixed once
+            # readers have mapped the file, so those can't go on the board.
+            return
+        values = list(event.energies) + list(event.levels)
+        self.update('frequencies', event.time, *values)
+
+    def handle_pitch(self, event):
+        self.update('pitch', event.time, event.pitch, event.confidence)
+
+    def handle_note(self, event):
+        self.update('note', event.time, event.note, event.previous_note)
+
+    def handle_block(self, event):
+        self.layout.pack_group(self.staging, 'block', time.time(), event.time)
+        self.sequence += 1
+        board.SEQUENCE.pack_into(self.board, board.SEQUENCE_OFFSET,
+                                 self.sequence)
+        self.board[board.BODY_OFFSET:self.layout.size] = bytes(self.staging)
+        self.sequence += 1
+        board.SEQUENCE.pack_into(self.board, board.SEQUENCE_OFFSET,
+                                 self.sequence)
+
+    def close(self):
+        self.board.close()
+        self.board_file.close()
+
+
+class BeatAggregator:
+    """Sums up RMS, band levels and pitch between beats.
+
+    The RMS and frequencies finders report on their own hop clocks, which
+    have nothing to do with the music, and a lighting desk only really
+    wants one value per beat (or per eighth or sixteenth) anyway. With
+    aggregate on, this subscribes to the FeatureBus ahead of the MidiEncoder
+    and adds up everything heard between beats: RMS levels, band levels, and
+    a vote for whichever note is sounding at the end of each block. At the
+    next beat, or at each part of the beat in between (worked out from the
+    steady BPM, or the time between the last two beats until there is one),
+    it publishes a SummaryEvent with the averages and the note with the most
+    votes, and starts over. The MidiEncoder sends each summary as one sysex
+    in place of the RMS, frequencies and pitch messages, which is a small
+    fraction of the messages.
+
+    The sums are allocated once, and zeroed rather than rebuilt after each
+    summary.
+
+    """
+
+    def __init__(self, options, feature_bus, band_count):
+        self.feature_bus = feature_bus
+        self.parts = options.config.aggregate
+        self.band_sums = np.zeros(band_count)
+        self.frequencies_count = 0
+        self.level_sum = 0.0
+        self.level_count = 0
+        self.note_votes = np.zeros(128, dtype=int)
+        self.note = -1
+        self.bpm = None
+        self.beat_time = None
+        self.beat_seconds = None
+        self.position = 0
+        self.part = 0
+        self.next_part_time = None
+        self.handlers = {TempoEvent: self.handle_tempo,
+                         BeatEvent: self.handle_beat,
+                         RMSEvent: self.handle_rms,
+                         FrequenciesEvent: self.handle_frequencies,
+                         NoteEvent: self.handle_note,
+                         BlockEvent: self.handle_block}
+
+    def handle_event(self, event):
+        handler = self.handlers.get(type(event))
+        if handler:
+            handler(event)
+
+    def handle_tempo(self, event):
+        if event.steady_bpm > 0:
+            self.bpm = event.steady_bpm
+
+    def handle_rms(self, event):
+        self.level_sum += event.level
+        self.level_count += 1
+
+    def handle_frequencies(self, event):
+        # Skipped if the band count changed under us, until a restart.
+        if len(event.levels) == len(self.band_sums):
+            self.band_sums += event.levels
+            self.frequencies_count += 1
+
+    def handle_note(self, event):
+        self.note = event.note
+
+    def handle_beat(self, event):
+        if self.beat_time is not None:
+            if event.time > self.beat_time:
+                self.beat_seconds = event.time - self.beat_time
+            self.summarize(event.time)
+        self.beat_time = event.time
+        self.position = event.position
+        self.part = 0
+        self.schedule_part()
+
+    def handle_block(self, event):
+        if self.note >= 0:
+            self.note_votes[self.note] += 1
+        if self.next_part_time is not None and \
+                event.time >= self.next_part_time:
+            self.summarize(event.time)
+            self.part += 1
+            self.schedule_part()
+
+    def schedule_part(self):
+        # When the next part of this beat ends, if it isn't the last part.
+        # The last part ends with the next beat, whenever that comes.
+        self.next_part_time = None
+        beat_seconds = self.beat_seconds
+        if self.bpm:
+            beat_seconds = 60.0 / self.bpm
+        if beat_seconds and self.part + 1 < self.parts:
+            self.next_part_time = (self.beat_time + beat_seconds *
+                                   (self.part + 1) / self.parts)
+
+    def summarize(self, event_time):
+        level = 0.0
+        if self.level_count:
+            level = self.level_sum / self.level_count
+        levels = self.band_sums.copy()
+        if self.frequencies_count:
+            levels /= self.frequencies_count
+        note = -1
+        if self.note_votes.any():
+            note = int(self.note_votes.argmax())
+        self.feature_bus.publish(SummaryEvent(event_time, self.position,
+                                              self.part, level, levels,
+                                              note,
+                                              self.feature_bus.input_index))
+        self.band_sums.fill(0)
+        self.frequencies_count = 0
+        self.level_sum = 0.0
+        self.level_count = 0
+        self.note_votes.fill(0)
+
+
+class InputWorker:
+    """A thread that runs the audio processors for one or more input devices.
+
+    With inworker set, a device's callback only copies the block and puts it
+    on this worker's queue, and the worker does the analysis. That keeps a
+    slow audio processor from making the sound card overflow, and lets
+    devices be spread over several cores (numpy and aubio let go of the GIL
+    while they crunch). If the worker falls behind and the queue fills up,
+    blocks are dropped and counted by the device rather than holding up the
+    callback. Until the worker is started, blocks are analysed right away in
+    the calling thread, the same as without a worker.
+
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.blocks = queue.Queue(size)
+        self.worker_thread = None
+
+    def start(self):
+        if self.worker_thread is None:
+            self.worker_thread = threading.Thread(target=self.run_worker)
+            self.worker_thread.daemon = True
+            self.worker_thread.start()
+
+    def stop(self):
+        if self.worker_thread is not None:
+            self.blocks.put(None)
+            self.worker_thread.join()
+            self.worker_thread = None
+
+    def put(self, analyse, data, frames, stream_time, capture_time=None):
+        if self.worker_thread is None:
+            analyse(data, frames, stream_time, capture_time)
+            return True
+        try:
+            # The copy has to happen here, since the sound card reuses its
+            # buffer.
+            self.blocks.put_nowait((analyse, data.copy(), frames,
+                                    stream_time, capture_time))
+        except queue.Full:
+            return False
+        return True
+
+    def run_worker(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            analyse, data, frames, stream_time, capture_time = block
+            analyse(data, frames, stream_time, capture_time)
 
 
 class ProcessAudio:
@@ -876,74 +2547,761 @@ class ProcessAudio:
     the audio processors that are turned on.  Responsible for initializing
     the audio processors and midi processor.
 
+    The audio processors publish what they find on a FeatureBus. MIDI output
+    is just one subscriber (the MidiEncoder), OSC another. If you're using
+    this as a library, subscribe to get the events directly instead of
+    sending MIDI out and reading it back in:
+
+        process_audio.subscribe(handler, [soundtomidi.BeatEvent])
+        events = process_audio.subscribe_queue(maxsize=1000)
+
+    Handlers are called from the audio thread. A subscribed queue is filled
+    without ever blocking; if it's full, the event is dropped. From asyncio,
+    use stream() instead, which runs all of this in a thread for you.
+
+    Audio processors can be changed without stopping the stream. Edit the
+    ini file and call reload() (or send the process a SIGHUP when it's run
+    from the command line), or hand reconfigure() a new Options. Only the
+    audio processors whose options changed are rebuilt, off in whatever
+    thread asked for it, and the finished ones are swapped in as a whole
+    new tuple that the callback picks up at the start of the next block.
+    enable() and disable() turn a feature on and off the same way, so ones
+    nobody is listening to don't cost anything. Sound card and output
+    options still need a restart.
+
+    inputdevice can list several devices, to run (say) two rooms from one
+    process. The first device is handled by this ProcessAudio, and each of
+    the others by one more ProcessAudio, in inputs, with its own audio
+    processors, FeatureBus and MidiEncoder. They all share this one's
+    MidiProcessor, through a MidiSource each, and start() opens a stream for
+    every one of them. subscribe() and subscribe_queue() here hear from all
+    of them, and every event's input_index says which device it came from;
+    subscribe to inputs[n] to hear from device n alone.
+    reconfigure(), enable() and disable() apply to every device. Capture,
+    replay, OSC and the FeatureBoard are for the first device only; when
+    replaying, the other devices aren't opened. stats() has numbers for
+    each device. A device can also be raw audio from standard input, a named
+    pipe or UDP (see rawinput.py), which goes through the same callback.
+
+    With statefile set, what the audio processors have learned (RMS and band
+    maxima, recent BPMs) is loaded at startup, saved every statesave seconds
+    from a thread of its own, and saved once more when start() returns. An
+    audio processor rebuilt by reconfigure() takes over its old one's state
+    too, if it still fits.
+
     """
 
-    def __init__(self, options):
-        self.midi_processor = MidiProcessor(options)
-        if options.settings['midiout']:
-            if options.settings['outport'] == 'default':
-                available_ports = mido.get_output_names()
-                if available_ports:
-                    options.settings['outport'] = available_ports[0]
-                else:
-                    options.settings['outport'] = ""
-            if options.settings['outport']:
-                self.midi_processor.midi_outport = mido.open_output(
-                    options.settings['outport'])
-
-        if options.settings['getbeats'] == 'True':
-            self.beat_finder = BeatFinder(options)
-            self.beat_finder.midi_processor = self.midi_processor
-        else:
-            self.beat_finder = None
-        if options.settings['gettempo'] == 'True':
-            self.tempo_finder = TempoFinder(options)
-            self.tempo_finder.midi_processor = self.midi_processor
-        else:
-            self.tempo_finder = None
-        if options.settings['getrms'] == 'True':
-            self.rms_finder = RMSFinder(options)
-            self.rms_finder.midi_processor = self.midi_processor
-        else:
-            self.rms_finder = None
-        if options.settings['getfrequencies'] == 'True':
-            self.frequencies_finder = FrequenciesFinder(options)
-            self.frequencies_finder.midi_processor = self.midi_processor
+    # Feature, the attribute it's kept in, and its audio processor. In the
+    # order they get the audio.
+    finder_classes = (('beats', 'beat_finder', BeatFinder),
+                      ('tempo', 'tempo_finder', TempoFinder),
+                      ('rms', 'rms_finder', RMSFinder),
+                      ('frequencies', 'frequencies_finder',
+                       FrequenciesFinder),
+                      ('pitch', 'pitch_finder', PitchFinder))
+
+    def __init__(self, options, input_index=0, midi_processor=None,
+                 workers=None):
+        config = options.config
+        self.options = options
+        self.reconfigure_lock = threading.Lock()
+        self.input_index = input_index
+        self.input_device, self.input_channel, self.features, \
+            self.worker_name = config.inputs[input_index]
+        if midi_processor is not None:
+            self.midi_processor = midi_processor
         else:
-            self.frequencies_finder = None
-        if options.settings['getpitch'] == 'True':
-            self.pitch_finder = PitchFinder(options)
-            self.pitch_finder.midi_processor = self.midi_processor
+            self.midi_processor = MidiProcessor(options)
+        if config.midiout and midi_processor is None:
+            for output in self.midi_processor.outputs:
+                if output.port_name == 'default':
+                    available_ports = mido.get_output_names()
+                    if available_ports:
+                        output.port_name = available_ports[0]
+                    else:
+                        output.port_name = ""
+                if output.port_name:
+                    output.midi_outport = mido.open_output(output.port_name)
+
+        self.feature_bus = FeatureBus(input_index)
+        self.beat_aggregator = None
+        if config.aggregate is not None:
+            # Ahead of the MidiEncoder, so a block's summary goes out with
+            # the rest of the block.
+            self.beat_aggregator = BeatAggregator(options, self.feature_bus,
+                                                  config.fbands)
+            self.feature_bus.subscribe(self.beat_aggregator.handle_event)
+        self.midi_source = MidiSource(self.midi_processor, input_index,
+                                      self.input_channel)
+        self.midi_encoder = MidiEncoder(options, self.midi_source)
+        self.feature_bus.subscribe(self.midi_encoder.handle_event,
+                                   owner=self.midi_encoder)
+        self.osc_processor = None
+        if config.oscout and input_index == 0:
+            self.osc_processor = OscProcessor(options)
+            self.feature_bus.subscribe(self.osc_processor.handle_event)
+        self.frames_processed = 0
+        self.blocks_analysed = 0
+        self.dropped_blocks = 0
+        self.flagged_blocks = 0
+        self.busy_total = 0.0
+        self.busy_max = 0.0
+
+        self.finders = ()
+        for feature, attribute, finder_class in self.finder_classes:
+            setattr(self, attribute, None)
+        for feature, attribute, finder_class in self.finder_classes:
+            if getattr(config, LIVE_OPTIONS[feature][0]) and \
+                    self.wants(feature):
+                self.set_finder(feature, self.build_finder(feature, options))
+        self.feature_board = None
+        if config.boardout and input_index == 0:
+            band_count = 0
+            if self.frequencies_finder:
+                band_count = config.fbands
+            self.feature_board = FeatureBoard(options, band_count)
+            self.feature_bus.subscribe(self.feature_board.handle_event)
+        self.channels = config.channels
+        self.blocksize = config.framesize
+        self.samplerate = config.samplerate
+        self.replay_reader = None
+        self.raw_source = rawinput.parse_source(self.input_device)
+        self.input_stream = None
+        self.stop_event = threading.Event()
+        if workers is None:
+            workers = {}
+        self.workers = workers
+        self.worker = None
+        if self.worker_name is not None:
+            if self.worker_name not in workers:
+                workers[self.worker_name] = InputWorker(self.worker_name,
+                                                        config.inqueue)
+            self.worker = workers[self.worker_name]
+        if config.replayfile is not None and input_index == 0:
+            self.replay_reader = capture.CaptureReader(config.replayfile)
+            if self.replay_reader.samplerate != self.samplerate:
+                raise ValueError(config.replayfile + " was captured at " +
+                                 str(self.replay_reader.samplerate) + " Hz, "
+                                 "set samplerate to match")
+        elif self.input_device == 'default' and self.raw_source is None:
+            self.input_device = sd.default.device['input']
+        self.input_capture = None
+        if config.capturefile is not None and input_index == 0:
+            self.input_capture = capture.CaptureWriter(
+                config.capturefile, self.samplerate, self.channels,
+                config.capturequeue)
+        self.inputs = [self]
+        if input_index == 0 and self.replay_reader is None:
+            for index in range(1, len(config.inputs)):
+                self.inputs.append(ProcessAudio(options, index,
+                                                self.midi_processor,
+                                                self.workers))
+        if config.statefile is not None and input_index == 0:
+            self.load_state()
+
+    def subscribe(self, handler, event_types=None):
+        # Every device's FeatureBus, so with several devices the handler
+        # gets called from each one's thread. event.input_index says which.
+        for process_audio in self.inputs:
+            process_audio.feature_bus.subscribe(handler, event_types)
+        return handler
+
+    def subscribe_queue(self, maxsize=0, event_types=None):
+        event_queue = queue.Queue(maxsize)
+
+        def put_event(event):
+            try:
+                event_queue.put_nowait(event)
+            except queue.Full:
+                pass
+
+        for process_audio in self.inputs:
+            process_audio.feature_bus.subscribe(put_event, event_types,
+                                                event_queue)
+        return event_queue
+
+    def unsubscribe(self, handler_or_queue):
+        for process_audio in self.inputs:
+            process_audio.feature_bus.unsubscribe(handler_or_queue)
+
+    def wants(self, feature):
+        return self.features is None or feature in self.features
+
+    def get_finder(self, feature):
+        for name, attribute, finder_class in self.finder_classes:
+            if name == feature:
+                return getattr(self, attribute)
+        raise ValueError("Unknown feature '" + feature + "'")
+
+    def build_finder(self, feature, options):
+        for name, attribute, finder_class in self.finder_classes:
+            if name == feature:
+                finder = finder_class(options)
+                finder.feature_bus = self.feature_bus
+                return finder
+        raise ValueError("Unknown feature '" + feature + "'")
+
+    def set_finder(self, feature, finder):
+        # Build the new tuple off to the side, then swap it in with one
+        # assignment. The callback only looks at self.finders once per
+        # block, so it gets either all of the old ones or all of the new.
+        finders = []
+        for name, attribute, finder_class in self.finder_classes:
+            if name == feature:
+                setattr(self, attribute, finder)
+            current = getattr(self, attribute)
+            if current is not None:
+                finders.append(current)
+        share_tempo_object(self.beat_finder, self.tempo_finder)
+        self.finders = tuple(finders)
+
+    def enable(self, feature):
+        # On every input device that wants the feature (see infeatures).
+        with self.reconfigure_lock:
+            for process_audio in self.inputs:
+                if process_audio.wants(feature) and \
+                        process_audio.get_finder(feature) is None:
+                    process_audio.set_finder(
+                        feature, process_audio.build_finder(feature,
+                                                            self.options))
+
+    def disable(self, feature):
+        with self.reconfigure_lock:
+            for process_audio in self.inputs:
+                process_audio.set_finder(feature, None)
+
+    def reconfigure(self, options):
+        # Apply a new set of options to a running stream. Returns the names
+        # of changed options that won't take effect until a restart.
+        with self.reconfigure_lock:
+            old_config = self.options.config
+            changed = [name for name in OPTION_NAMES
+                       if getattr(old_config, name, None) !=
+                       getattr(options.config, name, None)]
+            live = list(ENCODER_OPTIONS) + list(STARTUP_OPTIONS)
+            for names in LIVE_OPTIONS.values():
+                live.extend(names)
+            restart_needed = [name for name in changed if name not in live]
+            if restart_needed:
+                # Keep what the stream is actually running with, so a new
+                # samplerate or framesize doesn't sneak into the rebuilt
+                # audio processors.
+                for name in restart_needed:
+                    options.settings[name] = self.options.settings[name]
+                options.config = Config(options.settings)
+            if [name for name in changed if name in ENCODER_OPTIONS]:
+                self.midi_processor.set_urgent(options.config)
+            for process_audio in self.inputs:
+                process_audio.apply_options(options, changed)
+            return restart_needed
+
+    def apply_options(self, options, changed):
+        # This input device's part of reconfigure().
+        for feature, names in LIVE_OPTIONS.items():
+            if [name for name in changed if name in names]:
+                finder = None
+                if getattr(options.config, names[0]) and self.wants(feature):
+                    finder = self.build_finder(feature, options)
+                    old_finder = self.get_finder(feature)
+                    if old_finder is not None and \
+                            hasattr(old_finder, 'save_state'):
+                        finder.load_state(old_finder.save_state())
+                self.set_finder(feature, finder)
+        if [name for name in changed if name in ENCODER_OPTIONS]:
+            midi_encoder = MidiEncoder(options, self.midi_source)
+            self.feature_bus.replace(self.midi_encoder,
+                                     midi_encoder.handle_event,
+                                     owner=midi_encoder)
+            self.midi_encoder = midi_encoder
+        self.options = options
+
+    def save_state(self):
+        # Every input device's, named "<input>/<feature>/<name>". Runs in
+        # whatever thread calls it. The band maxima are replaced, never
+        # changed in place, and the BPM lists are copied in one go, so a copy
+        # taken mid-block is still a whole one.
+        state = {}
+        for process_audio in self.inputs:
+            for feature, attribute, finder_class in self.finder_classes:
+                finder = getattr(process_audio, attribute)
+                if finder is None or not hasattr(finder, 'save_state'):
+                    continue
+                for name, values in finder.save_state().items():
+                    state[str(process_audio.input_index) + '/' + feature +
+                          '/' + name] = values
+        try:
+            snapshot.write(self.options.config.statefile, state)
+        except (IOError, OSError) as error:
+            print("Couldn't save state. " + str(error), file=sys.stderr)
+            return False
+        return True
+
+    def load_state(self):
+        config = self.options.config
+        try:
+            saved = snapshot.read(config.statefile, config.statemaxage)
+        except (IOError, OSError, ValueError) as error:
+            print("Not using the saved state. " + str(error),
+                  file=sys.stderr)
+            return False
+        if saved is None:
+            return False
+        state, age = saved
+        finder_states = {}
+        for key, values in state.items():
+            parts = key.split('/', 2)
+            if len(parts) == 3:
+                finder_states.setdefault((parts[0], parts[1]),
+                                         {})[parts[2]] = values
+        for process_audio in self.inputs:
+            for feature, attribute, finder_class in self.finder_classes:
+                finder = getattr(process_audio, attribute)
+                finder_state = finder_states.get(
+                    (str(process_audio.input_index), feature))
+                if finder_state and finder is not None and \
+                        hasattr(finder, 'load_state'):
+                    finder.load_state(finder_state)
+        return True
+
+    def run_state_saver(self, done):
+        while not done.wait(self.options.config.statesave):
+            self.save_state()
+
+    def reload(self):
+        # Reread the ini file in the background and apply it. Safe to call
+        # from a signal handler.
+        reload_thread = threading.Thread(target=self.reload_now)
+        reload_thread.daemon = True
+        reload_thread.start()
+        return reload_thread
+
+    def reload_now(self):
+        try:
+            options = self.options.reload()
+        except ValueError as error:
+            print("Reload failed, keeping the old options. " + str(error),
+                  file=sys.stderr)
+            return
+        restart_needed = self.reconfigure(options)
+        if restart_needed:
+            print("These need a restart to change: " +
+                  ", ".join(restart_needed), file=sys.stderr)
+
+    def callback(self, data, frames, time_info, status):
+        if self.input_capture:
+            self.input_capture.write(self.frames_processed, data, time_info,
+                                     status)
+        if status:
+            self.flagged_blocks += 1
+        self.frames_processed += frames
+        stream_time = self.frames_processed / self.samplerate
+        capture_time = self.block_capture_time(frames, time_info)
+        if self.worker:
+            if not self.worker.put(self.analyse, data, frames, stream_time,
+                                   capture_time):
+                self.dropped_blocks += 1
         else:
-            self.pitch_finder = None
-        if options.settings['inputdevice'] == 'default':
-            options.settings['inputdevice'] = sd.default.device['input']
-        self.input_device = options.settings['inputdevice']
-        self.channels = int(options.settings['channels'])
-        self.blocksize = int(options.settings['framesize'])
-        self.samplerate = int(options.settings['samplerate'])
-
-    def callback(self, data, ignore_frames, ignore_time, ignore_status):
+            self.analyse(data, frames, stream_time, capture_time)
+
+    def block_capture_time(self, frames, time_info):
+        # When the last sample of the block reached the sound card, on the
+        # monotonic clock. PortAudio's timestamps are on a clock of its own,
+        # but currentTime is now on that clock, which lines the two up.
+        now = monotonic()
+        adc_time = getattr(time_info, 'inputBufferAdcTime', 0.0)
+        current_time = getattr(time_info, 'currentTime', 0.0)
+        if not adc_time or not current_time:
+            # Some host APIs don't fill them in. It's just arrived, then.
+            return now
+        return now - current_time + adc_time + frames / self.samplerate
+
+    def analyse(self, data, frames, stream_time, capture_time=None):
+        started = monotonic()
+        self.feature_bus.stream_time = stream_time
+        self.feature_bus.capture_time = capture_time
+        self.midi_source.capture_time = capture_time
         if any(data):
-            if self.beat_finder:
-                self.beat_finder.add_frame(data[:, 0])
-            if self.tempo_finder:
-                self.tempo_finder.add_frame(data[:, 0])
-            if self.rms_finder:
-                self.rms_finder.add_frame(data[:, 0])
-            if self.frequencies_finder:
-                self.frequencies_finder.add_frame(data[:, 0])
-            if self.pitch_finder:
-                self.pitch_finder.add_frame(data[:, 0])
+            for finder in self.finders:
+                finder.add_frame(data[:, 0])
+        self.feature_bus.publish(BlockEvent(stream_time, frames,
+                                            self.input_index))
+        busy = monotonic() - started
+        self.blocks_analysed += 1
+        self.busy_total += busy
+        if busy > self.busy_max:
+            self.busy_max = busy
 
     def start(self):
-        with sd.InputStream(device=self.input_device,
-                            channels=self.channels,
-                            callback=self.callback,
-                            blocksize=self.blocksize,
-                            samplerate=self.samplerate):
-            while True:
-                pass
+        self.midi_processor.start()
+        for worker in self.workers.values():
+            worker.start()
+        state_done = threading.Event()
+        state_thread = None
+        if self.options.config.statefile is not None:
+            state_thread = threading.Thread(target=self.run_state_saver,
+                                            args=(state_done,))
+            state_thread.daemon = True
+            state_thread.start()
+        try:
+            if self.replay_reader:
+                self.replay()
+                return
+            input_streams = []
+            try:
+                for process_audio in self.inputs:
+                    input_stream = process_audio.open_stream(self.stop)
+                    input_streams.append(input_stream)
+                    process_audio.input_stream = input_stream
+                    input_stream.start()
+                while not self.stop_event.is_set():
+                    time.sleep(.1)
+            finally:
+                for process_audio in self.inputs:
+                    process_audio.input_stream = None
+                for input_stream in input_streams:
+                    input_stream.close()
+        finally:
+            # Workers first, so what they were still working on makes it
+            # out.
+            for worker in self.workers.values():
+                worker.stop()
+            if state_thread:
+                state_done.set()
+                state_thread.join()
+                self.save_state()
+            self.midi_processor.stop()
+            if self.input_capture:
+                self.input_capture.close()
+                self.input_capture = None
+
+    def open_stream(self, finished_callback):
+        # A sound card through sounddevice, or raw input. finished_callback
+        # is for raw input that ends, like standard input.
+        if self.raw_source is not None:
+            config = self.options.config
+            return rawinput.open_stream(self.raw_source, self.channels,
+                                        self.callback, self.blocksize,
+                                        self.samplerate, config.rawformat,
+                                        config.rawjitter, finished_callback)
+        return sd.InputStream(device=self.input_device,
+                              channels=self.channels,
+                              callback=self.callback,
+                              blocksize=self.blocksize,
+                              samplerate=self.samplerate)
+
+    def replay(self):
+        # Feed the blocks of a capture file to the callback, at their
+        # original sample positions so stream times come out the same, and
+        # paced to replayspeed.
+        speed = self.options.config.replayspeed
+        started = monotonic()
+        first_position = None
+        try:
+            for position, data, time_info, status in \
+                    self.replay_reader.blocks():
+                frames = len(data)
+                if frames != self.blocksize:
+                    raise ValueError("The capture file has blocks of " +
+                                     str(frames) + " frames, set "
+                                     "framesize to match")
+                if first_position is None:
+                    first_position = position
+                if speed:
+                    due = started + (position - first_position + frames) / \
+                        self.samplerate / speed
+                    wait = due - monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                if self.stop_event.is_set():
+                    break
+                self.frames_processed = position
+                self.callback(data, frames, time_info, status)
+        finally:
+            self.replay_reader.close()
+            self.replay_reader = None
+
+    def stop(self):
+        # Makes start() return, from any thread, after the block it's on.
+        self.stop_event.set()
+
+    def stats(self):
+        midi_stats = self.midi_processor.stats()
+        input_stats = []
+        for process_audio in self.inputs:
+            busy_average = 0.0
+            if process_audio.blocks_analysed:
+                busy_average = (process_audio.busy_total /
+                                process_audio.blocks_analysed)
+            channel = process_audio.input_channel
+            if channel is not None:
+                channel += 1
+            raw_stats = None
+            input_stream = process_audio.input_stream
+            if input_stream is not None and hasattr(input_stream, 'stats'):
+                raw_stats = input_stream.stats()
+            input_stats.append({
+                'device': process_audio.input_device,
+                'channel': channel,
+                'worker': process_audio.worker_name,
+                'features': [feature for feature, attribute, finder_class
+                             in self.finder_classes
+                             if getattr(process_audio, attribute)],
+                'blocks': process_audio.blocks_analysed,
+                'dropped_blocks': process_audio.dropped_blocks,
+                'flagged_blocks': process_audio.flagged_blocks,
+                'busy_average': busy_average,
+                'busy_max': process_audio.busy_max,
+                'midi_sent': midi_stats['sent_by_input'].get(
+                    process_audio.input_index, 0),
+                'raw_input': raw_stats})
+        return {'inputs': input_stats, 'midi': midi_stats}
+
+
+def stream(options, max_blocks=100, policy='dropoldest', event_types=None):
+    """Feature events for asyncio. Python 3 only.
+
+        async with soundtomidi.stream(options) as events:
+            async for event in events:
+                ...
+
+    See streaming.py for the details and the backpressure policies.
+
+    """
+    try:
+        from . import streaming
+    except (ImportError, ValueError):
+        import streaming
+    return streaming.FeatureStream(options, max_blocks, policy, event_types)
+
+
+class AutoTuner:
+    """Tries out settings for each audio processor on this computer.
+
+    Getting the frame and hop multipliers right took a whole lot of tweaking,
+    and the right answer on a laptop isn't the right answer on a Pi Zero. So
+    this runs every turned on audio processor over synthetic audio from
+    signals.py, for each candidate framesize, multiplier and algorithm, and
+    times it. Cost is the fraction of one CPU core it takes to keep up with
+    the audio, and latency is how long it waits for a window of audio to
+    fill plus how long it takes to work on it.
+
+    Where there's a right answer to check against, there's an accuracy:
+    BPM of click tracks for tempo, clicks found for beats, and notes of pure
+    tones for pitch. RMS and frequencies don't have one, so for those the
+    window already in use is kept if it fits, and otherwise the cheapest.
+
+    Each audio processor gets an even share of tunecpu. Within that, and
+    within tunelatency, the most accurate setting wins, then the quickest.
+    The framesize that does best for all of them together is written to the
+    ini file with everything else left as it was. Settings that aubio won't
+    take (newer versions want exactly one hop per call) are skipped.
+
+    """
+
+    framesizes = (256, 512, 1024)
+    frame_multipliers = (1, 2, 4, 8)
+    hop_multipliers = ('1', '.5')
+    algorithms = {'tempo': ('default', 'specflux', 'complex', 'energy',
+                            'flux'),
+                  'beats': ('default', 'specflux', 'complex', 'energy',
+                            'flux'),
+                  'pitch': ('yin', 'yinfft', 'mcomb', 'schmitt')}
+    click_bpms = (96, 128)
+    notes = (45, 52, 57, 64, 69, 76, 81)
+
+    def __init__(self, options):
+        try:
+            from . import signals
+        except (ImportError, ValueError):
+            import signals
+        config = options.config
+        self.options = options
+        self.samplerate = config.samplerate
+        self.cpu_budget = config.tunecpu / 100.0
+        self.latency_budget = config.tunelatency
+        self.features = [feature for feature in FEATURES
+                         if getattr(config, LIVE_OPTIONS[feature][0])]
+        self.click_tracks = [signals.click_track(bpm, 8, self.samplerate)
+                             for bpm in self.click_bpms]
+        self.tones = signals.tones(self.notes, .5, self.samplerate)
+
+    def candidates(self, feature, framesize):
+        prefix = feature[0]
+        hop_multipliers = self.hop_multipliers
+        if feature == 'rms':
+            hop_multipliers = ('1',)
+        for algorithm in self.algorithms.get(feature, (None,)):
+            for frame_multiplier in self.frame_multipliers:
+                for hop_multiplier in hop_multipliers:
+                    changes = {'framesize': str(framesize),
+                               prefix + 'framemult': str(frame_multiplier),
+                               prefix + 'hopmult': hop_multiplier}
+                    if algorithm:
+                        changes[prefix + 'alg'] = algorithm
+                    yield changes
+
+    def run_finder(self, feature, options, samples):
+        for name, attribute, finder_class in ProcessAudio.finder_classes:
+            if name == feature:
+                finder = finder_class(options)
+        events = []
+        finder.feature_bus = FeatureBus()
+        finder.feature_bus.subscribe(events.append)
+        framesize = options.config.framesize
+        started = monotonic()
+        for start in range(0, len(samples) - framesize + 1, framesize):
+            finder.feature_bus.stream_time = (start + framesize) / \
+                self.samplerate
+            finder.add_frame(samples[start:start + framesize])
+        return events, monotonic() - started
+
+    def measure(self, feature, changes):
+        # Returns accuracy (or None), cost and latency for one candidate, or
+        # None if it can't be used at all.
+        try:
+            options = self.options.with_settings(changes)
+        except ValueError:
+            return None
+        config = options.config
+        window = config.framesize * getattr(config, feature[0] + 'framemult')
+        if feature == 'pitch':
+            tests = [(self.tones, self.score_pitch)]
+        elif feature == 'tempo':
+            tests = [(track, self.score_tempo) for track in self.click_tracks]
+        elif feature == 'beats':
+            tests = [(track, self.score_beats) for track in self.click_tracks]
+        else:
+            tests = [(self.click_tracks[0], None)]
+        elapsed = 0.0
+        audio_seconds = 0.0
+        hops = 0
+        scores = []
+        for (samples, answer), score in tests:
+            try:
+                events, seconds = self.run_finder(feature, options, samples)
+            except (ValueError, RuntimeError):
+                return None
+            elapsed += seconds
+            audio_seconds += len(samples) / self.samplerate
+            hops += len(samples) // window
+            if score:
+                scores.append(score(events, answer, window))
+        accuracy = None
+        if scores:
+            accuracy = sum(scores) / len(scores)
+        latency = window / self.samplerate + elapsed / max(hops, 1)
+        return accuracy, elapsed / audio_seconds, latency
+
+    def score_tempo(self, events, click_times, window):
+        events = [event for event in events if isinstance(event, TempoEvent)]
+        if not events:
+            return 0.0
+        # The middle interval, so hand marked beats that wander a little
+        # still give the right BPM.
+        bpm = 60.0 / np.median(np.diff(click_times))
+        return max(0.0, 1.0 - abs(events[-1].steady_bpm - bpm) / 10.0)
+
+    def score_beats(self, events, click_times, window):
+        # F-measure, after the first second. A beat counts if it is reported
+        # after its click, but before the next window could have caught it.
+        late = window / self.samplerate + .1
+        click_times = [click for click in click_times if click > 1]
+        beat_times = [event.time for event in events
+                      if isinstance(event, BeatEvent) and event.time > 1]
+        if not click_times or not beat_times:
+            return 0.0
+        found = [click for click in click_times
+                 if [beat for beat in beat_times
+                     if click <= beat <= click + late]]
+        matched = [beat for beat in beat_times
+                   if [click for click in click_times
+                       if click <= beat <= click + late]]
+        precision = len(matched) / len(beat_times)
+        recall = len(found) / len(click_times)
+        if not precision + recall:
+            return 0.0
+        return 2 * precision * recall / (precision + recall)
+
+    def score_pitch(self, events, answers, window):
+        # Fraction of pitches that are the right note, leaving out any
+        # window that straddles two notes.
+        half_window = window / self.samplerate / 2
+        right = 0
+        counted = 0
+        for event in events:
+            if not isinstance(event, PitchEvent):
+                continue
+            center = event.time - half_window
+            for start, end, note in answers:
+                if start + half_window < center < end - half_window:
+                    counted += 1
+                    if int(round(event.pitch)) == note:
+                        right += 1
+        if not counted:
+            return 0.0
+        return right / counted
+
+    def choose(self, feature, framesize, share):
+        config = self.options.config
+        current_window = getattr(config, feature[0] + 'window')
+        best = None
+        for changes in self.candidates(feature, framesize):
+            measured = self.measure(feature, changes)
+            if measured is None:
+                continue
+            accuracy, cost, latency = measured
+            window = framesize * int(changes[feature[0] + 'framemult'])
+            fits = cost <= share and latency <= self.latency_budget
+            if accuracy is None:
+                rank = (fits, window == current_window, -cost)
+            else:
+                rank = (fits, accuracy, -latency)
+            if best is None or rank > best[0]:
+                best = (rank, changes, measured, fits)
+        return best
+
+    def run(self):
+        share = self.cpu_budget / max(len(self.features), 1)
+        best = None
+        for framesize in self.framesizes:
+            print("\nFramesize", framesize)
+            chosen = []
+            for feature in self.features:
+                choice = self.choose(feature, framesize, share)
+                if choice is None:
+                    print("  {:<12} nothing aubio would take".format(feature))
+                    break
+                rank, changes, (accuracy, cost, latency), fits = choice
+                print("  {:<12} {:<40} accuracy {:>5} cpu {:5.1f}% latency "
+                      "{:5.3f}s{}".format(
+                          feature, " ".join(
+                              key + "=" + changes[key]
+                              for key in sorted(changes)
+                              if key != 'framesize'),
+                          '-' if accuracy is None else
+                          "{:.2f}".format(accuracy), cost * 100, latency,
+                          '' if fits else ' (over budget)'))
+                chosen.append(choice)
+            else:
+                all_fit = all(choice[3] for choice in chosen)
+                accuracy = sum(choice[2][0] or 0.0 for choice in chosen)
+                latency = max([choice[2][2] for choice in chosen] or [0.0])
+                rank = (all_fit, accuracy, -latency)
+                if best is None or rank > best[0]:
+                    best = (rank, framesize, chosen)
+        if best is None:
+            print("\nNo settings worked. Nothing written.")
+            return None
+        changes = {}
+        for choice in best[2]:
+            changes.update(choice[1])
+        tuned_options = self.options.with_settings(changes)
+        tuned_options.write_options_ini()
+        if not best[0][0]:
+            print("\nNothing fit the budget, so these are the closest.")
+        print("\nFramesize", best[1], "wins. Written to",
+              tuned_options.settings['inifile'])
+        return tuned_options
 
 
 if __name__ == '__main__':
@@ -954,22 +3312,33 @@ if __name__ == '__main__':
     # information, do that then quit.
     #
     # Otherwise, start the ProcessAudio class and get out of the way.
-    main_options = Options()
-    if main_options.settings['writeinifile']:
+    try:
+        main_options = Options()
+    except ValueError as error:
+        sys.exit(str(error))
+    if main_options.config.writeinifile:
         main_options.write_options_ini()
         quit()
-    elif main_options.settings['listsounddevices'] or main_options.settings[
-        'listmidiports']:
-        if main_options.settings['listsounddevices']:
+    elif main_options.config.autotune:
+        AutoTuner(main_options).run()
+        quit()
+    elif main_options.config.listsounddevices or \
+            main_options.config.listmidiports:
+        if main_options.config.listsounddevices:
             print("\nAvailable sound devices:")
             print(sd.query_devices())
-        if main_options.settings['listmidiports']:
+        if main_options.config.listmidiports:
             print("\nAvailable MIDI ports:")
             print("\n".join(mido.get_output_names()))
         print("")
         quit()
     print("Control-C to quit")
-    process_audio = ProcessAudio(main_options)
+    try:
+        process_audio = ProcessAudio(main_options)
+    except ValueError as error:
+        sys.exit(str(error))
+    if hasattr(signal, 'SIGHUP'):
+        # kill -HUP rereads the ini file without stopping the audio.
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: process_audio.reload())
     process_audio.start()
-    while True:
-        time.sleep(.1)
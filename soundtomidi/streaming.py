@@ -0,0 +1,188 @@
+"""Feature events for asyncio. Python 3 only.
+
+Rather than running ProcessAudio.start in a thread and reading the MIDI back
+in, an asyncio program can get the FeatureBus events directly:
+
+    async with soundtomidi.stream(options) as events:
+        async for event in events:
+            if isinstance(event, soundtomidi.BeatEvent):
+                ...
+
+ProcessAudio runs in its own thread as usual. Events are collected on the
+audio thread until the end of each block, and the whole block's worth is
+handed to the event loop at once, so the loop wakes up once per block rather
+than once per event. Blocks that produced nothing (that weren't asked for)
+aren't handed over at all. The BlockEvent that ends each block is passed
+along too, unless event_types leaves it out. To work a block at a time, use
+"async for batch in events.blocks()" instead.
+
+With several input devices, events come from all of them, each device's
+blocks handed over separately as they finish, and event.input_index says
+which device an event came from.
+
+If the program falls more than max_blocks blocks behind, something has to
+give, and policy says what:
+
+    dropoldest  throw away the oldest waiting block, since it's the stalest.
+    dropnewest  throw away the block that just came in.
+    wait        hold up the audio thread until there's room. Nothing is
+                lost, but a sound card will overflow, so this is really only
+                for replaying a capture file as fast as it can go.
+
+Dropped blocks are counted in stats().
+
+"""
+import asyncio
+import collections
+import threading
+
+try:
+    from .soundtomidi import BlockEvent, ProcessAudio
+except (ImportError, ValueError):
+    from soundtomidi import BlockEvent, ProcessAudio
+
+POLICIES = ('dropoldest', 'dropnewest', 'wait')
+
+
+class FeatureStream:
+    """Runs ProcessAudio and hands its events to the event loop."""
+
+    def __init__(self, options, max_blocks=100, policy='dropoldest',
+                 event_types=None):
+        if policy not in POLICIES:
+            raise ValueError("Policy must be one of " + ", ".join(POLICIES))
+        if max_blocks < 1:
+            raise ValueError("max_blocks must be at least 1")
+        self.process_audio = ProcessAudio(options)
+        self.max_blocks = max_blocks
+        self.policy = policy
+        self.event_types = None
+        if event_types is not None:
+            self.event_types = tuple(event_types)
+        # Audio threads only. One list per input device, since each has a
+        # thread of its own.
+        self.collecting = [[] for process_audio in self.process_audio.inputs]
+        self.slots = None
+        if policy == 'wait':
+            self.slots = threading.Semaphore(max_blocks)
+        # Event loop only.
+        self.loop = None
+        self.ready = None
+        self.waiting = collections.deque()
+        self.batch = ()
+        self.position = 0
+        self.finished = False
+        self.error = None
+        self.delivered_blocks = 0
+        self.dropped_blocks = 0
+        self.audio_thread = None
+        self.closed = False
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_event_loop()
+        self.ready = asyncio.Event()
+        for process_audio in self.process_audio.inputs:
+            process_audio.feature_bus.subscribe(self.handle_event,
+                                                owner=self)
+        self.audio_thread = threading.Thread(target=self.run_audio)
+        self.audio_thread.daemon = True
+        self.audio_thread.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.process_audio.unsubscribe(self)
+        self.process_audio.stop()
+        if self.audio_thread:
+            await self.loop.run_in_executor(None, self.audio_thread.join)
+
+    def run_audio(self):
+        error = None
+        try:
+            self.process_audio.start()
+        except Exception as exception:
+            error = exception
+        try:
+            self.loop.call_soon_threadsafe(self.finish, error)
+        except RuntimeError:
+            # The event loop is already gone.
+            pass
+
+    def handle_event(self, event):
+        # Called from the input device's audio thread, for every event.
+        is_block = isinstance(event, BlockEvent)
+        collecting = self.collecting[event.input_index]
+        if self.event_types is None or isinstance(event, self.event_types):
+            collecting.append(event)
+        if not is_block or not collecting:
+            return
+        batch = collecting
+        self.collecting[event.input_index] = []
+        if self.slots:
+            while not self.slots.acquire(timeout=.1):
+                if self.closed:
+                    return
+        self.loop.call_soon_threadsafe(self.deliver, batch)
+
+    def deliver(self, batch):
+        # On the event loop, once per block.
+        self.delivered_blocks += 1
+        if len(self.waiting) >= self.max_blocks:
+            self.dropped_blocks += 1
+            if self.policy == 'dropnewest':
+                return
+            self.waiting.popleft()
+        self.waiting.append(batch)
+        self.ready.set()
+
+    def finish(self, error):
+        self.finished = True
+        self.error = error
+        self.ready.set()
+
+    async def next_batch(self):
+        # The next block's worth of events, or None once the audio stops.
+        while not self.waiting:
+            if self.finished:
+                if self.error:
+                    error, self.error = self.error, None
+                    raise error
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        batch = self.waiting.popleft()
+        if self.slots:
+            self.slots.release()
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self.position >= len(self.batch):
+            batch = await self.next_batch()
+            if batch is None:
+                raise StopAsyncIteration
+            self.batch = batch
+            self.position = 0
+        event = self.batch[self.position]
+        self.position += 1
+        return event
+
+    async def blocks(self):
+        while True:
+            batch = await self.next_batch()
+            if batch is None:
+                return
+            yield batch
+
+    def stats(self):
+        return {'delivered_blocks': self.delivered_blocks,
+                'dropped_blocks': self.dropped_blocks,
+                'waiting_blocks': len(self.waiting)}